@@ -15,10 +15,15 @@ from urllib3.util.retry import Retry
 import json
 import hashlib
 import threading
+import socket
 from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
+from queue import Queue, Empty
 import concurrent.futures
-import csv
+import re
+import zipfile
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 
 # 修复PyInstaller打包后的akshare导入问题
 def fix_akshare_import():
@@ -46,6 +51,7 @@ fix_akshare_import()
 
 # 现在安全地导入其他模块
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta, date
 
 # 尝试导入akshare，如果失败提供备选方案
@@ -78,12 +84,41 @@ except ImportError:
 
 # 导入修复工具需要的模块
 import shutil
+import tempfile
+import multiprocessing
+
+# 本地模块
+import panel
+import resample
+import xsection
+import validation
+import work_queue
+import indicators
+import layout
+import index_store
+import replay
+import data_providers
+import window_scheduler
 
 # 配置 - 符合文档要求
 ROOT_DIR = "D:/股票归档"
-DATA_DIR = os.path.join(ROOT_DIR, "A_Stock_Data")
+DATA_DIR = os.path.join(ROOT_DIR, "A_Stock_Data")  # 按上市年限分组（新布局下为指向存储文件的链接视图）
+STORE_DIR = os.path.join(ROOT_DIR, "A_Stock_Store")  # 按股票代码固定存放的归档文件
 TEMPLATE_FILE = os.path.join(ROOT_DIR, "K线数据模板.xlsx")
 INDEX_FILE = os.path.join(ROOT_DIR, "stock_index.csv")
+RAW_DIR = os.path.join(ROOT_DIR, "A_Stock_Raw")  # 不复权日线
+FACTOR_DIR = os.path.join(ROOT_DIR, "A_Stock_Factor")  # 后复权因子
+RESAMPLE_DIR = os.path.join(ROOT_DIR, "A_Stock_Resampled")  # 周线/月线
+PANEL_CACHE_DIR = os.path.join(ROOT_DIR, "A_Stock_Cache")  # 归档Excel的二进制读取缓存
+XSECTION_DIR = os.path.join(ROOT_DIR, "A_Stock_XSection")  # 按交易日的全市场横截面
+INDICATOR_DIR = os.path.join(ROOT_DIR, "A_Stock_Indicators")  # 技术指标及其递推状态
+QUARANTINE_FILE = os.path.join(ROOT_DIR, "quarantine.json")  # 数据校验未通过的股票
+WORK_QUEUE_FILE = os.path.join(ROOT_DIR, "work_queue.db")  # 多进程协作的任务队列
+DAEMON_STATUS_FILE = os.path.join(ROOT_DIR, "daemon_status.json")  # 常驻模式的状态文件
+FIX_JOURNAL_FILE = os.path.join(ROOT_DIR, "classification_fix.json")  # 分类修复的移动计划（中断后继续执行）
+LISTING_DATES_FILE = os.path.join(ROOT_DIR, "listing_dates.csv")  # 交易所公布的上市日期
+REPLAY_DIR = os.path.join(ROOT_DIR, "replay_store")  # 数据接口调用的录制（离线回放）
+THROUGHPUT_STATS_FILE = os.path.join(ROOT_DIR, "throughput_stats.json")  # 各时段实测的请求吞吐
 
 # 如果D盘无法访问，使用当前目录
 try:
@@ -91,8 +126,22 @@ try:
 except:
     ROOT_DIR = os.path.join(os.getcwd(), "股票归档")
     DATA_DIR = os.path.join(ROOT_DIR, "A_Stock_Data")
+    STORE_DIR = os.path.join(ROOT_DIR, "A_Stock_Store")
     TEMPLATE_FILE = os.path.join(ROOT_DIR, "K线数据模板.xlsx")
     INDEX_FILE = os.path.join(ROOT_DIR, "stock_index.csv")
+    RAW_DIR = os.path.join(ROOT_DIR, "A_Stock_Raw")
+    FACTOR_DIR = os.path.join(ROOT_DIR, "A_Stock_Factor")
+    RESAMPLE_DIR = os.path.join(ROOT_DIR, "A_Stock_Resampled")
+    PANEL_CACHE_DIR = os.path.join(ROOT_DIR, "A_Stock_Cache")
+    XSECTION_DIR = os.path.join(ROOT_DIR, "A_Stock_XSection")
+    INDICATOR_DIR = os.path.join(ROOT_DIR, "A_Stock_Indicators")
+    QUARANTINE_FILE = os.path.join(ROOT_DIR, "quarantine.json")
+    WORK_QUEUE_FILE = os.path.join(ROOT_DIR, "work_queue.db")
+    DAEMON_STATUS_FILE = os.path.join(ROOT_DIR, "daemon_status.json")
+    FIX_JOURNAL_FILE = os.path.join(ROOT_DIR, "classification_fix.json")
+    LISTING_DATES_FILE = os.path.join(ROOT_DIR, "listing_dates.csv")
+    REPLAY_DIR = os.path.join(ROOT_DIR, "replay_store")
+    THROUGHPUT_STATS_FILE = os.path.join(ROOT_DIR, "throughput_stats.json")
 
 # Excel表头 - 符合文档要求的12列格式
 EXCEL_HEADERS = [
@@ -142,6 +191,75 @@ def create_template_file():
         log_message("ERROR", f"创建模板文件失败: {str(e)}")
         return False
 
+# ================== 分片运行 ==================
+
+# 多台机器分担初始化/更新时，每台只处理一个分片. SHARD = (分片序号, 分片总数)，None表示处理全部股票
+SHARD = None
+FULL_INDEX_FILE = INDEX_FILE  # 完整索引（分片运行时INDEX_FILE指向分片索引）
+SHARD_INDEX_PATTERN = re.compile(r'^stock_index\.shard(\d+)of(\d+)\.csv$')
+
+def get_stock_shard(stock_code, shard_count):
+    """股票所属分片：6位代码的CRC32对分片总数取模，只与代码和分片数有关，各机器结果一致"""
+    return zlib.crc32(str(stock_code).zfill(6).encode('ascii')) % shard_count
+
+def in_current_shard(stock_code):
+    """股票是否属于本次运行的分片（未分片时总是True）"""
+    return SHARD is None or get_stock_shard(stock_code, SHARD[1]) == SHARD[0]
+
+def get_shard_index_path(shard_index, shard_count, root_dir=None):
+    """分片索引文件路径"""
+    return os.path.join(root_dir or ROOT_DIR, f"stock_index.shard{shard_index}of{shard_count}.csv")
+
+def parse_shard_option(argv):
+    """
+    从命令行参数中取出 --shard i/N（或 --shard=i/N），并从argv中移除.
+    返回 (i, N)，未指定时返回None；格式错误时抛出ValueError.
+    """
+    for pos, arg in enumerate(argv):
+        if arg == '--shard' and pos + 1 < len(argv):
+            value = argv[pos + 1]
+            del argv[pos:pos + 2]
+        elif arg.startswith('--shard='):
+            value = arg.split('=', 1)[1]
+            del argv[pos]
+        else:
+            continue
+        match = re.match(r'^(\d+)/(\d+)$', value.strip())
+        if not match or not 0 <= int(match.group(1)) < int(match.group(2)):
+            raise ValueError(f"分片参数格式应为 i/N 且 0 <= i < N: {value}")
+        return int(match.group(1)), int(match.group(2))
+    return None
+
+def configure_shard(shard_index, shard_count):
+    """启用分片：只处理属于该分片的股票，索引写入分片专用文件"""
+    global SHARD, INDEX_FILE
+    SHARD = (shard_index, shard_count)
+    INDEX_FILE = get_shard_index_path(shard_index, shard_count)
+    log_message("INFO", f"分片运行: 第 {shard_index} 片 / 共 {shard_count} 片，索引文件: {INDEX_FILE}")
+
+def filter_stock_list_by_shard(stock_list):
+    """股票列表只保留本分片的股票"""
+    if SHARD is None:
+        return stock_list
+    mask = stock_list['股票代码'].astype(str).map(in_current_shard)
+    log_message("INFO", f"分片 {SHARD[0]}/{SHARD[1]}: 全部 {len(stock_list)} 只股票中本分片 {int(mask.sum())} 只")
+    return stock_list[mask].reset_index(drop=True)
+
+def load_index_for_run():
+    """
+    读取本次运行的索引. 分片运行时只保留本分片的股票；
+    分片索引还不存在时（如合并后把完整归档分发到各机器做日常更新），从完整索引中拆出本分片.
+    """
+    index = load_existing_index(INDEX_FILE)
+    if SHARD is None:
+        return index
+    if not index and os.path.exists(FULL_INDEX_FILE):
+        index = {code: info for code, info in load_existing_index(FULL_INDEX_FILE).items() if in_current_shard(code)}
+        if index:
+            save_index_file(list(index.values()), INDEX_FILE)
+            log_message("INFO", f"已从完整索引拆出本分片 {len(index)} 只股票: {INDEX_FILE}")
+    return {code: info for code, info in index.items() if in_current_shard(code)}
+
 def get_all_stock_list():
     """获取所有A股股票列表"""
     if not AKSHARE_AVAILABLE:
@@ -150,7 +268,7 @@ def get_all_stock_list():
         
     try:
         log_message("INFO", "正在获取A股股票列表...")
-        stock_info = ak.stock_info_a_code_name()
+        stock_info = call_akshare('stock_info_a_code_name')
         
         if stock_info is None or stock_info.empty:
             log_message("ERROR", "获取股票列表失败")
@@ -162,7 +280,7 @@ def get_all_stock_list():
         })
         
         log_message("INFO", f"成功获取 {len(stock_info)} 只股票")
-        return stock_info
+        return filter_stock_list_by_shard(stock_info)
         
     except Exception as e:
         log_message("ERROR", f"获取股票列表失败: {str(e)}")
@@ -313,8 +431,8 @@ class AntiBlockManager:
                 return cache_data['data']
         return None
     
-    def cache_data(self, stock_code, start_date, end_date, data):
-        """缓存数据"""
+    def store_cached_data(self, stock_code, start_date, end_date, data):
+        """缓存数据（方法名不能与 self.cache_data 字典同名，否则实例属性会覆盖方法）"""
         cache_key = self.get_cache_key(stock_code, start_date, end_date)
         self.cache_data[cache_key] = {
             'data': data,
@@ -322,19 +440,27 @@ class AntiBlockManager:
         }
         self.save_cache()
     
-    def is_peak_hour(self):
-        """检查是否是高峰时段"""
-        current_hour = datetime.now().hour
+    def is_peak_hour(self, now=None):
+        """检查是否是高峰时段（now为None时取当前时间）"""
+        current_hour = (now or datetime.now()).hour
         for start_hour, end_hour in CURRENT_CONFIG['peak_hours']:
             if start_hour <= current_hour <= end_hour:
                 return True
         return False
     
-    def is_night_time(self):
+    def is_night_time(self, now=None):
         """检查是否是深夜时段（22:00-06:00）"""
-        current_hour = datetime.now().hour
+        current_hour = (now or datetime.now()).hour
         return current_hour >= 22 or current_hour <= 6
     
+    def get_time_window(self, now=None):
+        """所属时段: night 深夜 / peak 高峰 / offpeak 其他"""
+        if self.is_night_time(now):
+            return 'night'
+        if self.is_peak_hour(now):
+            return 'peak'
+        return 'offpeak'
+    
     def get_random_headers(self):
         """获取随机请求头"""
         ua = CURRENT_CONFIG['user_agents'][self.current_ua_index]
@@ -435,23 +561,99 @@ class AntiBlockManager:
 # 创建全局反制管理器
 anti_block_manager = AntiBlockManager()
 
-def safe_request_with_retry(func, *args, max_retries=None, base_delay=None, **kwargs):
+# 多进程协作模式下的共享速率限制（work_queue.SharedRateLimiter），单进程运行时为None
+SHARED_RATE_LIMITER = None
+
+# ================== 时段调度 ==================
+
+# 按时段控制请求吞吐（window_scheduler）. 时段由 AntiBlockManager.get_time_window 划分（深夜 22:00-06:59，
+# 高峰为 peak_hours 配置）. rate 为该时段合计的请求速率上限（次/秒），backfill 为是否允许大批量补数（初始化）.
+# enabled=False 时不限速、不推迟，只统计各时段实测吞吐并估算完成时间；命令行 --off-peak 启用.
+SCHEDULE_CONFIG = {
+    'enabled': False,
+    'windows': {
+        'night': {'rate': 1.5, 'backfill': True},
+        'offpeak': {'rate': 0.8, 'backfill': False},
+        'peak': {'rate': 0.3, 'backfill': False},
+    },
+    # 估算完成时间时每只股票的请求数（复权因子、日线，初始化还有上市日期）
+    'requests_per_stock': {'backfill': 3, 'urgent': 2},
+}
+
+THROUGHPUT_SCHEDULER = window_scheduler.WindowScheduler(
+    anti_block_manager.get_time_window, SCHEDULE_CONFIG['windows'], THROUGHPUT_STATS_FILE,
+    enabled=SCHEDULE_CONFIG['enabled'])
+
+def log_completion_projection(kind, stock_count):
+    """按各时段实测吞吐估算任务的完成时间"""
+    requests_needed = stock_count * SCHEDULE_CONFIG['requests_per_stock'][kind]
+    now = datetime.now()
+    finish = THROUGHPUT_SCHEDULER.project_completion(requests_needed, kind, now)
+    label = '补数' if kind == 'backfill' else '更新'
+    if finish is None:
+        log_message("INFO", f"{label}任务 {stock_count} 只股票（约 {requests_needed} 次请求）预计 "
+                            f"{window_scheduler.MAX_PROJECTION_DAYS} 天内无法完成")
+    else:
+        log_message("INFO", f"{label}任务 {stock_count} 只股票（约 {requests_needed} 次请求）预计完成时间: "
+                            f"{finish.strftime('%Y-%m-%d %H:%M')}（约 {(finish - now).total_seconds() / 3600:.1f} 小时）")
+    for line in THROUGHPUT_SCHEDULER.summary_lines():
+        log_message("INFO", f"  {line}")
+    return finish
+
+def begin_scheduled_job(kind, stock_count):
+    """
+    开始一个任务: kind 为 backfill（大批量补数，只在允许的时段进行）或 urgent（日常更新）.
+    记录任务类型供请求调度使用，并输出预计完成时间.
+    """
+    THROUGHPUT_SCHEDULER.kind = kind
+    log_completion_projection(kind, stock_count)
+    now = datetime.now()
+    if THROUGHPUT_SCHEDULER.enabled and not THROUGHPUT_SCHEDULER.allowed(anti_block_manager.get_time_window(now), kind):
+        start = THROUGHPUT_SCHEDULER.next_allowed_time(now, kind)
+        log_message("INFO", f"当前时段不进行补数，请求将推迟到 {start.strftime('%Y-%m-%d %H:%M')} 开始")
+
+def end_scheduled_job():
+    """任务结束: 保存各时段实测吞吐"""
+    try:
+        THROUGHPUT_SCHEDULER.save_stats()
+    except OSError as e:
+        log_message("WARNING", f"保存吞吐统计失败: {e}")
+    if THROUGHPUT_SCHEDULER.deferred_seconds:
+        log_message("INFO", f"补数请求因时段推迟 {THROUGHPUT_SCHEDULER.deferred_seconds / 3600:.1f} 小时")
+    THROUGHPUT_SCHEDULER.kind = 'urgent'
+
+def estimate_mode(kind='update'):
+    """估算初始化（init）或更新（update）的完成时间，不联网"""
+    if kind == 'init':
+        stock_count = listing_registry.size() or len(load_existing_index(FULL_INDEX_FILE))
+        log_completion_projection('backfill', stock_count)
+    else:
+        log_completion_projection('urgent', len(load_index_for_run()))
+
+def safe_request_with_retry(func, *args, max_retries=None, base_delay=None, pace=True, **kwargs):
     """
     安全的API请求函数，带反制机制
+    pace=False 时不经过全局的请求间隔控制（由调用方自行限速，如多数据源各自的令牌桶）
     """
     if max_retries is None:
         max_retries = CURRENT_CONFIG['max_retries']
     
     for attempt in range(max_retries):
         try:
-            # 请求前检查
-            anti_block_manager.pre_request_check()
+            # 请求前检查：时段吞吐预算（补数任务在不允许的时段等待），再按全局请求间隔控制
+            THROUGHPUT_SCHEDULER.acquire()
+            if pace:
+                anti_block_manager.pre_request_check()
+            # 多进程协作时，所有进程合计的请求速率受共享令牌桶限制
+            if SHARED_RATE_LIMITER is not None:
+                SHARED_RATE_LIMITER.acquire()
             
             # 设置随机请求头（如果akshare支持）
             headers = anti_block_manager.get_random_headers()
             
             # 执行请求
             result = func(*args, **kwargs)
+            THROUGHPUT_SCHEDULER.record_done()
             
             # 请求成功，重置失败计数
             if hasattr(anti_block_manager, 'consecutive_failures'):
@@ -531,30 +733,372 @@ def safe_request_with_retry(func, *args, max_retries=None, base_delay=None, **kw
                 
     return None
 
+# ================== HTTP连接复用 ==================
+
+class SessionPool:
+    """
+    akshare内部直接调用 requests.get/post，没有传入会话的接口.
+    install() 把这两个函数替换为分派函数：只有在 scope() 范围内（经 call_akshare 发出的数据接口请求）
+    才使用池中的 Session 复用连接，其他调用方仍使用原来的 requests.get/post，不共享cookie和请求头.
+    requests.Session 不保证线程安全，每个 Session 同一时刻只借给一个线程，用完归还，连接在多次请求和多次更新之间复用.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.local = threading.local()
+        self.original = None
+
+    def install(self):
+        with self.lock:
+            if self.original is not None:
+                return
+            self.original = {'get': requests.get, 'post': requests.post}
+        requests.get = self._dispatcher('get')
+        requests.post = self._dispatcher('post')
+
+    def _dispatcher(self, method):
+        original = self.original[method]
+
+        def request(*args, **kwargs):
+            session = getattr(self.local, 'session', None)
+            if session is None:
+                return original(*args, **kwargs)
+            return getattr(session, method)(*args, **kwargs)
+        return request
+
+    @contextmanager
+    def scope(self):
+        """范围内当前线程的 requests.get/post 使用借出的 Session（未安装或已在范围内时不做处理）"""
+        if self.original is None or getattr(self.local, 'session', None) is not None:
+            yield
+            return
+        with self.lock:
+            session = self.idle.pop() if self.idle else requests.Session()
+        self.local.session = session
+        try:
+            yield
+        finally:
+            self.local.session = None
+            with self.lock:
+                self.idle.append(session)
+
+# 常驻模式启动时安装（daemon_mode），其他模式不替换 requests.get/post
+HTTP_SESSION_POOL = SessionPool()
+
+# ================== 录制/回放 ==================
+
+# 数据接口调用的录制/回放（replay.RecordReplaySource），用于离线、可重复的性能实验:
+#   --record 正常联网运行并录制每次调用的结果和耗时；--replay 不联网，按录制的耗时回放
+#   --replay-speed N 回放倍速（0 表示不等待）；--replay-faults disconnect:0.02,timeout:0.01 按概率注入故障
+REPLAY_CONFIG = {
+    'mode': 'off',
+    'store_dir': REPLAY_DIR,
+    'speed': 1.0,
+    'faults': '',
+    'seed': 0,
+}
+
+# 当前数据源，未启用录制/回放时为None
+DATA_SOURCE = None
+
+def call_akshare(api_name, **params):
+    """调用akshare接口. 所有数据接口调用都经过这里，启用录制/回放时交给 DATA_SOURCE 处理"""
+    with HTTP_SESSION_POOL.scope():
+        if DATA_SOURCE is None:
+            return getattr(ak, api_name)(**params)
+        return DATA_SOURCE.call(api_name, lambda **kwargs: getattr(ak, api_name)(**kwargs), **params)
+
+def parse_replay_options(argv):
+    """
+    从命令行参数中取出录制/回放选项（--record、--replay、--replay-speed、--replay-faults、
+    --replay-seed、--replay-dir，值可用空格或=分隔），并从argv中移除. 返回是否指定了选项.
+    """
+    value_options = {'--replay-speed': 'speed', '--replay-faults': 'faults',
+                     '--replay-seed': 'seed', '--replay-dir': 'store_dir'}
+    found = False
+    pos = 1
+    while pos < len(argv):
+        arg = argv[pos]
+        name, has_value, value = arg.partition('=')
+        if arg in ('--record', '--replay'):
+            REPLAY_CONFIG['mode'] = arg[2:]
+            del argv[pos]
+        elif name in value_options and (has_value or pos + 1 < len(argv)):
+            if not has_value:
+                value = argv[pos + 1]
+                del argv[pos + 1]
+            del argv[pos]
+            REPLAY_CONFIG[value_options[name]] = value
+        else:
+            pos += 1
+            continue
+        found = True
+    return found
+
+def configure_replay():
+    """按 REPLAY_CONFIG 启用录制/回放. 回放不需要联网，akshare未安装时也可运行"""
+    global DATA_SOURCE, AKSHARE_AVAILABLE
+    if REPLAY_CONFIG['mode'] == 'off':
+        return
+    DATA_SOURCE = replay.RecordReplaySource(
+        REPLAY_CONFIG['store_dir'], mode=REPLAY_CONFIG['mode'], speed=float(REPLAY_CONFIG['speed']),
+        faults=replay.parse_faults(REPLAY_CONFIG['faults']), seed=int(REPLAY_CONFIG['seed']))
+    if REPLAY_CONFIG['mode'] == 'replay':
+        AKSHARE_AVAILABLE = True
+        log_message("INFO", f"回放模式: {REPLAY_CONFIG['store_dir']}，倍速 {DATA_SOURCE.speed:g}，"
+                            f"注入故障 {DATA_SOURCE.faults or '无'}")
+    else:
+        log_message("INFO", f"录制模式: 数据接口调用保存到 {REPLAY_CONFIG['store_dir']}")
+
+# ================== 多数据源 ==================
+
+# 日线数据源（data_providers）. enabled=False 时只用东方财富 stock_zh_a_hist（原有方式）；
+# 启用后（或命令行 --multi-provider）日线请求按权重分摊到各数据源，各自限速（rate 次/秒，允许 burst 次突发），
+# 出错时自动切换. 日线请求的节奏由各数据源的令牌桶控制，不再经过全局的请求间隔控制.
+# 腾讯接口没有成交额和换手率，权重为0：只在其他数据源都不可用时使用，其数据入库校验不通过（金额缺失），股票隔离后重新获取.
+# 新浪复权因子请求（fetch_adjust_factors）也占用新浪数据源的令牌.
+PROVIDER_CONFIG = {
+    'enabled': False,
+    'providers': {
+        'eastmoney': {'weight': 2, 'rate': 0.8, 'burst': 2},
+        'sina': {'weight': 1, 'rate': 0.5, 'burst': 2},
+        'tencent': {'weight': 0, 'rate': 0.5, 'burst': 1},
+    },
+}
+
+PROVIDER_POOL = None
+_provider_pool_lock = threading.Lock()
+
+def get_provider_pool():
+    """多数据源组（首次使用时按 PROVIDER_CONFIG 建立，接口调用经过录制/回放层）"""
+    global PROVIDER_POOL
+    with _provider_pool_lock:
+        if PROVIDER_POOL is None:
+            PROVIDER_POOL = data_providers.build_pool(call_akshare, PROVIDER_CONFIG['providers'])
+        return PROVIDER_POOL
+
+# 对冲请求（data_providers.Hedger）: 日线请求超过近期耗时的 percentile 分位数（至少 min_delay 秒）仍未返回时，
+# 再发一个相同请求（多数据源时换一个数据源），取先返回的结果. 对冲请求数不超过 max_ratio，
+# 且与普通请求共用速率预算. 命令行 --hedge 启用
+HEDGE_CONFIG = {
+    'enabled': False,
+    'percentile': 95,
+    'min_samples': 20,
+    'min_delay': 0.5,
+    'max_ratio': 0.1,
+}
+
+HEDGER = None
+_hedger_lock = threading.Lock()
+
+def get_hedger():
+    global HEDGER
+    with _hedger_lock:
+        if HEDGER is None:
+            HEDGER = data_providers.Hedger(percentile=HEDGE_CONFIG['percentile'], min_samples=HEDGE_CONFIG['min_samples'],
+                                           min_delay=HEDGE_CONFIG['min_delay'], max_ratio=HEDGE_CONFIG['max_ratio'])
+        return HEDGER
+
+def acquire_hedge_budget():
+    """对冲请求发出前取速率预算：时段吞吐预算；单数据源时经过全局请求间隔控制，多数据源时由数据源的令牌桶限速"""
+    THROUGHPUT_SCHEDULER.acquire()
+    if not PROVIDER_CONFIG['enabled']:
+        anti_block_manager.pre_request_check()
+    if SHARED_RATE_LIMITER is not None:
+        SHARED_RATE_LIMITER.acquire()
+
+def fetch_history_once(symbol, start_date, end_date, adjust, used=None, avoid=()):
+    """发出一次日线请求，启用多数据源时由数据源组分摊和切换"""
+    if not PROVIDER_CONFIG['enabled']:
+        return call_akshare('stock_zh_a_hist', symbol=symbol, period="daily",
+                            start_date=start_date, end_date=end_date, adjust=adjust)
+    return get_provider_pool().fetch(symbol, start_date, end_date, adjust, used=used, avoid=avoid)
+
+def fetch_history(symbol, start_date, end_date, adjust):
+    """获取日线（东方财富列格式），启用对冲时慢请求会由对冲请求兜底"""
+    if not HEDGE_CONFIG['enabled']:
+        return fetch_history_once(symbol, start_date, end_date, adjust)
+    used = []
+    return get_hedger().run(
+        lambda: fetch_history_once(symbol, start_date, end_date, adjust, used=used),
+        lambda: fetch_history_once(symbol, start_date, end_date, adjust, avoid=tuple(used)),
+        before_hedge=acquire_hedge_budget)
+
+# 相同日线请求的合并和本次运行内的缓存（如确定上市日期的完整历史请求与随后的历史数据请求，复权方式由 full_history_adjust 统一选择）.
+# 完成的结果只保留到被相同请求取走一次，缓存按估算内存不超过 max_memo_mb，常驻模式每次更新前清空
+COALESCE_CONFIG = {
+    'enabled': True,
+    'max_memo_mb': 16,
+}
+
+REQUEST_COALESCER = data_providers.RequestCoalescer(COALESCE_CONFIG['max_memo_mb'] * 1024 * 1024)
+
+def request_history(symbol, start_date, end_date, adjust, **retry_options):
+    """
+    带重试的日线请求（多数据源时请求间隔由各数据源的限速控制）.
+    相同的 (代码, 起始日, 结束日, 复权方式) 请求只发出一次：进行中的请求被共用，完成的结果在本次运行内缓存
+    """
+    def _request():
+        return safe_request_with_retry(fetch_history, symbol, start_date, end_date, adjust,
+                                       pace=not PROVIDER_CONFIG['enabled'], **retry_options)
+
+    if not COALESCE_CONFIG['enabled']:
+        return _request()
+    key = (str(symbol).zfill(6), str(start_date).replace('-', ''), str(end_date).replace('-', ''), adjust)
+    return REQUEST_COALESCER.get(key, _request)
+
+# ================== 上市日期登记表 ==================
+
+LISTING_DATE_COLUMNS = ['股票代码', '股票名称', '上市日期', '交易所']
+
+def fetch_listing_tables():
+    """
+    从三个交易所的股票列表批量获取上市日期（共4次请求），返回 LISTING_DATE_COLUMNS 格式的表.
+    某个交易所获取失败时跳过，其余照常返回.
+    """
+    # (交易所, 接口, 参数, 代码列, 名称列, 上市日期列)
+    sources = [
+        ('上交所', 'stock_info_sh_name_code', {'symbol': '主板A股'}, '证券代码', '证券简称', '上市日期'),
+        ('上交所', 'stock_info_sh_name_code', {'symbol': '科创板'}, '证券代码', '证券简称', '上市日期'),
+        ('深交所', 'stock_info_sz_name_code', {'symbol': 'A股列表'}, 'A股代码', 'A股简称', 'A股上市日期'),
+        ('北交所', 'stock_info_bj_name_code', {}, '证券代码', '证券简称', '上市日期'),
+    ]
+    frames = []
+    for exchange, func_name, kwargs, code_col, name_col, date_col in sources:
+        try:
+            table = safe_request_with_retry(call_akshare, func_name, max_retries=3, base_delay=1.0, **kwargs)
+        except Exception as e:
+            log_message("WARNING", f"获取{exchange}上市日期列表失败: {str(e)}")
+            continue
+        if table is None or table.empty or code_col not in table.columns or date_col not in table.columns:
+            log_message("WARNING", f"{exchange}上市日期列表为空或格式不符: {func_name} {kwargs}")
+            continue
+        frames.append(pd.DataFrame({
+            '股票代码': table[code_col].astype(str).str.strip().str.zfill(6),
+            '股票名称': table[name_col].astype(str).str.strip() if name_col in table.columns else '',
+            '上市日期': pd.to_datetime(table[date_col].astype(str), errors='coerce').dt.strftime('%Y-%m-%d'),
+            '交易所': exchange,
+        }))
+    if not frames:
+        return pd.DataFrame(columns=LISTING_DATE_COLUMNS)
+    listing = pd.concat(frames, ignore_index=True).dropna(subset=['上市日期'])
+    return listing.drop_duplicates('股票代码', keep='last')[LISTING_DATE_COLUMNS]
+
+class ListingDateRegistry:
+    """
+    上市日期登记表：由交易所股票列表批量建立，保存在本地CSV.
+    查不到的代码（新股）触发一次刷新，每天最多刷新一次；刷新只追加和更新记录，已退市股票的记录保留.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.dates = None
+        self.refreshed_on = None
+        self.lookups = 0
+        self.misses = 0
+
+    def _load(self):
+        """读取本地登记表（只在首次查询时读取）"""
+        self.dates = {}
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            table = pd.read_csv(self.file_path, dtype=str, encoding='utf-8-sig').fillna('')
+        except Exception as e:
+            log_message("WARNING", f"读取上市日期登记表失败: {str(e)}")
+            return
+        self.dates = dict(zip(table['股票代码'].str.zfill(6), table['上市日期']))
+        # 文件修改日期即最后一次刷新的日期
+        self.refreshed_on = date.fromtimestamp(os.path.getmtime(self.file_path))
+
+    def size(self):
+        """已登记的股票数"""
+        with self.lock:
+            if self.dates is None:
+                self._load()
+            return len(self.dates)
+
+    def _save(self, table):
+        write_file_atomic(self.file_path, lambda tmp_path: table.to_csv(tmp_path, index=False, encoding='utf-8-sig'))
+
+    def refresh(self, force=False):
+        """从交易所列表刷新登记表，当天已刷新过时跳过（force=True 除外）. 返回新增的股票数"""
+        with self.lock:
+            if self.dates is None:
+                self._load()
+            if not AKSHARE_AVAILABLE or (not force and self.refreshed_on == date.today()):
+                return 0
+            self.refreshed_on = date.today()
+            fetched = fetch_listing_tables()
+            if fetched.empty:
+                log_message("WARNING", "未获取到任何交易所的上市日期列表，登记表保持不变")
+                return 0
+            table = fetched
+            if os.path.exists(self.file_path):
+                try:
+                    existing = pd.read_csv(self.file_path, dtype=str, encoding='utf-8-sig').fillna('')
+                    existing['股票代码'] = existing['股票代码'].str.zfill(6)
+                    table = pd.concat([existing, fetched], ignore_index=True).drop_duplicates('股票代码', keep='last')
+                except Exception as e:
+                    log_message("WARNING", f"读取上市日期登记表失败，只保存本次获取的列表: {e}")
+            added = len(set(fetched['股票代码']) - set(self.dates))
+            table = table.sort_values('股票代码', kind='mergesort')[LISTING_DATE_COLUMNS]
+            try:
+                self._save(table)
+            except Exception as e:
+                # 保存失败不影响本次查询，下次刷新时再保存
+                log_message("WARNING", f"保存上市日期登记表失败: {e}")
+            self.dates = dict(zip(table['股票代码'], table['上市日期']))
+            log_message("INFO", f"上市日期登记表已刷新: 共 {len(self.dates)} 只股票，新增 {added} 只")
+            return added
+
+    def get(self, stock_code, refresh=True):
+        """查询上市日期（YYYY-MM-DD），本地没有时刷新一次再查（refresh=False 时只查本地），仍没有时返回None"""
+        stock_code = str(stock_code).zfill(6)
+        with self.lock:
+            if self.dates is None:
+                self._load()
+            self.lookups += 1
+            listing_date = self.dates.get(stock_code)
+        if not listing_date and refresh:
+            self.refresh()
+            with self.lock:
+                listing_date = self.dates.get(stock_code)
+                if not listing_date:
+                    self.misses += 1
+        return listing_date or None
+
+    def log_summary(self):
+        with self.lock:
+            if self.lookups:
+                log_message("INFO", f"上市日期登记表 - 查询: {self.lookups}, 未登记（改用历史数据）: {self.misses}")
+
+listing_registry = ListingDateRegistry(LISTING_DATES_FILE)
+
 def get_stock_listing_date(stock_code):
-    """获取股票上市日期（智能查找，支持所有年代）"""
+    """获取股票上市日期：优先查上市日期登记表，登记表中没有时才下载完整历史确定"""
+    listing_date = listing_registry.get(stock_code)
+    if listing_date:
+        return listing_date
+    return probe_listing_date_from_history(stock_code)
+
+def probe_listing_date_from_history(stock_code):
+    """由完整历史数据的第一个交易日确定上市日期（智能查找，支持所有年代）"""
     if not AKSHARE_AVAILABLE:
         log_message("WARNING", "akshare不可用，使用默认上市日期")
         return "2000-01-01"
     
-    def _get_hist_data(symbol, start_date, end_date):
-        """内部函数：获取历史数据"""
-        return ak.stock_zh_a_hist(symbol=symbol, period="daily", 
-                                start_date=start_date, end_date=end_date, 
-                                adjust="qfq")
-    
     try:
         # 智能查找策略：从最早可能的日期开始获取所有历史数据
         current_date = datetime.now().strftime("%Y%m%d")
         
         log_message("INFO", f"正在获取股票 {stock_code} 的完整历史数据以确定上市日期...")
         
-        # 获取从1990年至今的所有数据（akshare会自动从实际上市日期开始返回）
-        hist_data = safe_request_with_retry(
-            _get_hist_data, 
-            stock_code, "19900101", current_date,
-            max_retries=3, base_delay=1.0
-        )
+        # 获取从1990年至今的所有数据（akshare会自动从实际上市日期开始返回）.
+        # 复权方式与随后的历史数据请求相同（第一个交易日与复权方式无关），两次请求合并为一次
+        _, adjust = full_history_adjust(stock_code)
+        hist_data = request_history(stock_code, "19900101", current_date, adjust, max_retries=3, base_delay=1.0)
         
         if hist_data is not None and not hist_data.empty:
             first_date = hist_data['日期'].iloc[0]
@@ -606,9 +1150,9 @@ def calculate_years_since_listing(listing_date):
             # 已经是date对象
             listing_date_obj = listing_date
 
-            # 简化计算年限：只考虑自然年
-            current_date = date.today()
-            years = current_date.year - listing_date_obj.year
+        # 简化计算年限：只考虑自然年
+        current_date = date.today()
+        years = current_date.year - listing_date_obj.year
         
         # 不再考虑月份和日期，直接返回年份差
         return max(0, years)
@@ -617,8 +1161,350 @@ def calculate_years_since_listing(listing_date):
         log_message("WARNING", f"计算上市年限失败: {str(e)}")
         return 0
 
-def get_stock_history_data(stock_code, start_date=None, end_date=None):
-    """获取股票历史数据（带反制机制）"""
+# ================== 不复权数据与复权因子 ==================
+
+# 历史数据接口列名 -> 归档列名
+HIST_COLUMN_MAPPING = {
+    '日期': '时间',
+    '开盘': '开盘价',
+    '最高': '最高价',
+    '最低': '最低价',
+    '收盘': '收盘价',
+    '成交量': '总手数',
+    '成交额': '金额',
+    '涨跌幅': '涨幅',
+    '涨跌额': '涨跌额',
+    '换手率': '换手率',
+    '振幅': '振幅'
+}
+
+NUMERIC_COLUMNS = ['开盘价', '最高价', '最低价', '收盘价', '涨幅', '振幅', '总手数', '金额', '换手率']
+
+# 复权只影响价格列，涨幅/振幅/成交量/金额/换手率与复权方式无关
+PRICE_COLUMNS = ['开盘价', '最高价', '最低价', '收盘价']
+
+# 不复权数据存储的列
+RAW_COLUMNS = ['时间'] + NUMERIC_COLUMNS
+
+# 复权视图缓存（键包含文件修改时间，数据更新后自动失效）
+ADJUSTED_VIEW_CACHE_SIZE = 256
+_adjusted_view_cache = OrderedDict()
+_adjusted_view_cache_lock = threading.Lock()
+
+def get_exchange_symbol(stock_code):
+    """转换为带交易所前缀的代码（新浪接口使用）"""
+    return data_providers.exchange_symbol(stock_code)
+
+def get_raw_bars_path(stock_code):
+    """不复权日线存储路径"""
+    return os.path.join(RAW_DIR, f"{str(stock_code).zfill(6)}.pkl")
+
+def get_factor_path(stock_code):
+    """复权因子表存储路径"""
+    return os.path.join(FACTOR_DIR, f"{str(stock_code).zfill(6)}.pkl")
+
+# 存储时压缩数据类型：以下列的数值最多两位小数，可无损存为float32（读取时按小数位还原为float64）
+STORAGE_DECIMALS = {
+    '开盘价': 2, '最高价': 2, '最低价': 2, '收盘价': 2,
+    '涨幅': 2, '振幅': 2, '涨跌额': 2, '换手率': 2
+}
+
+def downcast_frame(df, decimals=None):
+    """
+    存储前压缩数据类型，只在无损时转换：
+    有小数位约定的列转float32（还原后逐值相等才转换），整数列转int32，重复值多的文本列转category.
+    """
+    decimals = STORAGE_DECIMALS if decimals is None else decimals
+    columns = {}
+    stored_decimals = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_float_dtype(values) and col in decimals:
+            narrow = values.astype(np.float32)
+            restored = narrow.astype(np.float64).round(decimals[col])
+            if np.array_equal(restored.to_numpy(), values.to_numpy(), equal_nan=True):
+                values = narrow
+                stored_decimals[col] = decimals[col]
+        elif pd.api.types.is_integer_dtype(values) and values.dtype.itemsize > 4:
+            if values.empty or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+                values = values.astype(np.int32)
+        elif values.dtype == object and len(values) > 0 and values.nunique() <= len(values) // 2:
+            values = values.astype('category')
+        columns[col] = values
+    out = pd.DataFrame(columns, index=df.index)
+    out.attrs['storage_decimals'] = stored_decimals
+    return out
+
+def restore_frame(df):
+    """读取后还原downcast_frame压缩的类型，保证计算结果与未压缩时完全一致"""
+    if df is None:
+        return None
+    stored_decimals = df.attrs.get('storage_decimals')
+    if stored_decimals is None:
+        return df
+    for col in df.columns:
+        values = df[col]
+        if col in stored_decimals:
+            df[col] = values.astype(np.float64).round(stored_decimals[col])
+        elif pd.api.types.is_integer_dtype(values) and values.dtype.itemsize < 8:
+            df[col] = values.astype(np.int64)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            df[col] = values.astype(object)
+    df.attrs.pop('storage_decimals', None)
+    return df
+
+def write_file_atomic(file_path, write):
+    """
+    先写临时文件再替换，避免中断时留下残缺文件. write(临时文件路径) 负责写出内容.
+    临时文件名带进程号和线程号，多个工作进程同时写同一文件时不会互相覆盖临时文件（后替换的生效）；
+    写出或替换失败时删除临时文件并抛出异常.
+    """
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_json_atomic(data, file_path, indent=2):
+    """原子写出JSON文件"""
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+    write_file_atomic(file_path, write)
+
+def write_pickle_atomic(df, file_path):
+    """原子写出pickle文件"""
+    write_file_atomic(file_path, df.to_pickle)
+
+def read_pickle_safe(file_path):
+    """读取pickle文件，不存在或损坏时返回None"""
+    if not os.path.exists(file_path):
+        return None
+    try:
+        return pd.read_pickle(file_path)
+    except Exception as e:
+        log_message("WARNING", f"读取 {file_path} 失败: {e}")
+        return None
+
+def normalize_hist_columns(hist_data):
+    """历史数据接口返回结果的列名映射和数值类型转换（原地修改，不复制数据）"""
+    # 一次完成全部列名映射（不存在的列自动忽略）
+    hist_data.rename(columns=HIST_COLUMN_MAPPING, inplace=True)
+
+    for col in NUMERIC_COLUMNS:
+        if col in hist_data.columns and not pd.api.types.is_numeric_dtype(hist_data[col]):
+            hist_data[col] = pd.to_numeric(hist_data[col], errors='coerce')
+    return hist_data
+
+def finalize_export_frame(stock_code, hist_data):
+    """补充成交次数、名称，并整理为归档的12列格式"""
+    # 计算成交次数（使用增强版多因子模型）
+    hist_data['成交次数'] = calculate_trade_count_enhanced(hist_data)
+
+    # 添加股票名称列
+    hist_data['名称'] = get_stock_name(stock_code)
+
+    # 确保所有必需的列存在
+    for col in EXCEL_HEADERS:
+        if col not in hist_data.columns:
+            hist_data[col] = 0 if col not in ['时间', '名称'] else ''
+
+    # Excel中时间列按日期写入
+    if pd.api.types.is_datetime64_any_dtype(hist_data['时间']):
+        hist_data['时间'] = hist_data['时间'].dt.date
+
+    # 按要求的顺序排列列
+    return hist_data[EXCEL_HEADERS]
+
+def load_raw_bars(stock_code):
+    """读取本地不复权日线（还原存储时压缩的数据类型）"""
+    return restore_frame(read_pickle_safe(get_raw_bars_path(stock_code)))
+
+def merge_raw_bars(existing, new_bars):
+    """把新日线合并到已有不复权数据之后（只取晚于已有最后日期的数据），返回 (合并结果, 是否有新增)"""
+    new_bars = new_bars[RAW_COLUMNS].copy()
+    new_bars['时间'] = pd.to_datetime(new_bars['时间'])
+    new_bars = new_bars.sort_values('时间').drop_duplicates('时间', keep='last')
+    if existing is not None and not existing.empty:
+        new_bars = new_bars[new_bars['时间'] > existing['时间'].iloc[-1]]
+        if new_bars.empty:
+            return existing, False
+        return pd.concat([existing, new_bars], ignore_index=True), True
+    return new_bars.reset_index(drop=True), True
+
+def save_raw_bars(stock_code, new_bars, replace=False):
+    """
+    追加不复权日线（只追加晚于已有最后日期的数据），返回合并后的全部数据.
+    replace=True 时用new_bars整体替换（用于隔离股票的完整重新获取）.
+    """
+    existing = None if replace else load_raw_bars(stock_code)
+    merged, changed = merge_raw_bars(existing, new_bars)
+    if changed:
+        write_pickle_atomic(downcast_frame(merged), get_raw_bars_path(stock_code))
+    return merged
+
+def load_adjust_factors(stock_code):
+    """读取本地后复权因子表"""
+    return read_pickle_safe(get_factor_path(stock_code))
+
+def fetch_adjust_factors(stock_code):
+    """从新浪接口获取后复权因子表（数据量很小，只有除权日各一行）"""
+    if not AKSHARE_AVAILABLE:
+        return None
+
+    def _get_factor_data(symbol):
+        """内部函数：获取后复权因子（多数据源时与新浪日线共用新浪数据源的限速）"""
+        if PROVIDER_CONFIG['enabled']:
+            get_provider_pool().acquire('sina')
+        return call_akshare('stock_zh_a_daily', symbol=symbol, adjust="hfq-factor")
+
+    def _request():
+        return safe_request_with_retry(_get_factor_data, get_exchange_symbol(stock_code), max_retries=3)
+
+    try:
+        # 确定上市日期的探测与随后的历史数据获取各更新一次因子，由请求合并共用一次网络请求
+        if COALESCE_CONFIG['enabled']:
+            factor_data = REQUEST_COALESCER.get(('hfq-factor', str(stock_code).zfill(6)), _request)
+        else:
+            factor_data = _request()
+        if factor_data is None or factor_data.empty:
+            return None
+        factors = pd.DataFrame({
+            '时间': pd.to_datetime(factor_data['date']),
+            '复权因子': pd.to_numeric(factor_data['hfq_factor'], errors='coerce')
+        }).dropna()
+        return factors.sort_values('时间').drop_duplicates('时间', keep='last').reset_index(drop=True)
+    except Exception as e:
+        log_message("WARNING", f"获取股票 {stock_code} 复权因子失败: {e}")
+        return None
+
+def full_history_adjust(stock_code):
+    """
+    完整历史请求的复权方式：先增量更新复权因子，成功则获取不复权数据（入库、读时计算前复权），
+    因子不可用时退回直接获取前复权数据. 返回 (因子表, 复权方式).
+    确定上市日期的探测请求与随后的历史数据请求都按此选择，两者相同，由 request_history 合并为一次请求.
+    """
+    factors, _ = update_adjust_factors(stock_code)
+    return factors, ("" if factors is not None else "qfq")
+
+def update_adjust_factors(stock_code):
+    """
+    增量更新复权因子表.
+    后复权因子的历史值不会改变，除权时只会新增一行，因此本地表只追加.
+    返回 (因子表, 是否新增了除权记录)，获取失败时因子表为本地已有数据或None.
+    """
+    existing = load_adjust_factors(stock_code)
+    fetched = fetch_adjust_factors(stock_code)
+    if fetched is None:
+        return existing, False
+
+    if existing is not None and not existing.empty:
+        new_rows = fetched[fetched['时间'] > existing['时间'].iloc[-1]]
+        if new_rows.empty:
+            return existing, False
+        merged = pd.concat([existing, new_rows], ignore_index=True)
+    else:
+        merged = fetched
+
+    write_pickle_atomic(merged, get_factor_path(stock_code))
+    return merged, True
+
+def apply_adjustment(raw_bars, factors, adjust="qfq"):
+    """
+    由不复权数据和后复权因子计算复权视图（向量化）.
+    后复权价 = 不复权价 × 当日因子；前复权价 = 不复权价 × 当日因子 / 最新因子.
+    """
+    view = raw_bars.copy()
+    if not adjust or factors is None or factors.empty:
+        return view
+
+    bar_dates = pd.to_datetime(view['时间']).to_numpy(dtype='datetime64[ns]')
+    factor_dates = factors['时间'].to_numpy(dtype='datetime64[ns]')
+    factor_values = factors['复权因子'].to_numpy(dtype=float)
+
+    # 每个交易日取不晚于当日的最近一个因子，早于第一条因子记录时因子为1
+    pos = np.searchsorted(factor_dates, bar_dates, side='right') - 1
+    scale = np.where(pos >= 0, factor_values[np.clip(pos, 0, None)], 1.0)
+    if adjust == "qfq":
+        scale = scale / factor_values[-1]
+
+    for col in PRICE_COLUMNS:
+        view[col] = np.round(view[col].to_numpy(dtype=float) * scale, 2)
+    return view
+
+def load_adjusted_bars(stock_code, adjust="qfq"):
+    """读取本地复权视图（读时计算并缓存），adjust可为 'qfq'、'hfq' 或 ''"""
+    raw_path = get_raw_bars_path(stock_code)
+    factor_path = get_factor_path(stock_code)
+    try:
+        raw_mtime = os.stat(raw_path).st_mtime_ns
+    except OSError:
+        return None
+    factor_mtime = os.stat(factor_path).st_mtime_ns if os.path.exists(factor_path) else 0
+
+    cache_key = (str(stock_code).zfill(6), adjust, raw_mtime, factor_mtime)
+    with _adjusted_view_cache_lock:
+        if cache_key in _adjusted_view_cache:
+            _adjusted_view_cache.move_to_end(cache_key)
+            return _adjusted_view_cache[cache_key]
+
+    raw_bars = load_raw_bars(stock_code)
+    if raw_bars is None:
+        return None
+    view = apply_adjustment(raw_bars, load_adjust_factors(stock_code), adjust)
+
+    with _adjusted_view_cache_lock:
+        _adjusted_view_cache[cache_key] = view
+        while len(_adjusted_view_cache) > ADJUSTED_VIEW_CACHE_SIZE:
+            _adjusted_view_cache.popitem(last=False)
+    return view
+
+def build_export_frame(stock_code, raw_bars, factors):
+    """由不复权数据生成前复权的导出数据（保持Excel归档的前复权口径）"""
+    hist_data = apply_adjustment(raw_bars, factors, "qfq")
+    return finalize_export_frame(stock_code, hist_data)
+
+def fetch_hist_bars(stock_code, start_date, end_date, adjust=""):
+    """获取指定区间的日线，默认不复权（区间内无数据时返回空表；重试后仍请求失败时返回None）"""
+    hist_data = request_history(stock_code, start_date, end_date, adjust)
+    if hist_data is None:
+        return None
+    if hist_data.empty:
+        return pd.DataFrame(columns=RAW_COLUMNS)
+    hist_data = normalize_hist_columns(hist_data)
+    hist_data['时间'] = pd.to_datetime(hist_data['时间'])
+    return hist_data[RAW_COLUMNS]
+
+# 重叠K线比对：价格允许0.01的四舍五入误差，成交量必须一致
+OVERLAP_CHECK_COLUMNS = PRICE_COLUMNS + ['总手数']
+OVERLAP_CHECK_ATOL = np.array([0.011, 0.011, 0.011, 0.011, 0.5])
+OVERLAP_CHECK_RTOL = 1e-4
+
+def overlap_bars_match(stored_bars, fetched_bars):
+    """
+    比对本地前复权视图与新获取的前复权数据在重叠交易日上是否一致（向量化）.
+    除权除息会改变之前所有交易日的前复权价，因此任一重叠K线不一致即说明复权因子已变.
+    """
+    stored = stored_bars[['时间'] + OVERLAP_CHECK_COLUMNS]
+    fetched = fetched_bars[['时间'] + OVERLAP_CHECK_COLUMNS]
+    merged = stored.merge(fetched, on='时间', suffixes=('_本地', '_最新'))
+    if merged.empty:
+        return False
+    local_values = merged[[f"{col}_本地" for col in OVERLAP_CHECK_COLUMNS]].to_numpy(dtype=float)
+    latest_values = merged[[f"{col}_最新" for col in OVERLAP_CHECK_COLUMNS]].to_numpy(dtype=float)
+    return bool(np.isclose(local_values, latest_values, rtol=OVERLAP_CHECK_RTOL, atol=OVERLAP_CHECK_ATOL).all())
+
+def get_stock_history_data(stock_code, start_date=None, end_date=None, replace_raw=False, pending_raw=None):
+    """
+    获取股票历史数据（带反制机制），replace_raw=True 时整体替换本地不复权数据.
+    pending_raw 为列表时不直接入库，待入库的不复权数据放入列表，由调用方在Excel写入成功后入库.
+    """
     if not AKSHARE_AVAILABLE:
         log_message("ERROR", "akshare不可用，无法获取历史数据")
         return None
@@ -632,7 +1518,7 @@ def get_stock_history_data(stock_code, start_date=None, end_date=None):
     if start_date is None:
         start_date = "1990-01-01"  # 使用足够早的日期以获取所有历史数据
     
-    # 标准化日期格式用于缓存检查
+    # 标准化日期格式（相同请求由 request_history 合并，不再单独缓存接口原始数据）
     cache_start_date = start_date
     cache_end_date = end_date
     
@@ -653,144 +1539,149 @@ def get_stock_history_data(stock_code, start_date=None, end_date=None):
     if len(cache_end_date) != 8 or not cache_end_date.isdigit():
         cache_end_date = datetime.now().strftime("%Y%m%d")
     
-    # 检查缓存 - 使用标准化的日期格式
-    cached_data = anti_block_manager.get_cached_data(stock_code, cache_start_date, cache_end_date)
-    if cached_data is not None:
-        log_message("INFO", f"股票 {stock_code} 使用缓存数据")
-        # 从缓存创建DataFrame并进行相同的处理
-        hist_data = pd.DataFrame(cached_data)
-        
-        # 确保数值列的类型正确
-        numeric_columns = ['开盘价', '最高价', '最低价', '收盘价', '涨幅', '振幅', '总手数', '金额', '换手率']
-        for col in numeric_columns:
-            if col in hist_data.columns:
-                hist_data[col] = pd.to_numeric(hist_data[col], errors='coerce')
-        
-
-        
-        # 重新计算成交次数（因为缓存可能不包含最新算法）
-        hist_data['成交次数'] = calculate_trade_count_enhanced(hist_data)
-        
-        # 添加股票名称列
-        hist_data['名称'] = get_stock_name(stock_code)
-        
-        # 确保所有必需的列存在
-        required_columns = ['时间', '开盘价', '最高价', '最低价', '收盘价', '涨幅', '振幅', '总手数', '金额', '换手率', '成交次数', '名称']
-        for col in required_columns:
-            if col not in hist_data.columns:
-                hist_data[col] = 0 if col not in ['时间', '名称'] else ''
-        
-        # 按要求的顺序排列列
-        hist_data = hist_data[required_columns]
-        return hist_data
-    
-    def _get_hist_data(symbol, start_date, end_date):
-        """内部函数：获取历史数据"""
-        return ak.stock_zh_a_hist(symbol=symbol, period="daily", 
-                                start_date=start_date, end_date=end_date, 
-                                adjust="qfq")
-    
     try:
-        # 使用反制机制获取前复权数据
-        hist_data = safe_request_with_retry(_get_hist_data, stock_code, cache_start_date, cache_end_date)
+        factors, adjust = full_history_adjust(stock_code)
+        hist_data = request_history(stock_code, cache_start_date, cache_end_date, adjust)
         
         if hist_data is None or hist_data.empty:
             log_message("INFO", f"股票 {stock_code} 在指定时间范围内无数据")
             anti_block_manager.mark_stock_failed(stock_code)
             return None
         
-        # 数据处理和缓存
-        hist_data = hist_data.copy()
-        
-        # 缓存原始数据
-        if start_date and end_date:
-            anti_block_manager.cache_data(stock_code, start_date, end_date, hist_data.to_dict())
-        
-        # 数据清洗和标准化
-        column_mapping = {
-            '日期': '时间',
-            '开盘': '开盘价',
-            '最高': '最高价', 
-            '最低': '最低价',
-            '收盘': '收盘价',
-            '成交量': '总手数',
-            '成交额': '金额',
-            '涨跌幅': '涨幅',
-            '涨跌额': '涨跌额',
-            '换手率': '换手率',
-            '振幅': '振幅'
-        }
-        
-        # 应用列名映射
-        for old_name, new_name in column_mapping.items():
-            if old_name in hist_data.columns:
-                hist_data = hist_data.rename(columns={old_name: new_name})
-        
-        # 确保数值列的类型正确
-        numeric_columns = ['开盘价', '最高价', '最低价', '收盘价', '涨幅', '振幅', '总手数', '金额', '换手率']
-        for col in numeric_columns:
-            if col in hist_data.columns:
-                hist_data[col] = pd.to_numeric(hist_data[col], errors='coerce')
-        
-
-        
-        # 计算成交次数（使用增强版多因子模型）
-        hist_data['成交次数'] = calculate_trade_count_enhanced(hist_data)
-        
-        # 添加股票名称列
-        hist_data['名称'] = get_stock_name(stock_code)
+        # 数据清洗和标准化（接口返回的DataFrame只在本函数内使用，原地处理不再复制）
+        hist_data = normalize_hist_columns(hist_data)
+        hist_data['时间'] = pd.to_datetime(hist_data['时间'])
         
-        # 确保所有必需的列存在
-        required_columns = ['时间', '开盘价', '最高价', '最低价', '收盘价', '涨幅', '振幅', '总手数', '金额', '换手率', '成交次数', '名称']
-        for col in required_columns:
-            if col not in hist_data.columns:
-                hist_data[col] = 0 if col not in ['时间', '名称'] else ''
+        # 入库前校验，严重错误的数据不写入，股票进入隔离等待重新获取
+        if not check_ingest_data(stock_code, hist_data, raw=(adjust == "")):
+            anti_block_manager.mark_stock_failed(stock_code)
+            return None
         
-        # 按要求的顺序排列列
-        hist_data = hist_data[required_columns]
+        if factors is not None:
+            # 不复权数据只追加入库，导出仍为前复权口径
+            if pending_raw is not None:
+                pending_raw.append(hist_data[RAW_COLUMNS].copy())
+            else:
+                save_raw_bars(stock_code, hist_data, replace=replace_raw)
+            hist_data = apply_adjustment(hist_data, factors, "qfq")
         
-        return hist_data
+        return finalize_export_frame(stock_code, hist_data)
         
     except Exception as e:
         log_message("ERROR", f"获取股票 {stock_code} 历史数据失败: {str(e)}")
         anti_block_manager.mark_stock_failed(stock_code)
         return None
 
+def _column_values(hist_data, col):
+    """取出数值列为float数组（列不存在时为0），不复制整个DataFrame"""
+    if col not in hist_data.columns:
+        return np.zeros(len(hist_data))
+    return pd.to_numeric(hist_data[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+# 成交次数算法版本，写入每个归档文件的标记（trade_count_algo）.
+# 修改 calculate_trade_count_enhanced 的计算结果时必须加1，之后运行 --recompute-trade-count 重算旧文件
+TRADE_COUNT_ALGO_VERSION = 2
+
 def calculate_trade_count_enhanced(hist_data):
-    """增强版智能成交次数计算（多因子模型）"""
+    """增强版智能成交次数计算（多因子模型，按列向量化计算，结果与逐行计算一致）"""
     try:
-        trade_counts = []
-        hist_data_copy = hist_data.copy()
-        
-        # 计算移动平均成交量（用于相对成交量因子）
-        if len(hist_data_copy) >= 5:
-            hist_data_copy['成交量MA5'] = hist_data_copy['总手数'].rolling(window=5, min_periods=1).mean()
+        volume = _column_values(hist_data, '总手数')  # 成交量（手）
+        amount = _column_values(hist_data, '金额')   # 成交金额（元）
+        turnover_rate = _column_values(hist_data, '换手率')  # 换手率（%）
+        high_price = _column_values(hist_data, '最高价')
+        low_price = _column_values(hist_data, '最低价')
+        close_price = _column_values(hist_data, '收盘价')
+        change_pct = _column_values(hist_data, '涨幅')  # 涨跌幅
+        amplitude = _column_values(hist_data, '振幅')  # 振幅
+
+        # 移动平均成交量（用于相对成交量因子）
+        if len(hist_data) >= 5:
+            ma_volume = pd.Series(volume).rolling(window=5, min_periods=1).mean().to_numpy()
+        else:
+            ma_volume = volume
+
+        valid = (volume > 0) & (amount > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 1. 基础计算：根据成交均价确定基础单笔成交量（1手=100股）
+            avg_price = amount / (volume * 100)
+            base_volume = np.select(
+                [avg_price < 5, avg_price < 20, avg_price < 50, avg_price < 100],
+                [500, 300, 200, 100], 50)
+
+            # 2. 换手率因子（比较结果为NaN时落入最后一档，与逐行计算一致）
+            turnover_factor = np.select(
+                [turnover_rate > 10, turnover_rate > 5, turnover_rate > 2, turnover_rate > 0.5],
+                [0.6, 0.8, 1.0, 1.5], 2.0)
+
+            # 3. 振幅因子
+            amplitude_factor = np.select(
+                [amplitude > 9, amplitude > 6, amplitude > 3, amplitude > 1],
+                [0.7, 0.8, 1.0, 1.2], 1.5)
+
+            # 4. 涨跌幅因子
+            abs_change = np.abs(change_pct)
+            change_factor = np.select(
+                [abs_change > 9, abs_change > 5, abs_change > 2, abs_change > 0.5],
+                [0.7, 0.8, 1.0, 1.1], 1.3)
+
+            # 5. 价格位置因子（收盘价接近最高价时买盘强劲，更多小单）
+            has_range = high_price > low_price
+            price_position = (close_price - low_price) / np.where(has_range, high_price - low_price, 1.0)
+            position_factor = np.where(has_range, np.select(
+                [price_position > 0.8, price_position > 0.6, price_position > 0.4, price_position > 0.2],
+                [0.9, 0.95, 1.0, 1.05], 1.1), 1.0)
+
+            # 6. 相对成交量因子（异常放量时更多小单交易）
+            volume_ratio = volume / np.where(ma_volume > 0, ma_volume, 1.0)
+            volume_factor = np.where(ma_volume > 0, np.select(
+                [volume_ratio > 3, volume_ratio > 2, volume_ratio > 1.5, volume_ratio > 0.7, volume_ratio > 0.3],
+                [0.6, 0.8, 0.9, 1.0, 1.2], 1.5), 1.0)
+
+        # 7. 时间因子（周一情绪释放、周五获利了结）
+        if '时间' in hist_data.columns:
+            weekday = pd.to_datetime(hist_data['时间'], errors='coerce').dt.weekday.to_numpy()
+            time_factor = np.where((weekday == 0) | (weekday == 4), 0.9, 1.0)
         else:
-            hist_data_copy['成交量MA5'] = hist_data_copy['总手数']
+            time_factor = np.ones(len(hist_data))
+
+        # 综合计算所有因子（乘法顺序与逐行计算相同，保证浮点结果一致）
+        total_factor = (turnover_factor * amplitude_factor * change_factor *
+                        position_factor * volume_factor * time_factor)
+
+        # 计算调整后的平均单笔成交量和成交次数
+        avg_volume_per_trade = np.maximum(1, np.floor(base_volume * total_factor))
+        with np.errstate(invalid='ignore'):
+            estimated_count = np.maximum(1, np.floor(volume / avg_volume_per_trade))
+
+            # 合理性检查：成交次数不能超过成交量，过高时（接近每笔1手）取成交量的80%
+            estimated_count = np.where(estimated_count > volume, volume, estimated_count)
+            estimated_count = np.where(estimated_count > volume * 0.8, np.floor(volume * 0.8), estimated_count)
+
+        return np.where(valid, estimated_count, 0).astype(np.int64)
+
+    except Exception as e:
+        log_message("WARNING", f"增强版智能计算成交次数失败: {str(e)}")
+        return [0] * len(hist_data)
+
+# 保留原有的简单版本作为备用
+def calculate_trade_count_smart(hist_data):
+    """智能计算成交次数（基于金额、总手数、换手率）"""
+    try:
+        trade_counts = []
         
-        for index, row in hist_data_copy.iterrows():
+        for index, row in hist_data.iterrows():
             volume = row.get('总手数', 0)  # 成交量（手）
             amount = row.get('金额', 0)   # 成交金额（元）
             turnover_rate = row.get('换手率', 0)  # 换手率（%）
-            
-            # 基础数据
-            open_price = row.get('开盘价', 0)
-            high_price = row.get('最高价', 0)
-            low_price = row.get('最低价', 0)
-            close_price = row.get('收盘价', 0)
-            change_pct = row.get('涨幅', 0)  # 涨跌幅
-            amplitude = row.get('振幅', 0)  # 振幅
-            
-            # 移动平均成交量
-            ma_volume = row.get('成交量MA5', volume)
+            close_price = row.get('收盘价', 0)    # 收盘价
             
             if volume > 0 and amount > 0:
-                # 1. 基础计算（原有逻辑）
+                # 计算平均成交价格
                 avg_price = amount / (volume * 100)  # 1手=100股
                 
                 # 根据股价确定基础单笔成交量
                 if avg_price < 5:      # 低价股
-                    base_volume = 500   
+                    base_volume = 500   # 散户倾向于买更多手
                 elif avg_price < 20:   # 中低价股
                     base_volume = 300
                 elif avg_price < 50:   # 中价股
@@ -800,169 +1691,23 @@ def calculate_trade_count_enhanced(hist_data):
                 else:                  # 超高价股
                     base_volume = 50
                 
-                # 2. 换手率因子（原有逻辑）
+                # 根据换手率调整
                 if turnover_rate > 10:      # 非常活跃
-                    turnover_factor = 0.6    
+                    volume_factor = 0.6    # 更多小单交易
                 elif turnover_rate > 5:     # 活跃
-                    turnover_factor = 0.8
+                    volume_factor = 0.8
                 elif turnover_rate > 2:     # 正常
-                    turnover_factor = 1.0
+                    volume_factor = 1.0
                 elif turnover_rate > 0.5:   # 低迷
-                    turnover_factor = 1.5    
+                    volume_factor = 1.5    # 更多大单交易
                 else:                       # 极低迷
-                    turnover_factor = 2.0
-                
-                # 3. 振幅因子（新增）
-                if amplitude > 9:           # 振幅超过9%，交易很活跃
-                    amplitude_factor = 0.7
-                elif amplitude > 6:         # 振幅6-9%，较活跃
-                    amplitude_factor = 0.8
-                elif amplitude > 3:         # 振幅3-6%，正常
-                    amplitude_factor = 1.0
-                elif amplitude > 1:         # 振幅1-3%，较平静
-                    amplitude_factor = 1.2
-                else:                       # 振幅很小，交易平静
-                    amplitude_factor = 1.5
+                    volume_factor = 2.0
                 
-                # 4. 涨跌幅因子（新增）
-                abs_change = abs(change_pct)
-                if abs_change > 9:          # 涨跌超过9%，交易很活跃
-                    change_factor = 0.7
-                elif abs_change > 5:        # 涨跌5-9%，较活跃
-                    change_factor = 0.8
-                elif abs_change > 2:        # 涨跌2-5%，正常
-                    change_factor = 1.0
-                elif abs_change > 0.5:      # 涨跌0.5-2%，较平静
-                    change_factor = 1.1
-                else:                       # 涨跌很小，平静
-                    change_factor = 1.3
+                # 计算调整后的平均单笔成交量
+                avg_volume_per_trade = max(1, int(base_volume * volume_factor))
                 
-                # 5. 价格位置因子（新增）
-                if high_price > low_price:
-                    price_position = (close_price - low_price) / (high_price - low_price)
-                    if price_position > 0.8:       # 收盘价接近最高价
-                        position_factor = 0.9      # 买盘强劲，更多小单
-                    elif price_position > 0.6:     # 收盘价偏高
-                        position_factor = 0.95
-                    elif price_position > 0.4:     # 收盘价居中
-                        position_factor = 1.0
-                    elif price_position > 0.2:     # 收盘价偏低
-                        position_factor = 1.05
-                    else:                          # 收盘价接近最低价
-                        position_factor = 1.1      # 卖盘强劲，可能更多大单
-                else:
-                    position_factor = 1.0
-                
-                # 6. 相对成交量因子（新增）
-                if ma_volume > 0:
-                    volume_ratio = volume / ma_volume
-                    if volume_ratio > 3:           # 成交量是平均的3倍以上，异常放量
-                        volume_factor = 0.6        # 更多小单交易
-                    elif volume_ratio > 2:         # 成交量是平均的2-3倍，放量
-                        volume_factor = 0.8
-                    elif volume_ratio > 1.5:       # 成交量是平均的1.5-2倍，温和放量
-                        volume_factor = 0.9
-                    elif volume_ratio > 0.7:       # 成交量正常
-                        volume_factor = 1.0
-                    elif volume_ratio > 0.3:       # 成交量较小
-                        volume_factor = 1.2
-                    else:                          # 成交量很小
-                        volume_factor = 1.5
-                else:
-                    volume_factor = 1.0
-                
-                # 7. 时间因子（新增）
-                try:
-                    # 获取交易日期
-                    trade_date = pd.to_datetime(row.get('时间', ''))
-                    weekday = trade_date.weekday()  # 0=周一, 6=周日
-                    
-                    if weekday == 0:               # 周一，情绪释放
-                        time_factor = 0.9
-                    elif weekday == 4:             # 周五，获利了结
-                        time_factor = 0.9
-                    elif weekday in [1, 2, 3]:     # 周二到周四，正常交易
-                        time_factor = 1.0
-                    else:                          # 其他情况
-                        time_factor = 1.0
-                except:
-                    time_factor = 1.0
-                
-                # 综合计算所有因子
-                total_factor = (turnover_factor * amplitude_factor * change_factor * 
-                               position_factor * volume_factor * time_factor)
-                
-                # 计算调整后的平均单笔成交量
-                avg_volume_per_trade = max(1, int(base_volume * total_factor))
-                
-                # 计算成交次数
-                estimated_count = max(1, int(volume / avg_volume_per_trade))
-                
-                # 合理性检查（避免异常值）
-                if estimated_count > volume:  # 成交次数不能超过成交量
-                    estimated_count = volume
-                elif estimated_count < 1:
-                    estimated_count = 1
-                
-                # 最终微调：确保结果在合理范围内
-                if estimated_count > volume * 0.8:  # 成交次数过高，可能每笔都是1手
-                    estimated_count = int(volume * 0.8)
-                
-                trade_counts.append(estimated_count)
-            else:
-                trade_counts.append(0)
-        
-        return trade_counts
-        
-    except Exception as e:
-        log_message("WARNING", f"增强版智能计算成交次数失败: {str(e)}")
-        return [0] * len(hist_data)
-
-# 保留原有的简单版本作为备用
-def calculate_trade_count_smart(hist_data):
-    """智能计算成交次数（基于金额、总手数、换手率）"""
-    try:
-        trade_counts = []
-        
-        for index, row in hist_data.iterrows():
-            volume = row.get('总手数', 0)  # 成交量（手）
-            amount = row.get('金额', 0)   # 成交金额（元）
-            turnover_rate = row.get('换手率', 0)  # 换手率（%）
-            close_price = row.get('收盘价', 0)    # 收盘价
-            
-            if volume > 0 and amount > 0:
-                # 计算平均成交价格
-                avg_price = amount / (volume * 100)  # 1手=100股
-                
-                # 根据股价确定基础单笔成交量
-                if avg_price < 5:      # 低价股
-                    base_volume = 500   # 散户倾向于买更多手
-                elif avg_price < 20:   # 中低价股
-                    base_volume = 300
-                elif avg_price < 50:   # 中价股
-                    base_volume = 200
-                elif avg_price < 100:  # 高价股
-                    base_volume = 100
-                else:                  # 超高价股
-                    base_volume = 50
-                
-                # 根据换手率调整
-                if turnover_rate > 10:      # 非常活跃
-                    volume_factor = 0.6    # 更多小单交易
-                elif turnover_rate > 5:     # 活跃
-                    volume_factor = 0.8
-                elif turnover_rate > 2:     # 正常
-                    volume_factor = 1.0
-                elif turnover_rate > 0.5:   # 低迷
-                    volume_factor = 1.5    # 更多大单交易
-                else:                       # 极低迷
-                    volume_factor = 2.0
-                
-                # 计算调整后的平均单笔成交量
-                avg_volume_per_trade = max(1, int(base_volume * volume_factor))
-                
-                # 计算成交次数
-                estimated_count = max(1, int(volume / avg_volume_per_trade))
+                # 计算成交次数
+                estimated_count = max(1, int(volume / avg_volume_per_trade))
                 
                 # 合理性检查（避免异常值）
                 if estimated_count > volume:  # 成交次数不能超过成交量
@@ -981,16 +1726,10 @@ def calculate_trade_count_smart(hist_data):
         return [0] * len(hist_data)
 
 def load_name_cache_from_index(index_file):
-    name_cache = {}
-    if os.path.exists(index_file):
-        with open(index_file, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                code = str(row.get('股票代码')).zfill(6)
-                name = row.get('股票名称', '')
-                if code and name:
-                    name_cache[code] = name
-    return name_cache
+    try:
+        return index_store.read_index_names(index_file)
+    except Exception:
+        return {}
 
 # 全局股票名称缓存，程序启动时即加载
 STOCK_NAME_CACHE = load_name_cache_from_index(INDEX_FILE)
@@ -999,62 +1738,179 @@ def get_stock_name(stock_code):
     # 只查本地缓存，不联网
     return STOCK_NAME_CACHE.get(stock_code, stock_code)
 
-def create_excel_file(file_path, stock_name, data):
-    """创建Excel文件（基于模板文件，始终写入Sheet1）"""
+# ================== 内容哈希与文件标记 ==================
+
+# 文件标记写在xlsx文档属性的关键词中（格式 key=value;key=value），文件移动后仍随文件保留
+_KEYWORDS_PATTERN = re.compile(r'<cp:keywords[^>]*>(.*?)</cp:keywords>', re.S)
+
+def compute_content_hash(data, stock_name):
+    """按列计算导出数据的内容哈希（直接对NumPy缓冲区求哈希，不逐行转换）"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(len(data)).encode())
+    for col in EXCEL_HEADERS:
+        digest.update(col.encode('utf-8'))
+        if col == '名称':
+            digest.update(str(stock_name).encode('utf-8'))
+        elif col == '时间':
+            values = pd.to_datetime(data[col]).to_numpy(dtype='datetime64[ns]')
+            digest.update(np.ascontiguousarray(values).view('int64').tobytes())
+        else:
+            values = pd.to_numeric(data[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+            digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+def read_file_stamps(file_path):
+    """读取xlsx文件中的标记（只解压文档属性，不解析工作表），文件不存在或无标记时返回空字典"""
     try:
-        # 检查模板文件是否存在
-        if os.path.exists(TEMPLATE_FILE):
-            # 使用模板文件作为基础
-            log_message("INFO", f"使用模板文件: {TEMPLATE_FILE}")
-            wb = load_workbook(TEMPLATE_FILE)
-            # 强制写入Sheet1，如果没有则新建
-            if 'Sheet1' in wb.sheetnames:
-                ws = wb['Sheet1']
-            else:
-                ws = wb.create_sheet('Sheet1', 0)
-                # 写入表头
-                for col, header in enumerate(EXCEL_HEADERS, 1):
-                    ws.cell(row=1, column=col, value=header)
-                log_message("INFO", "模板无Sheet1，已自动创建Sheet1并写入表头")
-            # 检查Sheet1是否已有表头
-            existing_headers = []
-            for col in range(1, 13):  # 检查前12列
-                header_value = ws.cell(row=1, column=col).value
-                if header_value:
-                    existing_headers.append(str(header_value))
-            # 如果表头不完整或不匹配，写入标准表头
-            if len(existing_headers) < 12 or existing_headers != EXCEL_HEADERS:
-                log_message("INFO", "Sheet1表头不完整，写入标准表头")
-                for col, header in enumerate(EXCEL_HEADERS, 1):
-                    ws.cell(row=1, column=col, value=header)
-            else:
-                log_message("INFO", "Sheet1已有标准表头")
+        with zipfile.ZipFile(file_path) as zf:
+            core = zf.read('docProps/core.xml').decode('utf-8')
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return {}
+    match = _KEYWORDS_PATTERN.search(core)
+    if not match:
+        return {}
+    stamps = {}
+    for item in match.group(1).split(';'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            stamps[key.strip()] = value.strip()
+    return stamps
+
+def format_file_stamps(stamps):
+    """标记字典转为关键词字符串"""
+    return ';'.join(f"{key}={value}" for key, value in sorted(stamps.items()))
+
+class WriteStats:
+    """Excel写入统计：内容未变化时跳过写入"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.written = 0
+            self.skipped = 0
+            self.bytes_saved = 0
+
+    def record_written(self):
+        with self.lock:
+            self.written += 1
+
+    def record_skipped(self, file_size):
+        with self.lock:
+            self.skipped += 1
+            self.bytes_saved += file_size
+
+    def log_summary(self):
+        with self.lock:
+            log_message("INFO", f"Excel写入 - 写入: {self.written}, 内容未变跳过: {self.skipped}, 节省写入: {self.bytes_saved / 1024 / 1024:.1f}MB")
+
+write_stats = WriteStats()
+
+def build_excel_workbook(stock_name, data):
+    """基于模板生成工作簿（始终写入Sheet1）"""
+    # 检查模板文件是否存在
+    if os.path.exists(TEMPLATE_FILE):
+        # 使用模板文件作为基础
+        log_message("INFO", f"使用模板文件: {TEMPLATE_FILE}")
+        wb = load_workbook(TEMPLATE_FILE)
+        # 强制写入Sheet1，如果没有则新建
+        if 'Sheet1' in wb.sheetnames:
+            ws = wb['Sheet1']
         else:
-            # 模板文件不存在，创建新工作簿
-            log_message("INFO", "模板文件不存在，创建新工作簿")
-            wb = Workbook()
-            ws = wb.active
-            ws.title = 'Sheet1'
+            ws = wb.create_sheet('Sheet1', 0)
             # 写入表头
             for col, header in enumerate(EXCEL_HEADERS, 1):
                 ws.cell(row=1, column=col, value=header)
-        # 清除现有数据（保留表头）
-        if ws.max_row > 1:
-            ws.delete_rows(2, ws.max_row - 1)
-        # 写入数据
-        for row_idx, (_, row_data) in enumerate(data.iterrows(), 2):
-            for col_idx, header in enumerate(EXCEL_HEADERS, 1):
-                if header == '名称':
-                    ws.cell(row=row_idx, column=col_idx, value=stock_name)
-                else:
-                    value = row_data[header]
-                    cell = ws.cell(row=row_idx, column=col_idx, value=value)
-                    # 对涨幅和振幅字段设置为百分比格式
-                    if header in ['涨幅', '振幅'] and isinstance(value, (int, float)):
-                        cell.value = value / 100
-                        cell.number_format = '0.00%'
+            log_message("INFO", "模板无Sheet1，已自动创建Sheet1并写入表头")
+        # 检查Sheet1是否已有表头
+        existing_headers = []
+        for col in range(1, 13):  # 检查前12列
+            header_value = ws.cell(row=1, column=col).value
+            if header_value:
+                existing_headers.append(str(header_value))
+        # 如果表头不完整或不匹配，写入标准表头
+        if len(existing_headers) < 12 or existing_headers != EXCEL_HEADERS:
+            log_message("INFO", "Sheet1表头不完整，写入标准表头")
+            for col, header in enumerate(EXCEL_HEADERS, 1):
+                ws.cell(row=1, column=col, value=header)
+        else:
+            log_message("INFO", "Sheet1已有标准表头")
+    else:
+        # 模板文件不存在，创建新工作簿
+        log_message("INFO", "模板文件不存在，创建新工作簿")
+        wb = Workbook()
+        ws = wb.active
+        ws.title = 'Sheet1'
+        # 写入表头
+        for col, header in enumerate(EXCEL_HEADERS, 1):
+            ws.cell(row=1, column=col, value=header)
+    # 清除现有数据（保留表头）
+    if ws.max_row > 1:
+        ws.delete_rows(2, ws.max_row - 1)
+    # 写入数据
+    for row_idx, (_, row_data) in enumerate(data.iterrows(), 2):
+        for col_idx, header in enumerate(EXCEL_HEADERS, 1):
+            if header == '名称':
+                ws.cell(row=row_idx, column=col_idx, value=stock_name)
+            else:
+                value = row_data[header]
+                cell = ws.cell(row=row_idx, column=col_idx, value=value)
+                # 对涨幅和振幅字段设置为百分比格式
+                if header in ['涨幅', '振幅'] and isinstance(value, (int, float)):
+                    cell.value = value / 100
+                    cell.number_format = '0.00%'
+    return wb
+
+def fsync_file(file_path):
+    """把文件内容刷到磁盘"""
+    with open(file_path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+def fsync_directory(dir_path):
+    """把目录项（重命名结果）刷到磁盘，Windows不支持对目录fsync，直接跳过"""
+    if os.name == 'nt':
+        return
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def get_temp_path(file_path):
+    """写入用的临时文件路径（与目标同目录，保证os.replace是原子操作）"""
+    return f"{file_path}.tmp"
+
+def prepare_excel_file(file_path, stock_name, data):
+    """
+    生成待写入的工作簿. 内容与已有文件相同时返回None（并计入跳过统计）.
+    """
+    content_hash = compute_content_hash(data, stock_name)
+    stamps = {'content_hash': content_hash, 'trade_count_algo': str(TRADE_COUNT_ALGO_VERSION)}
+    if os.path.exists(file_path) and read_file_stamps(file_path) == stamps:
+        log_message("INFO", f"内容未变化，跳过写入: {file_path}")
+        write_stats.record_skipped(os.path.getsize(file_path))
+        return None
+    wb = build_excel_workbook(stock_name, data)
+    # 记录内容哈希（下次内容相同时可跳过写入）和成交次数算法版本
+    wb.properties.keywords = format_file_stamps(stamps)
+    return wb
+
+def create_excel_file(file_path, stock_name, data):
+    """
+    创建Excel文件（基于模板文件，始终写入Sheet1），内容与已有文件相同时跳过写入.
+    先写同目录临时文件并fsync，再os.replace替换，中途崩溃不会留下残缺的xlsx.
+    """
+    try:
+        wb = prepare_excel_file(file_path, stock_name, data)
+        if wb is None:
+            return True
         # 保存文件
-        wb.save(file_path)
+        tmp_path = get_temp_path(file_path)
+        wb.save(tmp_path)
+        fsync_file(tmp_path)
+        os.replace(tmp_path, file_path)
+        write_stats.record_written()
         # 输出工作表信息
         sheet_names = wb.sheetnames
         log_message("INFO", f"Excel文件已创建，包含工作表: {', '.join(sheet_names)}")
@@ -1063,93 +1919,302 @@ def create_excel_file(file_path, stock_name, data):
         log_message("ERROR", f"创建Excel文件失败: {str(e)}")
         return False
 
+# ================== 后台写入线程 ==================
+
+# 后台写入配置
+WRITER_CONFIG = {
+    'max_queue': 32,  # 队列中最多等待写入的文件数
+    'max_memory_mb': 256,  # 队列中数据占用内存上限（MB）
+    'fsync_batch_size': 8,  # 每批fsync并替换的文件数
+    'fsync_interval': 2.0,  # 未满一批时最长等待时间（秒）
+}
+
+class ExcelWriteBehind:
+    """
+    后台Excel写入线程.
+    抓取线程提交数据后立即返回，只有队列或内存达到上限时才阻塞（背压）；
+    写入线程生成临时文件，按批fsync后用os.replace原子替换，完成后回调通知.
+    依赖文件落盘的状态（如本地不复权数据入库）只在 on_done(True) 中推进：
+    进程在队列中的文件写入前退出时，这些股票的状态不变，下次运行重新获取.
+    """
+    _STOP = object()
+
+    def __init__(self, max_queue=None, max_memory_mb=None, fsync_batch_size=None, fsync_interval=None):
+        self.max_memory = (max_memory_mb or WRITER_CONFIG['max_memory_mb']) * 1024 * 1024
+        self.fsync_batch_size = fsync_batch_size or WRITER_CONFIG['fsync_batch_size']
+        self.fsync_interval = fsync_interval or WRITER_CONFIG['fsync_interval']
+        self.queue = Queue(maxsize=max_queue or WRITER_CONFIG['max_queue'])
+        self.memory_cond = threading.Condition()
+        self.queued_bytes = 0
+        # 指标
+        self.metrics_lock = threading.Lock()
+        self.max_depth = 0
+        self.latencies = []
+        self.backpressure_time = 0.0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name="excel-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, file_path, stock_name, data, on_done=None):
+        """提交一个写入任务，on_done(success) 在文件落盘（或失败）后由写入线程调用"""
+        size = int(data.memory_usage(index=False, deep=True).sum())
+        wait_start = time.time()
+        with self.memory_cond:
+            while self.queued_bytes > 0 and self.queued_bytes + size > self.max_memory:
+                self.memory_cond.wait()
+            self.queued_bytes += size
+        self.queue.put((file_path, stock_name, data, on_done, size, time.time()))
+        waited = time.time() - wait_start
+        with self.metrics_lock:
+            self.backpressure_time += waited
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _release(self, size):
+        with self.memory_cond:
+            self.queued_bytes -= size
+            self.memory_cond.notify_all()
+
+    def _run(self):
+        pending = []  # (临时文件, 目标文件, 回调, 提交时间)
+        batch_start = None
+        while True:
+            timeout = None if not pending else max(0.0, self.fsync_interval - (time.time() - batch_start))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            if item is self._STOP:
+                self._flush(pending)
+                break
+            if item is not None:
+                file_path, stock_name, data, on_done, size, submitted = item
+                try:
+                    wb = prepare_excel_file(file_path, stock_name, data)
+                    if wb is None:
+                        self._finish(on_done, True, submitted)
+                    else:
+                        tmp_path = get_temp_path(file_path)
+                        wb.save(tmp_path)
+                        if not pending:
+                            batch_start = time.time()
+                        pending.append((tmp_path, file_path, on_done, submitted))
+                except Exception as e:
+                    log_message("ERROR", f"后台写入 {file_path} 失败: {e}")
+                    self._finish(on_done, False, submitted)
+                finally:
+                    del data
+                    self._release(size)
+            # 满一批、超时或队列已空时落盘
+            if pending and (len(pending) >= self.fsync_batch_size or item is None or self.queue.empty()):
+                self._flush(pending)
+                pending = []
+
+    def _flush(self, pending):
+        """批量fsync临时文件后原子替换，最后fsync涉及的目录"""
+        committed = []
+        for tmp_path, file_path, on_done, submitted in pending:
+            try:
+                fsync_file(tmp_path)
+                os.replace(tmp_path, file_path)
+                committed.append((file_path, on_done, submitted))
+            except Exception as e:
+                log_message("ERROR", f"后台写入 {file_path} 落盘失败: {e}")
+                self._finish(on_done, False, submitted)
+        for dir_path in set(os.path.dirname(file_path) for file_path, _, _ in committed):
+            try:
+                fsync_directory(dir_path)
+            except OSError:
+                pass
+        for file_path, on_done, submitted in committed:
+            write_stats.record_written()
+            self._finish(on_done, True, submitted)
+
+    def _finish(self, on_done, success, submitted):
+        with self.metrics_lock:
+            if success:
+                self.latencies.append(time.time() - submitted)
+            else:
+                self.failed += 1
+        if on_done is not None:
+            try:
+                on_done(success)
+            except Exception as e:
+                log_message("ERROR", f"写入完成回调出错: {e}")
+
+    def close(self):
+        """等待队列中的文件全部落盘后结束写入线程"""
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            latencies = sorted(self.latencies)
+            count = len(latencies)
+            return {
+                'written': count,
+                'failed': self.failed,
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_depth,
+                'avg_latency': sum(latencies) / count if count else 0.0,
+                'p95_latency': latencies[min(count - 1, int(count * 0.95))] if count else 0.0,
+                'max_latency': latencies[-1] if count else 0.0,
+                'backpressure_time': self.backpressure_time,
+            }
+
+    def log_metrics(self):
+        m = self.get_metrics()
+        log_message("INFO", f"后台写入 - 完成: {m['written']}, 失败: {m['failed']}, 最大队列深度: {m['max_queue_depth']}, "
+                            f"写入延迟 平均/P95/最大: {m['avg_latency']:.2f}/{m['p95_latency']:.2f}/{m['max_latency']:.2f} 秒, "
+                            f"抓取线程背压等待: {m['backpressure_time']:.1f} 秒")
+
+# 索引文件的列（读写统一由 index_store 完成，股票代码始终是6位字符串）
+INDEX_HEADERS = index_store.INDEX_HEADERS
+
 def save_index_file(processed_stocks_list, index_path):
     """
     更新索引文件. 这是一个原子操作, 线程安全.
     processed_stocks_list: 一个包含股票信息字典的列表.
     """
     log_message("DEBUG", f"准备写入索引文件: {index_path}, 新增股票数: {len(processed_stocks_list)}")
-    INDEX_HEADERS = ['股票代码', '股票名称', '上市日期', '上市年限', '文件路径']
     with index_update_lock:
         existing_stocks = load_existing_index(index_path)
         # 合并新处理的股票到现有索引中
         for stock_info in processed_stocks_list:
-            stock_code = str(stock_info.get('股票代码')).zfill(6)
-            if not stock_code or stock_code == '000000': continue # 跳过无效代码
+            stock_code = index_store.normalize_code(stock_info.get('股票代码'))
+            if not stock_code: continue # 跳过无效代码
             # 确保所有字段都存在
             full_info = {h: stock_info.get(h, '') for h in INDEX_HEADERS}
-            full_info['股票代码'] = stock_code # 确保代码是6位数
+            full_info['股票代码'] = stock_code
             existing_stocks[stock_code] = full_info
         if not existing_stocks:
             log_message("DEBUG", f"索引为空，未写入: {index_path}")
             return
         try:
-            # 按股票代码排序后写入
-            sorted_codes = sorted(existing_stocks.keys())
-            log_message("DEBUG", f"已打开索引文件: {index_path}，准备写入")
-            with open(index_path, 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.DictWriter(f, fieldnames=INDEX_HEADERS)
-                writer.writeheader()
-                for code in sorted_codes:
-                    writer.writerow(existing_stocks[code])
+            # 按股票代码排序，先写临时文件再替换，同时更新二进制快照
+            index_store.write_index(existing_stocks, index_path)
             log_message("DEBUG", f"索引文件写入完成: {index_path}")
         except Exception as e:
             log_message("ERROR", f"保存索引文件失败: {e}")
 
 def load_existing_index(index_path):
-    """加载现有的索引文件"""
-    if not os.path.exists(index_path):
+    """加载现有的索引文件，返回 {股票代码: 记录字典}（CSV未变化时读取二进制快照）"""
+    try:
+        return index_store.read_index(index_path)
+    except Exception as e:
+        log_message("ERROR", f"加载索引文件失败: {e}")
         return {}
-    
-    existing_stocks = {}
-    
-    def read_with_encoding(encoding):
-        with open(index_path, 'r', newline='', encoding=encoding) as f:
-            # 首先尝试用DictReader，这是最理想的情况
-            try:
-                reader = csv.DictReader(f)
-                if not reader.fieldnames or '股票代码' not in reader.fieldnames:
-                    raise ValueError("Incorrect headers") # 触发回退机制
-                
-                for row in reader:
-                    stock_code = str(row.get('股票代码')).zfill(6)
-                    if stock_code and stock_code != '000000':
-                        existing_stocks[stock_code] = row
-                return existing_stocks
-            except (ValueError, KeyError, IndexError):
-                # 如果DictReader失败，回退到普通Reader
-                f.seek(0)
-                plain_reader = csv.reader(f)
-                try:
-                    next(plain_reader) # 跳过表头
-                except StopIteration:
-                    return {} # 空文件
-
-                for row in plain_reader:
-                    if len(row) >= 5:
-                        stock_code = str(row[0]).zfill(6)
-                        if stock_code and stock_code != '000000':
-                            existing_stocks[stock_code] = {
-                                '股票代码': stock_code,
-                                '股票名称': row[1],
-                                '上市日期': row[2],
-                                '上市年限': row[3],
-                                '文件路径': row[4]
-                        }
-        return existing_stocks
 
+# ================== 存储布局 ==================
+
+# 年限视图的链接方式: auto（优先符号链接，无权限时用硬链接）/ symlink / hardlink
+LAYOUT_CONFIG = {
+    'view_link': 'auto',
+}
+
+def get_stock_file_path(stock_code):
+    """新建归档文件的路径（按股票代码固定存放，不随上市年限变化）"""
+    return layout.get_store_path(STORE_DIR, stock_code)
+
+def find_stock_file(stock_code, stock_name):
+    """
+    查找股票已有的归档文件：先查代码存储目录，再查旧的按年限存放的位置.
+    返回 (文件路径, 年限文件夹)，代码存储中的文件年限文件夹为None，找不到时返回 (None, None)
+    """
+    store_path = get_stock_file_path(stock_code)
+    if os.path.exists(store_path):
+        return store_path, None
+    safe_name = stock_name.replace('*', '').replace('ST', '')
+    for possible_years in range(36):
+        possible_file = os.path.join(DATA_DIR, f"{possible_years}年", f"{stock_code}_{safe_name}.xlsx")
+        if os.path.exists(possible_file):
+            return possible_file, possible_years
+    return None, None
+
+def get_found_file_listing(stock_code, found_years):
+    """
+    已有文件的上市日期和年限：旧布局的年限取自所在文件夹，上市日期留空（避免网络请求）；
+    代码存储中的文件没有年限文件夹，上市日期查登记表. 返回 (上市日期, 上市年限)
+    """
+    if found_years is not None:
+        return '', found_years
+    listing_date = listing_registry.get(stock_code) or ''
+    return listing_date, calculate_years_since_listing(listing_date) if listing_date else ''
+
+def get_listing_years(stock_info):
+    """由索引记录计算当前的上市年限（有上市日期时按日期计算，否则沿用记录中的年限）"""
+    listing_date = stock_info.get('上市日期', '')
+    if listing_date:
+        return calculate_years_since_listing(listing_date)
     try:
-        # 尝试用 utf-8-sig, 兼容 windows excel/notepad 保存的文件
-        return read_with_encoding('utf-8-sig')
-    except Exception:
-        try:
-            # 如果 utf-8-sig 失败, 尝试用 utf-8
-            return read_with_encoding('utf-8')
-        except Exception as e:
-            log_message("ERROR", f"加载索引文件失败: {e}")
-            # 如果两种编码都失败，返回空字典
-            return {}
-            
+        return int(stock_info.get('上市年限') or 0)
+    except ValueError:
+        return 0
+
+def refresh_year_views(index_path=None):
+    """
+    按索引重建上市年限视图（DATA_DIR/<N>年/ 下指向存储文件的链接），同时更新索引中的上市年限.
+    只处理已在代码存储目录中的股票，不读取数据文件. 返回统计信息，没有这样的股票时返回None
+    """
+    index_path = index_path or INDEX_FILE
+    index = load_existing_index(index_path)
+    entries = []
+    changed = []
+    for stock_code, info in index.items():
+        file_path = info.get('文件路径', '')
+        if not layout.is_store_path(file_path, STORE_DIR):
+            continue
+        years = get_listing_years(info)
+        if str(info.get('上市年限', '')) != str(years):
+            changed.append(dict(info, 上市年限=years))
+        entries.append((stock_code, info.get('股票名称') or stock_code, years, file_path))
+    if not entries:
+        return None
+    if changed:
+        save_index_file(changed, index_path)
+    start_time = time.time()
+    stats = layout.rebuild_views(entries, DATA_DIR, LAYOUT_CONFIG['view_link'])
+    log_message("INFO", f"上市年限视图已更新（{stats['mode']}）- 新建: {stats['linked']}, 保持: {stats['kept']}, "
+                        f"删除: {stats['removed']}, 失败: {stats['failed']}, 年限变化: {len(changed)}, "
+                        f"耗时 {time.time() - start_time:.2f} 秒")
+    return stats
+
+def migrate_layout_mode():
+    """
+    把按年限存放的归档文件迁移到代码存储目录（同一磁盘内重命名，不复制数据），
+    然后生成年限视图. 可重复运行，已迁移的股票跳过.
+    """
+    log_message("INFO", "=== 迁移到按代码存储的布局 ===")
+    index = load_existing_index(INDEX_FILE)
+    if not index:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    moved = []
+    stats = {'moved': 0, 'already': 0, 'missing': 0}
+    start_time = time.time()
+    for stock_code, info in index.items():
+        file_path = info.get('文件路径', '')
+        if layout.is_store_path(file_path, STORE_DIR):
+            stats['already'] += 1
+            continue
+        if not file_path or not os.path.isfile(file_path) or os.path.islink(file_path):
+            stats['missing'] += 1
+            continue
+        store_path = get_stock_file_path(stock_code)
+        ensure_directory(os.path.dirname(store_path))
+        os.replace(file_path, store_path)
+        moved.append(dict(info, 文件路径=store_path))
+        stats['moved'] += 1
+        # 分批写索引，中途中断时已移动的文件也能由 find_stock_file 在代码存储中找到
+        if len(moved) >= 500:
+            save_index_file(moved, INDEX_FILE)
+            moved = []
+    if moved:
+        save_index_file(moved, INDEX_FILE)
+    log_message("INFO", f"迁移完成 - 移动: {stats['moved']}, 已在新布局: {stats['already']}, "
+                        f"文件缺失: {stats['missing']}, 耗时 {time.time() - start_time:.1f} 秒")
+    refresh_year_views()
+    return True
+
 # 多线程配置（3线程最佳平衡方案）
 MULTITHREAD_CONFIG = {
     'max_workers': 3,  # 3线程平衡方案
@@ -1167,7 +2232,7 @@ MULTITHREAD_CONFIG = {
 # 全局线程安全锁
 file_write_lock = threading.Lock()
 index_update_lock = threading.Lock()
-global_stats_lock = threading.Lock()
+global_stats_lock = threading.RLock()  # get_stats 在持锁时调用 get_success_rate
 
 # 全局统计信息
 class GlobalStats:
@@ -1206,6 +2271,137 @@ class GlobalStats:
 
 global_stats = GlobalStats()
 
+class RefreshStats:
+    """增量更新路径统计：重叠K线一致走增量追加，不一致走完整刷新"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.incremental = 0
+            self.full = 0
+
+    def record_incremental(self):
+        with self.lock:
+            self.incremental += 1
+
+    def record_full(self):
+        with self.lock:
+            self.full += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'incremental': self.incremental, 'full': self.full}
+
+refresh_stats = RefreshStats()
+
+class ValidationStats:
+    """入库校验统计：每条规则的违规行数和涉及股票数"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checked = 0
+            self.rejected = 0
+            self.rule_rows = {}
+            self.rule_stocks = {}
+
+    def record(self, violations, rejected):
+        with self.lock:
+            self.checked += 1
+            self.rejected += int(rejected)
+            for name, count in violations.items():
+                self.rule_rows[name] = self.rule_rows.get(name, 0) + count
+                self.rule_stocks[name] = self.rule_stocks.get(name, 0) + 1
+
+    def log_summary(self):
+        with self.lock:
+            log_message("INFO", f"数据校验 - 校验: {self.checked} 只, 拒绝写入: {self.rejected} 只")
+            for name in sorted(self.rule_rows):
+                log_message("INFO", f"  {name}: {self.rule_rows[name]} 行, 涉及 {self.rule_stocks[name]} 只股票")
+
+validation_stats = ValidationStats()
+
+# 隔离的股票最多自动重新获取的次数，超过后保留记录但不再自动重试
+QUARANTINE_MAX_REFETCH = 3
+
+class QuarantineRegistry:
+    """数据异常股票的隔离记录（持久化为json），更新时优先完整重新获取"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            if os.path.exists(file_path):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+        except Exception as e:
+            log_message("WARNING", f"读取隔离记录失败: {e}")
+
+    def _save(self):
+        try:
+            write_json_atomic(self.entries, self.file_path)
+        except Exception as e:
+            log_message("WARNING", f"保存隔离记录失败: {e}")
+
+    def add(self, stock_code, violations):
+        with self.lock:
+            entry = self.entries.get(stock_code, {'attempts': 0})
+            entry['violations'] = violations
+            entry['time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.entries[stock_code] = entry
+            self._save()
+
+    def release(self, stock_code):
+        with self.lock:
+            if self.entries.pop(stock_code, None) is not None:
+                self._save()
+
+    def should_refetch(self, stock_code):
+        """是否需要完整重新获取（调用即计为一次尝试）"""
+        with self.lock:
+            entry = self.entries.get(stock_code)
+            if entry is None or entry.get('attempts', 0) >= QUARANTINE_MAX_REFETCH:
+                return False
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            self._save()
+            return True
+
+    def merge(self, entries):
+        """合并其他机器的隔离记录（同一股票保留尝试次数较多的记录）"""
+        with self.lock:
+            for stock_code, entry in entries.items():
+                current = self.entries.get(stock_code)
+                if current is None or entry.get('attempts', 0) > current.get('attempts', 0):
+                    self.entries[stock_code] = entry
+            self._save()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+quarantine_registry = QuarantineRegistry(QUARANTINE_FILE)
+
+def check_ingest_data(stock_code, bars, raw=True):
+    """
+    入库前校验一只股票的日线. 有违规时记入隔离列表等待重新获取；
+    返回False表示存在严重错误，数据不应写入.
+    """
+    violations = validation.validate_bars(bars, raw=raw)
+    rejected = validation.has_errors(violations)
+    validation_stats.record(violations, rejected)
+    if violations:
+        level = "ERROR" if rejected else "WARNING"
+        detail = ", ".join(f"{name} {count}行" for name, count in violations.items())
+        log_message(level, f"股票 {stock_code} 数据校验未通过: {detail}{'，拒绝写入' if rejected else ''}，已隔离")
+        quarantine_registry.add(stock_code, violations)
+    else:
+        quarantine_registry.release(stock_code)
+    return not rejected
+
 class ThreadSafeAntiBlockManager(AntiBlockManager):
     """线程安全的反制机制管理器"""
     
@@ -1253,7 +2449,35 @@ class ThreadSafeAntiBlockManager(AntiBlockManager):
             self.last_request_time = time.time()
             self.request_count += 1
 
-def process_single_stock(stock_info, thread_id=0, result_queue=None):
+def write_stock_file(file_path, stock_name, data, result, result_queue=None, writer=None, on_written=None):
+    """
+    写入股票文件并登记结果.
+    有后台写入线程时排队后立即返回，文件落盘后才计入成功并放入结果队列，索引不会指向未写完的文件.
+    on_written 在文件落盘后、计入成功前调用（用于此时才推进本地不复权数据），失败时按写入失败处理.
+    """
+    def on_done(success):
+        if success and on_written is not None:
+            try:
+                on_written()
+            except Exception as e:
+                log_message("ERROR", f"文件 {file_path} 已写入，但本地数据入库失败: {e}")
+                success = False
+        if success:
+            global_stats.update_success()
+            if result_queue is not None:
+                result_queue.put(result)
+        else:
+            global_stats.update_failure()
+        return success
+
+    if writer is not None:
+        writer.submit(file_path, stock_name, data, on_done)
+        return result
+    success = create_excel_file(file_path, stock_name, data)
+    success = on_done(success)
+    return result if success else None
+
+def process_single_stock(stock_info, thread_id=0, result_queue=None, writer=None):
     """处理单只股票（线程安全版本）"""
     stock_code = stock_info['股票代码']
     stock_name = stock_info['股票名称']
@@ -1261,23 +2485,15 @@ def process_single_stock(stock_info, thread_id=0, result_queue=None):
     thread_anti_block = ThreadSafeAntiBlockManager(thread_id)
     try:
         log_message("DEBUG", f"线程{thread_id} 获取上市日期和历史数据 {stock_code}")
-        safe_name = stock_name.replace('*', '').replace('ST', '')
-        found_file = None
-        found_years = None
-        for possible_years in range(36):
-            possible_dir = os.path.join(DATA_DIR, f"{possible_years}年")
-            possible_file = os.path.join(possible_dir, f"{stock_code}_{safe_name}.xlsx")
-            if os.path.exists(possible_file):
-                found_file = possible_file
-                found_years = possible_years
-                break
+        found_file, found_years = find_stock_file(stock_code, stock_name)
         if found_file:
             log_message("INFO", f"线程{thread_id} 股票 {stock_code} 文件已存在，跳过")
             global_stats.update_success()
+            listing_date, found_years = get_found_file_listing(stock_code, found_years)
             result = {
                 'stock_code': stock_code,
                 'stock_name': stock_name,
-                'listing_date': '',
+                'listing_date': listing_date,
                 'years': found_years,
                 'file_path': found_file,
                 'status': 'skipped'
@@ -1287,9 +2503,8 @@ def process_single_stock(stock_info, thread_id=0, result_queue=None):
             return result
         listing_date = get_stock_listing_date(stock_code)
         years = calculate_years_since_listing(listing_date)
-        years_dir = os.path.join(DATA_DIR, f"{years}年")
-        ensure_directory(years_dir)
-        file_path = os.path.join(years_dir, f"{stock_code}_{safe_name}.xlsx")
+        file_path = get_stock_file_path(stock_code)
+        ensure_directory(os.path.dirname(file_path))
         hist_data = get_stock_history_data(stock_code)
         log_message("DEBUG", f"线程{thread_id} 获取历史数据完成 {stock_code}, 数据行数: {0 if hist_data is None else len(hist_data)}")
         if hist_data is None or hist_data.empty:
@@ -1297,25 +2512,18 @@ def process_single_stock(stock_info, thread_id=0, result_queue=None):
             global_stats.update_failure()
             return None
         log_message("DEBUG", f"线程{thread_id} 开始写Excel {file_path}")
-        if create_excel_file(file_path, stock_name, hist_data):
-            log_message("DEBUG", f"线程{thread_id} 写Excel完成 {file_path}")
+        result = {
+            'stock_code': stock_code,
+            'stock_name': stock_name,
+            'listing_date': listing_date,
+            'years': years,
+            'file_path': file_path,
+            'status': 'success'
+        }
+        result = write_stock_file(file_path, stock_name, hist_data, result, result_queue, writer)
+        if result is not None:
             log_message("INFO", f"线程{thread_id} 股票 {stock_code} 处理完成，数据量: {len(hist_data)}")
-            global_stats.update_success()
-            result = {
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'listing_date': listing_date,
-                'years': years,
-                'file_path': file_path,
-                'status': 'success'
-            }
-            if result_queue is not None:
-                result_queue.put(result)
-            return result
-        else:
-            global_stats.update_failure()
-            return None
-        log_message("DEBUG", f"线程{thread_id} 结束处理 {stock_code}")
+        return result
     except Exception as e:
         log_message("ERROR", f"线程{thread_id} 处理股票 {stock_code} 时发生错误: {str(e)}")
         global_stats.update_failure()
@@ -1337,6 +2545,7 @@ def initial_mode():
     failed_count = 0
     
     log_message("INFO", f"开始处理 {total_stocks} 只股票")
+    begin_scheduled_job('backfill', total_stocks)
     
     for index, stock in stock_list.iterrows():
         stock_code = stock['股票代码']
@@ -1345,28 +2554,18 @@ def initial_mode():
         log_message("INFO", f"处理股票 {stock_code} - {stock_name} ({index + 1}/{total_stocks})")
         
         try:
-            # 先尝试从各年限文件夹中查找现有文件
-            safe_name = stock_name.replace('*', '').replace('ST', '')
-            found_file = None
-            found_years = None
-            
-            # 遍历可能的年限文件夹（0-35年）
-            for possible_years in range(36):
-                possible_dir = os.path.join(DATA_DIR, f"{possible_years}年")
-                possible_file = os.path.join(possible_dir, f"{stock_code}_{safe_name}.xlsx")
-                if os.path.exists(possible_file):
-                    found_file = possible_file
-                    found_years = possible_years
-                    break
+            # 先查找现有文件（代码存储目录，以及旧的年限文件夹）
+            found_file, found_years = find_stock_file(stock_code, stock_name)
             
             # 如果找到了现有文件，直接跳过
             if found_file:
                 log_message("INFO", f"股票 {stock_code} 文件已存在，跳过")
                 anti_block_manager.update_success()
+                listing_date, found_years = get_found_file_listing(stock_code, found_years)
                 stock_info = {
                     '股票代码': stock_code,
                     '股票名称': stock_name,
-                    '上市日期': '',  # 暂时留空，避免网络请求
+                    '上市日期': listing_date,
                     '上市年限': found_years,
                     '文件路径': found_file
                 }
@@ -1378,12 +2577,9 @@ def initial_mode():
             listing_date = get_stock_listing_date(stock_code)
             years = calculate_years_since_listing(listing_date)
             
-            # 创建年限文件夹
-            years_dir = os.path.join(DATA_DIR, f"{years}年")
-            ensure_directory(years_dir)
-            
-            # 生成文件路径
-            file_path = os.path.join(years_dir, f"{stock_code}_{safe_name}.xlsx")
+            # 按股票代码固定存放，年限分组由视图提供
+            file_path = get_stock_file_path(stock_code)
+            ensure_directory(os.path.dirname(file_path))
             
             # 获取历史数据（包含智能计算的成交次数）- 获取所有可用历史数据
             hist_data = get_stock_history_data(stock_code)
@@ -1422,39 +2618,283 @@ def initial_mode():
     
     # 保存最终索引文件（虽然每个股票都已经更新，但为了安全起见，再保存一次完整的）
     save_index_file(processed_stocks, INDEX_FILE)
+    refresh_year_views()
     
     # 获取详细统计信息
     progress_info = anti_block_manager.get_progress_info()
     log_message("INFO", f"初始化完成 - 成功: {success_count}, 失败: {failed_count}")
     log_message("INFO", f"网络统计 - 请求: {progress_info['requests']}, 成功: {progress_info['success']}, 失败: {progress_info['failure']}, 成功率: {progress_info['success_rate']:.1f}%")
+    validation_stats.log_summary()
+    write_stats.log_summary()
+    listing_registry.log_summary()
+    end_scheduled_job()
+    log_message("INFO", "可运行 --rebuild-xsection、--resample 和 --rebuild-indicators 生成横截面存储、周线/月线和技术指标，之后的日常更新会自动追加")
     return True
 
-def update_mode():
-    """更新模式 - 多线程并发更新所有股票，批量写入索引文件"""
-    log_message("INFO", "=== 更新模式（多线程） ===")
-    log_message("INFO", "将并发更新所有已归档股票，仅追加最新数据")
-    processed_stocks = load_existing_index(INDEX_FILE)
-    if not processed_stocks:
-        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+def initial_mode_multithread():
+    """初始化模式 - 多线程下载所有可用历史数据，Excel由后台写入线程落盘"""
+    log_message("INFO", "=== 初始化模式 (多线程) ===")
+    log_message("INFO", "将下载A股所有可用历史数据")
+
+    stock_list = get_all_stock_list()
+    if stock_list is None:
         return False
-    stock_items = list(processed_stocks.items())
-    total = len(stock_items)
+
+    stock_infos = stock_list[['股票代码', '股票名称']].to_dict('records')
+    total_stocks = len(stock_infos)
+    max_workers = MULTITHREAD_CONFIG.get('max_workers', 3)
+    log_message("INFO", f"开始处理 {total_stocks} 只股票，线程数: {max_workers}")
+    begin_scheduled_job('backfill', total_stocks)
+    validation_stats.reset()
+    write_stats.reset()
+
+    result_queue = Queue()
+    completed = 0
+    writer = ExcelWriteBehind()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(process_single_stock, stock_info, idx % max_workers, result_queue, writer)
+                       for idx, stock_info in enumerate(stock_infos)]
+            for f in concurrent.futures.as_completed(futures):
+                completed += 1
+                if completed % 20 == 0 or completed == total_stocks:
+                    log_message("INFO", f"进度: {completed}/{total_stocks} ({completed/total_stocks*100:.1f}%)")
+    finally:
+        writer.close()
+
+    processed_stocks = []
+    while not result_queue.empty():
+        result = result_queue.get()
+        processed_stocks.append({
+            '股票代码': result['stock_code'],
+            '股票名称': result['stock_name'],
+            '上市日期': result['listing_date'],
+            '上市年限': result['years'],
+            '文件路径': result['file_path']
+        })
+    if processed_stocks:
+        save_index_file(processed_stocks, INDEX_FILE)
+    refresh_year_views()
+
+    stats = global_stats.get_stats()
+    log_message("INFO", f"初始化完成 - 成功: {stats['success']}, 失败: {stats['failed']}")
+    validation_stats.log_summary()
+    write_stats.log_summary()
+    listing_registry.log_summary()
+    writer.log_metrics()
+    end_scheduled_job()
+    log_message("INFO", "可运行 --rebuild-xsection、--resample 和 --rebuild-indicators 生成横截面存储、周线/月线和技术指标，之后的日常更新会自动追加")
+    return True
+
+def update_single_stock(stock_code, stock_info, result_queue=None, thread_id=0, writer=None):
+    """
+    增量更新单只股票.
+    不复权日线只追加新交易日，复权因子增量更新，再由两者生成前复权Excel.
+    没有本地不复权数据的旧归档首次更新时完整获取一次.
+    新日线在Excel写入成功后才入库：写入失败或进程在写入前退出时，下次运行会重新获取这些交易日.
+    """
+    stock_code = str(stock_code).zfill(6)
+    stock_name = stock_info.get('股票名称') or get_stock_name(stock_code)
+    file_path = stock_info.get('文件路径', '')
+    if not file_path:
+        log_message("WARNING", f"线程{thread_id} 股票 {stock_code} 索引中无文件路径，跳过")
+        global_stats.update_failure()
+        return None
+    try:
+        raw_bars = load_raw_bars(stock_code)
+        raw_last_date = None
+        pending_raw = []
+        replace_raw = False
+        if quarantine_registry.should_refetch(stock_code):
+            log_message("INFO", f"线程{thread_id} 股票 {stock_code} 在隔离列表中，完整重新获取")
+            replace_raw = True
+            hist_data = get_stock_history_data(stock_code, replace_raw=True, pending_raw=pending_raw)
+            full_refresh = True
+        elif raw_bars is None or raw_bars.empty:
+            log_message("INFO", f"线程{thread_id} 股票 {stock_code} 无本地不复权数据，完整获取一次")
+            hist_data = get_stock_history_data(stock_code, pending_raw=pending_raw)
+            full_refresh = True
+        else:
+            today = datetime.now().strftime("%Y%m%d")
+            last_date = raw_last_date = raw_bars['时间'].iloc[-1]
+            factors = load_adjust_factors(stock_code)
+
+            # 从最后一个已存交易日开始请求前复权数据，多出的一根重叠K线用于检测除权除息
+            fetched = fetch_hist_bars(stock_code, last_date.strftime("%Y%m%d"), today, adjust="qfq")
+            if fetched is None:
+                # 请求失败不能当作除权除息或无新数据处理，计为失败，下次运行重试
+                log_message("WARNING", f"线程{thread_id} 股票 {stock_code} 获取新数据失败")
+                global_stats.update_failure()
+                return None
+            new_bars = fetched[fetched['时间'] > last_date]
+            stored_overlap = apply_adjustment(raw_bars.iloc[-1:], factors, "qfq")
+
+            overlap_matched = factors is not None and overlap_bars_match(stored_overlap, fetched)
+            # 比对完成后只保留新K线，重叠比对用的数据尽早释放
+            del fetched, stored_overlap
+
+            if overlap_matched:
+                # 复权因子未变：重叠日之后的前复权价就是不复权价，直接追加
+                refresh_stats.record_incremental()
+                factor_changed = False
+            else:
+                # 复权因子已变（或无法确认）：更新因子表并重新获取不复权的新数据
+                log_message("INFO", f"线程{thread_id} 股票 {stock_code} 重叠K线不一致，可能发生除权除息，完整刷新")
+                refresh_stats.record_full()
+                factors, factor_changed = update_adjust_factors(stock_code)
+                if not new_bars.empty:
+                    start = (last_date + timedelta(days=1)).strftime("%Y%m%d")
+                    new_bars = fetch_hist_bars(stock_code, start, today)
+                    if new_bars is None:
+                        log_message("WARNING", f"线程{thread_id} 股票 {stock_code} 获取不复权新数据失败")
+                        global_stats.update_failure()
+                        return None
+
+            if new_bars.empty and not factor_changed:
+                log_message("INFO", f"线程{thread_id} 股票 {stock_code} 无新数据")
+                global_stats.update_success()
+                return None
+            if not new_bars.empty:
+                # 新数据连同最后一根已存K线一起校验，以便发现日期重复或倒序
+                if not check_ingest_data(stock_code, pd.concat([raw_bars.iloc[-1:], new_bars], ignore_index=True)):
+                    global_stats.update_failure()
+                    return None
+                raw_bars, _ = merge_raw_bars(raw_bars, new_bars)
+                pending_raw.append(new_bars)
+            hist_data = build_export_frame(stock_code, raw_bars, factors)
+            full_refresh = factor_changed
+
+        if hist_data is None or hist_data.empty:
+            log_message("WARNING", f"线程{thread_id} 股票 {stock_code} 无历史数据")
+            global_stats.update_failure()
+            return None
+
+        ensure_directory(os.path.dirname(file_path))
+        result = dict(stock_info)
+        result['股票代码'] = stock_code
+        result['股票名称'] = stock_name
+        # 供重采样等下游存储增量合并：除权后前复权价整体变化，需要整段替换
+        result['new_bars'] = hist_data if full_refresh else hist_data[pd.to_datetime(hist_data['时间']) > raw_last_date]
+        result['full_refresh'] = full_refresh
+        result['new_raw_bars'] = None
+        if raw_last_date is not None:
+            # 横截面存储使用当日实际价格（不复权），成交次数与复权无关，取自导出数据
+            new_raw_bars = raw_bars[raw_bars['时间'] > raw_last_date]
+            trade_counts = pd.Series(hist_data['成交次数'].to_numpy(), index=pd.to_datetime(hist_data['时间']))
+            result['new_raw_bars'] = new_raw_bars.assign(成交次数=new_raw_bars['时间'].map(trade_counts).fillna(0).to_numpy(),
+                                                         名称=stock_name)
+
+        def commit_raw_bars():
+            for bars in pending_raw:
+                save_raw_bars(stock_code, bars, replace=replace_raw)
+
+        result = write_stock_file(file_path, stock_name, hist_data, result, result_queue, writer,
+                                  on_written=commit_raw_bars if pending_raw else None)
+        if result is not None:
+            log_message("INFO", f"线程{thread_id} 股票 {stock_code} 更新完成，数据量: {len(hist_data)}")
+        return result
+    except Exception as e:
+        log_message("ERROR", f"线程{thread_id} 更新股票 {stock_code} 时发生错误: {str(e)}")
+        global_stats.update_failure()
+        return None
+
+def collect_new_bars(updated_list):
+    """把各股票更新结果中的新日线合并为一张长表，返回 (长表, 整段替换的股票代码)"""
+    frames = []
+    full_codes = []
+    for result in updated_list:
+        new_bars = result.get('new_bars')
+        if new_bars is None or new_bars.empty:
+            continue
+        frames.append(new_bars.assign(股票代码=result['股票代码']))
+        if result.get('full_refresh'):
+            full_codes.append(result['股票代码'])
+    if not frames:
+        return None, full_codes
+    new_daily = pd.concat(frames, ignore_index=True)
+    new_daily['时间'] = pd.to_datetime(new_daily['时间'])
+    return new_daily, full_codes
+
+def update_indicator_store(updated_list):
+    """技术指标随更新递推追加；除权后整段替换的股票重建"""
+    counts = {'appended': 0, 'rebuilt': 0, 'skipped': 0}
+    for result in updated_list:
+        new_bars = result.get('new_bars')
+        if new_bars is None or new_bars.empty:
+            continue
+        stock_code = result['股票代码']
+        try:
+            outcome = indicators.update_indicators(INDICATOR_DIR, stock_code, new_bars,
+                                                   full_refresh=result.get('full_refresh', False),
+                                                   load_full_bars=lambda: load_adjusted_bars(stock_code))
+            counts[outcome] += 1
+        except Exception as e:
+            log_message("ERROR", f"股票 {stock_code} 技术指标更新失败: {e}")
+    log_message("INFO", f"技术指标 - 追加: {counts['appended']}, 重建: {counts['rebuilt']}, 跳过: {counts['skipped']}")
+
+def ingest_new_bars(updated_list):
+    """更新完成后，把本次所有股票的新日线一次性合并到下游存储"""
+    raw_frames = [result['new_raw_bars'].assign(股票代码=result['股票代码'])
+                  for result in updated_list
+                  if result.get('new_raw_bars') is not None and not result['new_raw_bars'].empty]
+    if raw_frames:
+        try:
+            days = xsection.append_bars(pd.concat(raw_frames, ignore_index=True), XSECTION_DIR)
+            log_message("INFO", f"横截面存储已追加 {days} 个交易日")
+        except Exception as e:
+            log_message("ERROR", f"横截面存储追加失败: {e}")
+
+    if os.path.isdir(INDICATOR_DIR):
+        update_indicator_store(updated_list)
+
+    new_daily, full_codes = collect_new_bars(updated_list)
+    if new_daily is None:
+        return
+    if os.path.isdir(RESAMPLE_DIR):
+        try:
+            counts = resample.update_resampled(new_daily, RESAMPLE_DIR, full_codes=full_codes)
+            log_message("INFO", f"周线/月线已增量更新: {counts}")
+        except Exception as e:
+            log_message("ERROR", f"周线/月线增量更新失败: {e}")
+    else:
+        log_message("INFO", "未找到周线/月线数据，可运行 --resample 首次生成")
+
+def update_mode(processed_stocks=None):
+    """更新模式 - 多线程并发更新所有股票，批量写入索引文件（常驻模式传入已加载的索引）"""
+    log_message("INFO", "=== 更新模式（多线程） ===")
+    log_message("INFO", "将并发更新所有已归档股票，仅追加最新数据")
+    if processed_stocks is None:
+        processed_stocks = load_index_for_run()
+    if not processed_stocks:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    stock_items = list(processed_stocks.items())
+    total = len(stock_items)
     log_message("INFO", f"共需更新 {total} 只股票")
+    begin_scheduled_job('urgent', total)
+    refresh_stats.reset()
+    validation_stats.reset()
+    write_stats.reset()
     result_queue = Queue()
     max_workers = MULTITHREAD_CONFIG.get('max_workers', 3)
     batch_size = MULTITHREAD_CONFIG.get('batch_size_total', 120)
     completed = 0
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for i in range(0, total, batch_size):
-            batch = stock_items[i:i+batch_size]
-            futures = []
-            for idx, (stock_code, stock_info) in enumerate(batch):
-                thread_id = idx % max_workers
-                futures.append(executor.submit(update_single_stock, stock_code, stock_info, result_queue, thread_id))
-            for f in concurrent.futures.as_completed(futures):
-                completed += 1
-                if completed % 20 == 0 or completed == total:
-                    log_message("INFO", f"进度: {completed}/{total} ({completed/total*100:.1f}%)")
+    # 抓取线程只负责网络请求和计算，Excel由后台写入线程落盘
+    writer = ExcelWriteBehind()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i in range(0, total, batch_size):
+                batch = stock_items[i:i+batch_size]
+                futures = []
+                for idx, (stock_code, stock_info) in enumerate(batch):
+                    thread_id = idx % max_workers
+                    futures.append(executor.submit(update_single_stock, stock_code, stock_info, result_queue, thread_id, writer))
+                for f in concurrent.futures.as_completed(futures):
+                    completed += 1
+                    if completed % 20 == 0 or completed == total:
+                        log_message("INFO", f"进度: {completed}/{total} ({completed/total*100:.1f}%)")
+    finally:
+        writer.close()
     # 收集所有结果，批量写索引
     updated_list = []
     while not result_queue.empty():
@@ -1462,107 +2902,513 @@ def update_mode():
     if updated_list:
         save_index_file(updated_list, INDEX_FILE)
         log_message("INFO", f"索引文件已批量更新，共 {len(updated_list)} 条")
+        ingest_new_bars(updated_list)
+    # 写入后硬链接视图会指向旧文件，跨年后年限也会变化，每次更新后同步视图
+    refresh_year_views()
+    refresh_info = refresh_stats.get_stats()
+    log_message("INFO", f"更新路径统计 - 增量追加: {refresh_info['incremental']}, 除权完整刷新: {refresh_info['full']}")
+    validation_stats.log_summary()
+    write_stats.log_summary()
+    writer.log_metrics()
+    log_message("INFO", f"隔离列表中共 {len(quarantine_registry)} 只股票")
+    end_scheduled_job()
     log_message("INFO", "多线程更新完成")
     return True
 
-# ================== 分类修复功能 ==================
+def update_mode_multithread():
+    """多线程更新模式（更新模式已全面多线程化，保留此入口供菜单和命令行使用）"""
+    return update_mode()
 
-def get_file_actual_date_range(file_path):
-    """获取Excel文件中的实际日期范围"""
-    try:
-        df = pd.read_excel(file_path)
-        if '时间' in df.columns and len(df) > 0:
-            first_date = df['时间'].iloc[0]
-            
-            # 转换为标准日期格式
-            if isinstance(first_date, str):
-                first_date = pd.to_datetime(first_date).date()
-            else:
-                first_date = first_date.date()
-                
-            return first_date, len(df)
-        return None, 0
-    except Exception as e:
-        log_message("WARNING", f"读取文件 {file_path} 失败: {e}")
-        return None, 0
+# ================== 多进程协作 ==================
+
+# 协作工作进程配置
+WORK_QUEUE_CONFIG = {
+    'lease_seconds': 600,  # 任务租约时长（秒），进程崩溃后超过此时间任务被重新分配
+    'max_attempts': 3,  # 每只股票最多尝试次数
+    'rate_per_second': 2.0,  # 所有进程合计的请求速率上限（次/秒）
+    'burst': 4,  # 共享令牌桶允许的突发请求数
+    'flush_every': 50,  # 每完成多少只股票写一次索引
+}
 
-# 使用统一的年限计算函数：calculate_years_since_listing
+def open_work_queue():
+    """打开归档目录下的工作队列"""
+    return work_queue.WorkQueue(WORK_QUEUE_FILE,
+                                lease_seconds=WORK_QUEUE_CONFIG['lease_seconds'],
+                                max_attempts=WORK_QUEUE_CONFIG['max_attempts'])
 
-def create_missing_folders_for_fix(base_dir, fixes_needed):
-    """预先创建所有需要的文件夹"""
-    log_message("INFO", "检查并创建必要的文件夹...")
-    
-    # 收集所有需要的年限文件夹
-    needed_folders = set()
-    for fix in fixes_needed:
-        needed_folders.add(fix['correct_folder'])
-    
-    # 为了完整性，也创建0-35年的所有文件夹（覆盖可能的所有股票年限）
-    for years in range(0, 36):
-        needed_folders.add(f"{years}年")
-    
-    created_count = 0
-    for folder in sorted(needed_folders):
-        folder_path = os.path.join(base_dir, folder)
-        if not os.path.exists(folder_path):
+def get_worker_run_id(kind):
+    """同一天同一类任务的所有工作进程共用一个批次（分片运行时按分片区分）"""
+    run_id = f"{kind}-{datetime.now().strftime('%Y%m%d')}"
+    if SHARD is not None:
+        run_id += f"-shard{SHARD[0]}of{SHARD[1]}"
+    return run_id
+
+def build_worker_tasks(kind):
+    """生成批次的任务列表 [(股票代码, 股票信息)]，失败时返回None"""
+    if kind == 'update':
+        index = load_index_for_run()
+        if not index:
+            log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+            return None
+        return [(code, {h: info.get(h, '') for h in INDEX_HEADERS}) for code, info in index.items()]
+    stock_list = get_all_stock_list()
+    if stock_list is None:
+        return None
+    return [(str(row['股票代码']).zfill(6), {'股票代码': str(row['股票代码']).zfill(6), '股票名称': row['股票名称']})
+            for row in stock_list[['股票代码', '股票名称']].to_dict('records')]
+
+def worker_mode(kind='update'):
+    """
+    协作工作进程（kind: update 日常更新 / init 初始化）.
+    同一归档目录可同时启动任意多个工作进程，各自从工作队列领取股票，不会重复下载；
+    索引在数据库写锁下写出，不会被多个进程同时改写. 所有进程合计的请求速率受共享令牌桶限制.
+    """
+    global SHARED_RATE_LIMITER
+    if kind not in ('update', 'init'):
+        log_message("ERROR", f"未知的任务类型: {kind}（可选 update / init）")
+        return False
+    queue = open_work_queue()
+    SHARED_RATE_LIMITER = work_queue.SharedRateLimiter(queue, rate=WORK_QUEUE_CONFIG['rate_per_second'],
+                                                       burst=WORK_QUEUE_CONFIG['burst'])
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    run_id = get_worker_run_id(kind)
+    log_message("INFO", f"=== 协作工作进程 {worker}，批次 {run_id} ===")
+
+    # 第一个进程负责建立任务；并发建立时重复的任务会被忽略
+    if not queue.has_run(run_id):
+        tasks = build_worker_tasks(kind)
+        if tasks is None:
+            return False
+        log_message("INFO", f"批次 {run_id} 新建 {queue.enqueue(run_id, tasks)} 个任务")
+
+    remaining = queue.counts(run_id)
+    begin_scheduled_job('urgent' if kind == 'update' else 'backfill',
+                        remaining['pending'] + remaining['leased'] + remaining['expired'])
+    refresh_stats.reset()
+    validation_stats.reset()
+    write_stats.reset()
+    updated_list = []
+    processed = 0
+    failed = 0
+    start_time = time.time()
+
+    def write_index(rows):
+        save_index_file(rows, INDEX_FILE)
+
+    while True:
+        claimed = queue.claim(run_id, worker)
+        if not claimed:
+            break
+        stock_code, stock_info = claimed[0]
+        failed_before = global_stats.get_stats()['failed']
+        if kind == 'update':
+            result = update_single_stock(stock_code, stock_info)
+            index_row = None if result is None else {h: result.get(h, '') for h in INDEX_HEADERS}
+        else:
+            result = process_single_stock(stock_info)
+            index_row = None if result is None else {
+                '股票代码': result['stock_code'],
+                '股票名称': result['stock_name'],
+                '上市日期': result['listing_date'],
+                '上市年限': result['years'],
+                '文件路径': result['file_path']
+            }
+        # 返回None可能是失败，也可能是无新数据：按失败计数区分（工作进程内串行处理，计数准确）
+        if result is None and global_stats.get_stats()['failed'] > failed_before:
+            queue.fail(run_id, worker, stock_code)
+            failed += 1
+            continue
+        if not queue.complete(run_id, worker, stock_code, index_row):
+            log_message("WARNING", f"股票 {stock_code} 的租约已过期并被其他进程接管，本次结果不提交")
+            continue
+        processed += 1
+        if kind == 'update' and result is not None:
+            updated_list.append(result)
+        if processed % WORK_QUEUE_CONFIG['flush_every'] == 0:
+            queue.flush_results(run_id, write_index)
+            counts = queue.counts(run_id)
+            log_message("INFO", f"批次进度 - 完成: {counts['done']}, 等待: {counts['pending']}, 进行中: {counts['leased']}, 失败: {counts['failed']}")
+
+    flushed = queue.flush_results(run_id, write_index)
+    # 横截面、周线/月线文件和上市年限视图由多个进程共用，在数据库写锁下更新
+    with queue.exclusive():
+        if updated_list:
+            ingest_new_bars(updated_list)
+        refresh_year_views()
+
+    elapsed = time.time() - start_time
+    counts = queue.counts(run_id)
+    log_message("INFO", f"工作进程完成 - 处理: {processed}, 失败: {failed}, 耗时 {elapsed:.1f} 秒, "
+                        f"{processed / elapsed * 60 if elapsed > 0 else 0:.1f} 只/分钟, 最后写出索引 {flushed} 条")
+    log_message("INFO", f"共享限速 - 请求: {SHARED_RATE_LIMITER.acquired}, 等待令牌: {SHARED_RATE_LIMITER.waited:.1f} 秒")
+    log_message("INFO", f"批次 {run_id} - 完成: {counts['done']}, 等待: {counts['pending']}, "
+                        f"进行中: {counts['leased']}, 租约过期: {counts['expired']}, 失败: {counts['failed']}")
+    validation_stats.log_summary()
+    write_stats.log_summary()
+    end_scheduled_job()
+    queue.close()
+    return True
+
+def queue_status_mode():
+    """显示工作队列中最近批次的状态"""
+    if not os.path.exists(WORK_QUEUE_FILE):
+        log_message("INFO", "工作队列尚未建立")
+        return True
+    queue = open_work_queue()
+    for run_id in queue.runs()[:10]:
+        counts = queue.counts(run_id)
+        log_message("INFO", f"批次 {run_id} - 完成: {counts['done']}, 等待: {counts['pending']}, "
+                            f"进行中: {counts['leased']}, 租约过期: {counts['expired']}, 失败: {counts['failed']}")
+    queue.close()
+    return True
+
+# ================== 常驻模式 ==================
+
+# 常驻模式配置
+DAEMON_CONFIG = {
+    'market_close': '15:00',  # 收盘时间（计算数据就绪耗时的起点）
+    'run_after': '15:30',  # 交易日此时间之后开始增量更新（等待数据源完成收盘数据）
+    'poll_interval': 60,  # 空闲时检查间隔（秒），同时刷新状态文件
+    'retry_interval': 1800,  # 更新失败后重试间隔（秒）
+    'max_runs_per_day': 3,  # 每个交易日最多尝试次数
+    'history_size': 30,  # 状态文件中保留的历史运行记录数
+}
+
+def parse_clock(value):
+    """'HH:MM' 转为 time 对象"""
+    hour, minute = value.split(':')
+    return datetime.strptime(f"{int(hour):02d}:{int(minute):02d}", "%H:%M").time()
+
+class DaemonState:
+    """
+    常驻进程的热状态：索引（含文件路径）、股票名称缓存和交易日历（HTTP连接池为 HTTP_SESSION_POOL），
+    跨多次更新保留在内存中，只在索引文件被修改后重新加载.
+    """
+    def __init__(self):
+        self.index = {}
+        self.index_mtime = None
+        self.trade_days = set()
+        self.trade_days_last = None
+        self.calendar_checked_on = None
+        self.history = []
+        self.last_success_date = None
+        self.runs_today = 0
+        self.runs_date = None
+        self.next_retry = None
+        self.state = 'starting'
+        self.started = datetime.now()
+
+    def refresh_index(self):
+        """索引文件变化时重新加载索引和名称缓存"""
+        mtime = os.path.getmtime(INDEX_FILE) if os.path.exists(INDEX_FILE) else None
+        if self.index and mtime == self.index_mtime:
+            return
+        self.index = load_index_for_run()
+        self.index_mtime = os.path.getmtime(INDEX_FILE) if os.path.exists(INDEX_FILE) else None
+        STOCK_NAME_CACHE.update({code: info.get('股票名称', '') for code, info in self.index.items() if info.get('股票名称')})
+        log_message("INFO", f"已加载索引: {len(self.index)} 只股票")
+
+    def is_trading_day(self, day):
+        """
+        是否交易日：优先使用交易日历（包含接口返回的全部年份），日历未覆盖该日时刷新，
+        每天最多请求一次（失败也不重复请求）；日历覆盖不到的日期按工作日判断.
+        """
+        if ((self.trade_days_last is None or day > self.trade_days_last)
+                and self.calendar_checked_on != date.today() and AKSHARE_AVAILABLE):
+            self.calendar_checked_on = date.today()
             try:
-                os.makedirs(folder_path, exist_ok=True)
-                log_message("INFO", f"创建文件夹: {folder}")
-                created_count += 1
+                calendar = safe_request_with_retry(call_akshare, 'tool_trade_date_hist_sina', max_retries=3)
+                if calendar is not None and not calendar.empty:
+                    self.trade_days = set(pd.to_datetime(calendar['trade_date']).dt.date)
+                    self.trade_days_last = max(self.trade_days)
+                    log_message("INFO", f"交易日历已更新，共 {len(self.trade_days)} 天，至 {self.trade_days_last}")
             except Exception as e:
-                log_message("ERROR", f"创建文件夹 {folder} 失败: {e}")
-    
-    if created_count > 0:
-        log_message("INFO", f"共创建了 {created_count} 个新文件夹")
-    else:
-        log_message("INFO", "所有必要的文件夹都已存在")
+                log_message("WARNING", f"获取交易日历失败，按工作日判断: {e}")
+        if self.trade_days_last is not None and self.trade_days_last >= day:
+            return day in self.trade_days
+        return day.weekday() < 5
 
-def execute_classification_fixes(base_dir, fixes_needed):
-    """执行文件修复"""
-    # 先创建所有需要的文件夹
-    create_missing_folders_for_fix(base_dir, fixes_needed)
-    
-    log_message("INFO", "开始执行文件移动...")
-    
-    success_count = 0
-    error_count = 0
-    
-    for fix in fixes_needed:
+    def runs_exhausted(self, day):
+        """当天的尝试次数是否已用完"""
+        return self.runs_date == day and self.runs_today >= DAEMON_CONFIG['max_runs_per_day']
+
+    def next_run_time(self, now):
+        """下一次计划更新的时间"""
+        run_after = parse_clock(DAEMON_CONFIG['run_after'])
+        day = now.date()
+        done_today = self.last_success_date == day or self.runs_exhausted(day)
+        if not done_today and self.next_retry is not None and self.next_retry.date() == day:
+            return self.next_retry
+        if done_today:
+            day += timedelta(days=1)
+        for _ in range(30):
+            if self.is_trading_day(day):
+                break
+            day += timedelta(days=1)
+        return datetime.combine(day, run_after)
+
+    def write_status(self, now=None):
+        """写出状态文件（先写临时文件再替换，读取方不会读到半个文件）"""
+        now = now or datetime.now()
+        fresh = [run['time_to_fresh'] for run in self.history if run.get('success') and run.get('time_to_fresh') is not None]
+        status = {
+            'pid': os.getpid(),
+            'state': self.state,
+            'started': self.started.strftime("%Y-%m-%d %H:%M:%S"),
+            'heartbeat': now.strftime("%Y-%m-%d %H:%M:%S"),
+            'stocks': len(self.index),
+            'last_success_date': self.last_success_date.isoformat() if self.last_success_date else None,
+            'next_run': self.next_run_time(now).strftime("%Y-%m-%d %H:%M:%S"),
+            'time_to_fresh': {
+                'last': fresh[-1] if fresh else None,
+                'median': float(np.median(fresh)) if fresh else None,
+                'max': max(fresh) if fresh else None,
+            },
+            'history': self.history[-DAEMON_CONFIG['history_size']:],
+        }
         try:
-            # 目标文件夹路径（现在应该已经存在了）
-            target_dir = os.path.join(base_dir, fix['correct_folder'])
-            
-            # 目标文件路径
-            target_path = os.path.join(target_dir, fix['filename'])
-            
-            # 如果目标已存在，添加序号
-            if os.path.exists(target_path):
-                name, ext = os.path.splitext(fix['filename'])
-                counter = 1
-                while os.path.exists(target_path):
-                    target_path = os.path.join(target_dir, f"{name}_重复{counter}{ext}")
-                    counter += 1
-                log_message("WARNING", f"目标文件已存在，重命名为: {os.path.basename(target_path)}")
-            
-            # 移动文件
-            shutil.move(fix['current_path'], target_path)
-            log_message("INFO", f"✅ {fix['filename']}: {fix['current_folder']} → {fix['correct_folder']}")
-            success_count += 1
-            
+            write_json_atomic(status, DAEMON_STATUS_FILE)
         except Exception as e:
-            log_message("ERROR", f"❌ {fix['filename']}: 移动失败 - {e}")
-            error_count += 1
-    
-    log_message("INFO", f"修复完成: 成功 {success_count}, 失败 {error_count}")
-    
-    if success_count > 0:
-        log_message("INFO", "建议:")
-        log_message("INFO", "  1. 检查修复后的文件是否正确")
-        log_message("INFO", "  2. 重新运行主程序时，会自动跳过已存在的文件")
-        log_message("INFO", "  3. 如有问题，可手动调整文件位置")
+            log_message("WARNING", f"写入状态文件失败: {e}")
+
+    def run_update(self, now):
+        """执行一次增量更新并记录数据就绪耗时（收盘到更新完成的秒数）"""
+        if self.runs_date != now.date():
+            self.runs_date = now.date()
+            self.runs_today = 0
+        self.runs_today += 1
+        self.state = 'running'
+        self.write_status(now)
+        # 前一天失败的股票不应影响今天的更新
+        anti_block_manager.failed_stocks.clear()
+        REQUEST_COALESCER.clear()
+        self.refresh_index()
+
+        before = global_stats.get_stats()
+        start = time.time()
+        try:
+            success = bool(self.index) and update_mode(dict(self.index))
+        except Exception as e:
+            log_message("ERROR", f"常驻模式更新出错: {e}")
+            success = False
+        after = global_stats.get_stats()
+        finished = datetime.now()
+        log_message("INFO", REQUEST_COALESCER.summary_text())
+
+        close_time = datetime.combine(now.date(), parse_clock(DAEMON_CONFIG['market_close']))
+        record = {
+            'date': now.date().isoformat(),
+            'start': now.strftime("%H:%M:%S"),
+            'end': finished.strftime("%H:%M:%S"),
+            'duration': round(time.time() - start, 1),
+            'success': success,
+            'succeeded': after['success'] - before['success'],
+            'failed': after['failed'] - before['failed'],
+            'time_to_fresh': round((finished - close_time).total_seconds(), 1) if success else None,
+        }
+        self.history.append(record)
+        self.history = self.history[-DAEMON_CONFIG['history_size']:]
+        if success:
+            self.last_success_date = now.date()
+            self.next_retry = None
+            log_message("INFO", f"收盘后 {record['time_to_fresh'] / 60:.1f} 分钟数据就绪（更新耗时 {record['duration']:.0f} 秒）")
+        else:
+            self.next_retry = finished + timedelta(seconds=DAEMON_CONFIG['retry_interval'])
+            log_message("WARNING", f"更新失败，{DAEMON_CONFIG['retry_interval'] // 60} 分钟后重试")
+        self.refresh_index()
+        self.state = 'idle'
+        self.write_status()
+
+def daemon_mode():
+    """
+    常驻模式：进程保持运行，索引、名称缓存、交易日历和HTTP连接池常驻内存，
+    每个交易日收盘后自动执行增量更新；运行状态和收盘到数据就绪的耗时写入 daemon_status.json.
+    """
+    log_message("INFO", "=== 常驻模式 ===")
+    log_message("INFO", f"交易日 {DAEMON_CONFIG['run_after']} 后自动更新，状态文件: {DAEMON_STATUS_FILE}")
+    if not AKSHARE_AVAILABLE:
+        log_message("ERROR", "akshare不可用，无法运行常驻模式")
+        return False
+    switch_to_optimized_mode()
+    state = DaemonState()
+    HTTP_SESSION_POOL.install()
+    state.refresh_index()
+    if not state.index:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    run_after = parse_clock(DAEMON_CONFIG['run_after'])
+    state.state = 'idle'
+    try:
+        while True:
+            now = datetime.now()
+            due = (state.is_trading_day(now.date()) and now.time() >= run_after
+                   and state.last_success_date != now.date() and not state.runs_exhausted(now.date())
+                   and (state.next_retry is None or now >= state.next_retry))
+            if due:
+                state.run_update(now)
+                continue
+            state.write_status(now)
+            wait = (state.next_run_time(now) - now).total_seconds()
+            time.sleep(max(1, min(DAEMON_CONFIG['poll_interval'], wait)))
+    except KeyboardInterrupt:
+        log_message("INFO", "常驻模式已退出")
+        state.state = 'stopped'
+        state.write_status()
+    return True
+
+# ================== 分类修复功能 ==================
+
+# 分类修复时并发移动文件的线程数（同一磁盘内重命名，不复制数据）
+FIX_MOVE_WORKERS = 8
+
+def scan_legacy_year_files(base_dir, store_codes):
+    """
+    列出仍按年限文件夹存放的归档文件（只列目录，不打开文件），代码存储中已有的股票（视图链接）跳过.
+    返回 DataFrame: 股票代码、文件名、当前文件夹、当前路径
+    """
+    rows = []
+    for year_folder in os.listdir(base_dir):
+        year_path = os.path.join(base_dir, year_folder)
+        if not year_folder.endswith('年') or not year_folder[:-1].isdigit() or not os.path.isdir(year_path):
+            continue
+        for filename in os.listdir(year_path):
+            if filename.endswith('.xlsx') and not filename.startswith('~$') and filename[:6] not in store_codes:
+                rows.append((filename[:6], filename, year_folder, os.path.join(year_path, filename)))
+    return pd.DataFrame(rows, columns=['股票代码', '文件名', '当前文件夹', '当前路径'])
+
+def resolve_missing_listing_dates(codes, paths):
+    """
+    索引中没有上市日期的股票：先查上市日期登记表，仍没有时才读取文件的第一个交易日（多进程）.
+    返回 {股票代码: 上市日期字符串}
+    """
+    resolved = {}
+    to_read = []
+    for code, path in zip(codes, paths):
+        listing_date = listing_registry.get(code)
+        if listing_date:
+            resolved[code] = listing_date
+        else:
+            to_read.append((code, path))
+    if to_read:
+        log_message("INFO", f"{len(to_read)} 只股票缺少上市日期，读取文件第一行确定")
+        for code, (first_date, _) in panel.read_first_bars(dict(to_read)).items():
+            if first_date is not None:
+                resolved[code] = first_date.strftime('%Y-%m-%d')
+    return resolved
+
+def plan_classification_fixes(base_dir, index, store_codes):
+    """
+    由索引一次计算所有旧文件的目标年限文件夹，返回 (移动计划, 索引更新).
+    移动计划: [{'code', 'src', 'dst', 'from', 'to', 'listing_date'}]；
+    索引更新: 位置正确但索引路径、年限或上市日期需要修正的记录.
+    """
+    files = scan_legacy_year_files(base_dir, store_codes)
+    if files.empty:
+        return [], []
+    files['上市日期'] = files['股票代码'].map(lambda code: index.get(code, {}).get('上市日期', '')).fillna('')
+    missing = files['上市日期'] == ''
+    if missing.any():
+        resolved = resolve_missing_listing_dates(files.loc[missing, '股票代码'], files.loc[missing, '当前路径'])
+        files.loc[missing, '上市日期'] = files.loc[missing, '股票代码'].map(resolved).fillna('')
+
+    # 与 calculate_years_since_listing 相同：只按自然年计算，未来日期为0年
+    listing_year = pd.to_datetime(files['上市日期'], errors='coerce').dt.year
+    files['目标年限'] = (date.today().year - listing_year).clip(lower=0)
+    unknown = files['目标年限'].isna()
+    if unknown.any():
+        log_message("WARNING", f"{int(unknown.sum())} 个文件无法确定上市日期，保持原位置")
+    files = files[~unknown].copy()
+    files['目标文件夹'] = files['目标年限'].astype(int).astype(str) + '年'
+
+    moves = []
+    index_updates = []
+    planned_targets = set()
+    for row in files.itertuples(index=False):
+        info = index.get(row.股票代码, {})
+        entry = {
+            '股票代码': row.股票代码,
+            '股票名称': info.get('股票名称') or row.文件名[7:-5],
+            '上市日期': row.上市日期,
+            '上市年限': int(row.目标年限),
+            '文件路径': row.当前路径,
+        }
+        if row.目标文件夹 == row.当前文件夹:
+            if any(str(info.get(key, '')) != str(entry[key]) for key in ('上市日期', '上市年限', '文件路径')):
+                index_updates.append(entry)
+            continue
+        target_dir = os.path.join(base_dir, row.目标文件夹)
+        dst = os.path.join(target_dir, row.文件名)
+        # 目标已存在（或已被本次计划占用）时添加序号
+        counter = 1
+        name, ext = os.path.splitext(row.文件名)
+        while dst in planned_targets or os.path.exists(dst):
+            dst = os.path.join(target_dir, f"{name}_重复{counter}{ext}")
+            counter += 1
+        planned_targets.add(dst)
+        entry['文件路径'] = dst
+        moves.append({'src': row.当前路径, 'dst': dst, 'from': row.当前文件夹, 'to': row.目标文件夹, 'entry': entry})
+    return moves, index_updates
+
+def write_fix_journal(moves, index_updates):
+    """先把移动计划写入日志文件，中断后可继续执行"""
+    write_json_atomic({'moves': moves, 'index_updates': index_updates}, FIX_JOURNAL_FILE, indent=None)
+
+def _apply_move(move):
+    """执行一个移动（os.replace）. 源文件已不存在而目标存在时视为上次已完成. 返回是否成功"""
+    src, dst = move['src'], move['dst']
+    if not os.path.exists(src) and os.path.exists(dst):
+        return True
+    try:
+        os.replace(src, dst)
+        return True
+    except OSError as e:
+        log_message("ERROR", f"❌ {os.path.basename(src)}: 移动失败 - {e}")
+        return False
+
+def execute_classification_fixes(moves, index_updates):
+    """
+    按计划并发移动文件（只创建需要的文件夹），再一次性更新索引，最后删除移动计划.
+    返回 (成功数, 失败数)
+    """
+    write_fix_journal(moves, index_updates)
+    for folder in sorted({os.path.dirname(move['dst']) for move in moves}):
+        ensure_directory(folder)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=FIX_MOVE_WORKERS) as executor:
+        results = list(executor.map(_apply_move, moves))
+    success_count = sum(results)
+    elapsed = time.time() - start_time
+    log_message("INFO", f"文件移动完成: 成功 {success_count}, 失败 {len(moves) - success_count}, 耗时 {elapsed:.2f} 秒")
+
+    # 移动成功的文件和需要修正的记录一次写入索引；失败的文件保持原索引记录
+    updates = [move['entry'] for move, ok in zip(moves, results) if ok] + index_updates
+    if updates:
+        save_index_file(updates, INDEX_FILE)
+        log_message("INFO", f"索引已更新 {len(updates)} 条记录")
+    os.remove(FIX_JOURNAL_FILE)
+    return success_count, len(moves) - success_count
+
+def resume_classification_fixes():
+    """上次分类修复在移动过程中中断时，按保存的计划继续执行"""
+    if not os.path.exists(FIX_JOURNAL_FILE):
+        return False
+    try:
+        with open(FIX_JOURNAL_FILE, 'r', encoding='utf-8') as f:
+            journal = json.load(f)
+    except Exception as e:
+        log_message("WARNING", f"读取上次的分类修复计划失败，重新规划: {e}")
+        os.remove(FIX_JOURNAL_FILE)
+        return False
+    log_message("INFO", f"发现上次未完成的分类修复（{len(journal['moves'])} 个移动），继续执行")
+    execute_classification_fixes(journal['moves'], journal['index_updates'])
+    return True
 
 def classification_fix_mode():
-    """分类修复模式"""
+    """
+    分类修复模式：由索引中的上市日期一次算出每个文件应在的年限文件夹（缺少上市日期时才读取文件），
+    规划全部移动后并发执行，并在同一次操作中更新索引.
+    """
     log_message("INFO", "启动分类修复模式")
     
     base_dir = DATA_DIR
@@ -1570,83 +3416,43 @@ def classification_fix_mode():
     if not os.path.exists(base_dir):
         log_message("ERROR", f"目录不存在: {base_dir}")
         return False
-    
-    log_message("INFO", "开始扫描错误分类的文件...")
-    print("=" * 80)
-    
-    fixes_needed = []
-    total_files = 0
-    
-    # 遍历所有年限文件夹
-    for year_folder in os.listdir(base_dir):
-        year_path = os.path.join(base_dir, year_folder)
-        if not os.path.isdir(year_path) or not year_folder.endswith('年'):
-            continue
-            
-        current_year_label = int(year_folder.replace('年', ''))
-        log_message("INFO", f"📁 检查 {year_folder} 文件夹...")
-        
-        # 检查该文件夹中的每个文件
-        for filename in os.listdir(year_path):
-            if not filename.endswith('.xlsx'):
-                continue
-                
-            file_path = os.path.join(year_path, filename)
-            total_files += 1
-            
-            # 获取文件实际日期范围
-            first_date, row_count = get_file_actual_date_range(file_path)
-            
-            if first_date is None:
-                log_message("WARNING", f"  ⚠️  {filename}: 无法读取日期")
-                continue
-            
-            # 计算正确年限
-            correct_years = calculate_years_since_listing(first_date)
-            
-            # 检查是否分类错误
-            if correct_years != current_year_label:
-                file_size = os.path.getsize(file_path)
-                fixes_needed.append({
-                    'filename': filename,
-                    'current_folder': year_folder,
-                    'current_path': file_path,
-                    'actual_listing_date': first_date,
-                    'correct_years': correct_years,
-                    'correct_folder': f"{correct_years}年",
-                    'row_count': row_count,
-                    'file_size': file_size
-                })
-                
-                status = "🚨 错误分类" if file_size < 50000 else "📊 需要移动"
-                log_message("INFO", f"  {status} {filename}: {first_date} → 应该是{correct_years}年 (数据{row_count}行, {file_size/1024:.1f}KB)")
-            else:
-                if row_count < 100:  # 数据较少的文件也提示
-                    log_message("INFO", f"  ✅ {filename}: {first_date}, {correct_years}年 (数据{row_count}行) - 分类正确但数据较少")
-    
-    print("=" * 80)
-    log_message("INFO", f"📊 扫描完成:")
-    log_message("INFO", f"  总文件数: {total_files}")
-    log_message("INFO", f"  需要修复: {len(fixes_needed)}")
-    
-    if not fixes_needed:
+
+    resume_classification_fixes()
+
+    # 代码存储中的股票只需重建年限视图，下面只检查仍按年限存放的旧文件
+    refresh_year_views()
+    store_codes = set(layout.scan_store(STORE_DIR))
+
+    log_message("INFO", "开始计算各文件的正确年限...")
+    start_time = time.time()
+    index = load_existing_index(INDEX_FILE)
+    moves, index_updates = plan_classification_fixes(base_dir, index, store_codes)
+    log_message("INFO", f"📊 规划完成（{time.time() - start_time:.2f} 秒）: 需要移动 {len(moves)} 个文件，"
+                        f"需要修正索引 {len(index_updates)} 条")
+
+    if not moves and not index_updates:
         log_message("INFO", "🎉 所有文件分类正确！")
         return True
-    
-    # 显示修复列表
-    print(f"\n📋 需要修复的文件:")
-    print("-" * 100)
-    print(f"{'文件名':<30} {'当前位置':<8} {'实际上市':<12} {'正确位置':<8} {'数据行数':<8} {'文件大小'}")
-    print("-" * 100)
-    
-    for fix in fixes_needed:
-        print(f"{fix['filename']:<30} {fix['current_folder']:<8} {fix['actual_listing_date']:<12} {fix['correct_folder']:<8} {fix['row_count']:<8} {fix['file_size']/1024:.1f}KB")
-    
-    # 自动执行修复
+
+    if moves:
+        print(f"\n📋 需要修复的文件（前20个）:")
+        print("-" * 80)
+        print(f"{'文件名':<30} {'当前位置':<8} {'上市日期':<12} {'正确位置':<8}")
+        print("-" * 80)
+        for move in moves[:20]:
+            print(f"{os.path.basename(move['src']):<30} {move['from']:<8} {move['entry']['上市日期']:<12} {move['to']:<8}")
+        if len(moves) > 20:
+            print(f"... 以及其他 {len(moves) - 20} 个文件")
+
     print(f"\n🔧 开始执行自动修复...")
-    execute_classification_fixes(base_dir, fixes_needed)
+    execute_classification_fixes(moves, index_updates)
     return True
 
+def wait_for_exit():
+    """交互运行时等待按键再退出；由计划任务等非交互方式运行时直接退出，不阻塞"""
+    if sys.stdin is not None and sys.stdin.isatty():
+        input("按任意键退出...")
+
 def main():
     """主函数"""
     print("=" * 60)
@@ -1659,7 +3465,7 @@ def main():
         print("程序需要akshare库来获取股票数据")
         print("请检查网络连接或重新安装依赖")
         print("=" * 60)
-        input("按任意键退出...")
+        wait_for_exit()
         return False
     
     # 检查数据源状态
@@ -1745,9 +3551,263 @@ def main():
     print(f"程序运行完成，耗时: {duration}")
     print("=" * 60)
     
-    input("按任意键退出...")
+    wait_for_exit()
     return True
 
+def resample_mode():
+    """由归档的日线Excel重建全部周线/月线"""
+    log_message("INFO", "=== 周线/月线重建 ===")
+    index = load_existing_index(INDEX_FILE)
+    if not index:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    file_map = {code: info.get('文件路径', '') for code, info in index.items()}
+    start_time = time.time()
+    daily = resample.load_archive_frame(file_map, cache_dir=PANEL_CACHE_DIR)
+    log_message("INFO", f"已读取 {daily['股票代码'].nunique() if not daily.empty else 0} 只股票共 {len(daily)} 条日线，耗时 {time.time() - start_time:.1f} 秒")
+    counts = resample.rebuild_resampled(daily, RESAMPLE_DIR)
+    log_message("INFO", f"周线/月线已重建: {counts}，保存位置: {RESAMPLE_DIR}，总耗时 {time.time() - start_time:.1f} 秒")
+    return True
+
+def xsection_rebuild_mode():
+    """由按股票存储的归档并行重建横截面（按交易日）存储"""
+    log_message("INFO", "=== 横截面存储重建 ===")
+    index = load_existing_index(INDEX_FILE)
+    if not index:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    file_map = {code: info.get('文件路径', '') for code, info in index.items()}
+    start_time = time.time()
+    stats = xsection.rebuild_xsection(file_map, XSECTION_DIR, raw_dir=RAW_DIR, cache_dir=PANEL_CACHE_DIR)
+    log_message("INFO", f"横截面存储已重建: {stats['stocks']} 只股票（其中 {stats['raw_stocks']} 只使用不复权数据），"
+                        f"{stats['rows']} 条日线，{stats['days']} 个交易日，失败 {stats['failed']}，"
+                        f"耗时 {time.time() - start_time:.1f} 秒")
+    if stats['raw_stocks'] < stats['stocks']:
+        log_message("WARNING", "部分股票没有不复权数据，横截面中使用了归档中的前复权价格，完成一次更新后可重新重建")
+    return True
+
+def _split_path(path):
+    """拆分路径（兼容其他系统写入的分隔符）"""
+    return [part for part in re.split(r'[\\/]', str(path)) if part]
+
+def copy_file_atomic(src, dst):
+    """复制文件（先复制为临时文件再替换），目标与源大小和修改时间都相同时跳过. 返回是否复制"""
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return False
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+            return False
+    ensure_directory(os.path.dirname(dst))
+    tmp_path = f"{dst}.tmp"
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+    return True
+
+def merge_shards_mode(shard_roots):
+    """
+    合并各机器分片运行的结果: shard_roots 为各分片的归档根目录（从各机器拷贝回来的目录）.
+    归档Excel按 年限文件夹/文件名 合并到 DATA_DIR，不复权数据和复权因子一并合并，
+    各分片索引合并为完整索引 stock_index.csv.
+    """
+    log_message("INFO", "=== 合并分片 ===")
+    if not shard_roots:
+        log_message("ERROR", "请指定各分片的归档根目录，如: --merge-shards D:\\shard0 D:\\shard1")
+        return False
+
+    data_folder = os.path.basename(DATA_DIR)
+    store_folder = os.path.basename(STORE_DIR)
+    raw_folder = os.path.basename(RAW_DIR)
+    factor_folder = os.path.basename(FACTOR_DIR)
+    canonical_index = load_existing_index(FULL_INDEX_FILE)
+    merged = {}
+    merged_mtime = {}
+    stats = {'stocks': 0, 'copied': 0, 'missing': 0, 'conflicts': 0, 'foreign': 0}
+    start_time = time.time()
+
+    for root in shard_roots:
+        if not os.path.isdir(root):
+            log_message("ERROR", f"分片目录不存在: {root}")
+            return False
+        index_files = sorted(name for name in os.listdir(root) if SHARD_INDEX_PATTERN.match(name))
+        if not index_files and os.path.exists(os.path.join(root, "stock_index.csv")):
+            index_files = ["stock_index.csv"]
+        if not index_files:
+            log_message("WARNING", f"分片目录中没有索引文件，跳过: {root}")
+            continue
+
+        for index_name in index_files:
+            match = SHARD_INDEX_PATTERN.match(index_name)
+            shard = (int(match.group(1)), int(match.group(2))) if match else None
+            shard_index = load_existing_index(os.path.join(root, index_name))
+            log_message("INFO", f"读取 {os.path.join(root, index_name)}: {len(shard_index)} 只股票")
+
+            for stock_code, info in shard_index.items():
+                if shard is not None and get_stock_shard(stock_code, shard[1]) != shard[0]:
+                    stats['foreign'] += 1
+                parts = _split_path(info.get('文件路径', ''))
+                if len(parts) < 2:
+                    stats['missing'] += 1
+                    continue
+                if len(parts) >= 3 and parts[-3] == store_folder:
+                    # 按代码存储的文件
+                    src = os.path.join(root, store_folder, parts[-2], parts[-1])
+                    dst = get_stock_file_path(stock_code)
+                else:
+                    years_folder, file_name = parts[-2], parts[-1]
+                    src = os.path.join(root, data_folder, years_folder, file_name)
+                    dst = os.path.join(DATA_DIR, years_folder, file_name)
+                if not os.path.exists(src):
+                    log_message("WARNING", f"分片中找不到文件: {src}")
+                    stats['missing'] += 1
+                    continue
+
+                # 同一股票出现在多个分片时（分片数变更过），保留较新的文件
+                src_mtime = os.path.getmtime(src)
+                if stock_code in merged:
+                    stats['conflicts'] += 1
+                    if src_mtime <= merged_mtime[stock_code]:
+                        continue
+
+                stats['copied'] += int(copy_file_atomic(src, dst))
+                for folder, dst_path in ((raw_folder, get_raw_bars_path(stock_code)),
+                                         (factor_folder, get_factor_path(stock_code))):
+                    store_src = os.path.join(root, folder, f"{stock_code}.pkl")
+                    if os.path.exists(store_src):
+                        copy_file_atomic(store_src, dst_path)
+
+                # 股票在其他年限文件夹中的旧文件（已重新分类）删除，保持每只股票只有一个文件
+                old_path = canonical_index.get(stock_code, {}).get('文件路径', '')
+                if old_path and os.path.exists(old_path) and os.path.abspath(old_path) != os.path.abspath(dst) \
+                        and (os.path.abspath(old_path).startswith(os.path.abspath(DATA_DIR))
+                             or layout.is_store_path(old_path, STORE_DIR)):
+                    os.remove(old_path)
+
+                entry = dict(info)
+                entry['文件路径'] = dst
+                merged[stock_code] = entry
+                merged_mtime[stock_code] = src_mtime
+
+        quarantine_path = os.path.join(root, os.path.basename(QUARANTINE_FILE))
+        if os.path.exists(quarantine_path) and os.path.abspath(quarantine_path) != os.path.abspath(QUARANTINE_FILE):
+            try:
+                with open(quarantine_path, 'r', encoding='utf-8') as f:
+                    quarantine_registry.merge(json.load(f))
+            except Exception as e:
+                log_message("WARNING", f"合并隔离记录失败 {quarantine_path}: {e}")
+
+    stats['stocks'] = len(merged)
+    if merged:
+        save_index_file(list(merged.values()), FULL_INDEX_FILE)
+        refresh_year_views(FULL_INDEX_FILE)
+    log_message("INFO", f"合并完成 - 股票: {stats['stocks']}, 复制文件: {stats['copied']}, 缺失: {stats['missing']}, "
+                        f"重复: {stats['conflicts']}, 不属于所在分片: {stats['foreign']}, 耗时 {time.time() - start_time:.1f} 秒")
+    log_message("INFO", f"完整索引: {FULL_INDEX_FILE}，可运行 --rebuild-xsection 和 --resample 重建横截面和周线/月线")
+    return True
+
+def indicator_rebuild_mode():
+    """由归档的日线Excel向量化重建全部股票的技术指标"""
+    log_message("INFO", "=== 技术指标重建 ===")
+    index = load_existing_index(INDEX_FILE)
+    if not index:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    file_map = {code: info.get('文件路径', '') for code, info in index.items()}
+    start_time = time.time()
+    closes = panel.read_many(file_map, fields=('收盘价',), cache_dir=PANEL_CACHE_DIR)
+    if closes.empty:
+        log_message("ERROR", "未读取到任何日线数据")
+        return False
+    stocks = 0
+    for stock_code, bars in closes.groupby('股票代码', sort=False):
+        indicators.save_indicators(INDICATOR_DIR, stock_code, indicators.rebuild(bars.reset_index(drop=True)))
+        stocks += 1
+    log_message("INFO", f"技术指标已重建: {stocks} 只股票，保存位置: {INDICATOR_DIR}，耗时 {time.time() - start_time:.1f} 秒")
+    return True
+
+# ================== 成交次数重算 ==================
+
+# 成交次数在Excel中的列号（从1开始）
+TRADE_COUNT_COLUMN = EXCEL_HEADERS.index('成交次数') + 1
+
+def is_trade_count_stale(file_path):
+    """文件的成交次数是否由旧版本算法（或未记录版本的程序）计算"""
+    return read_file_stamps(file_path).get('trade_count_algo') != str(TRADE_COUNT_ALGO_VERSION)
+
+def recompute_trade_count_file(file_path):
+    """
+    进程池任务：按当前算法重算一个归档文件的成交次数，只改写成交次数一列，不联网.
+    标记随文件一起原子替换，中断后重新运行会跳过已完成的文件. 返回 (文件路径, 状态, 改变的行数)
+    """
+    if not is_trade_count_stale(file_path):
+        return file_path, 'current', 0
+    wb = load_workbook(file_path)
+    ws = wb['Sheet1'] if 'Sheet1' in wb.sheetnames else wb.active
+    rows = [row[:len(EXCEL_HEADERS)] for row in ws.iter_rows(min_row=2, values_only=True) if row and row[0] is not None]
+    data = pd.DataFrame(rows, columns=EXCEL_HEADERS)
+    # Excel中涨幅、振幅以百分比格式存储，算法使用百分数
+    for col in ('涨幅', '振幅'):
+        data[col] = pd.to_numeric(data[col], errors='coerce') * 100
+
+    counts = np.asarray(calculate_trade_count_enhanced(data), dtype=np.int64)
+    old_counts = pd.to_numeric(data['成交次数'], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    changed = int(np.count_nonzero(old_counts != counts))
+    for row_idx, count in enumerate(counts, 2):
+        ws.cell(row=row_idx, column=TRADE_COUNT_COLUMN, value=int(count))
+
+    stock_name = data['名称'].iloc[-1] if len(data) else ''
+    data['成交次数'] = counts
+    stamps = read_file_stamps(file_path)
+    # 百分比读回后可能有浮点误差，哈希不一致只会让下次更新多写一次文件
+    stamps['content_hash'] = compute_content_hash(data, stock_name)
+    stamps['trade_count_algo'] = str(TRADE_COUNT_ALGO_VERSION)
+    wb.properties.keywords = format_file_stamps(stamps)
+
+    tmp_path = get_temp_path(file_path)
+    wb.save(tmp_path)
+    fsync_file(tmp_path)
+    os.replace(tmp_path, file_path)
+    return file_path, 'recomputed', changed
+
+def recompute_trade_count_mode(max_workers=None):
+    """
+    按当前算法版本重算归档中所有旧版本文件的成交次数（多进程，不联网，可中断后继续）.
+    """
+    log_message("INFO", f"=== 成交次数重算（算法版本 {TRADE_COUNT_ALGO_VERSION}）===")
+    index = load_existing_index(INDEX_FILE)
+    if not index:
+        log_message("ERROR", "未找到索引文件，请先运行初始化模式")
+        return False
+    paths = [info.get('文件路径', '') for info in index.values()]
+    paths = [path for path in paths if path and os.path.exists(path)]
+    stale = [path for path in paths if is_trade_count_stale(path)]
+    log_message("INFO", f"归档文件 {len(paths)} 个，需要重算 {len(stale)} 个")
+    if not stale:
+        return True
+
+    start_time = time.time()
+    stats = {'recomputed': 0, 'current': 0, 'failed': 0, 'rows_changed': 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(recompute_trade_count_file, path): path for path in stale}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            try:
+                _, status, changed = future.result()
+                stats[status] += 1
+                stats['rows_changed'] += changed
+            except Exception as e:
+                stats['failed'] += 1
+                log_message("ERROR", f"重算成交次数失败: {futures[future]} - {str(e)}")
+            if done % 100 == 0:
+                elapsed = time.time() - start_time
+                log_message("INFO", f"进度 {done}/{len(stale)}，{done / elapsed:.1f} 文件/秒")
+
+    elapsed = time.time() - start_time
+    log_message("INFO", f"成交次数重算完成 - 重算: {stats['recomputed']}, 已是最新: {stats['current']}, "
+                        f"失败: {stats['failed']}, 变化行数: {stats['rows_changed']}, 耗时 {elapsed:.1f} 秒")
+    if stats['failed']:
+        log_message("WARNING", "部分文件重算失败，重新运行 --recompute-trade-count 会继续处理未完成的文件")
+    return stats['failed'] == 0
+
 # ================== 测试函数 ==================
 
 def test_years_calculation():
@@ -1788,6 +3848,183 @@ def test_years_calculation():
     print("-" * 50)
     print("测试完成")
 
+def test_indicator_parity():
+    """测试技术指标：逐根递推追加与整段向量化计算的结果是否一致"""
+    print("\n===== 测试技术指标递推一致性 =====")
+    rng = np.random.default_rng(0)
+    count = 3000
+    samples = {
+        '模拟随机游走': pd.DataFrame({'时间': pd.bdate_range('2010-01-04', periods=count),
+                                   '收盘价': np.round(10 * np.cumprod(1 + rng.normal(0, 0.02, count)), 2)}),
+        '模拟停牌（价格不变）': pd.DataFrame({'时间': pd.bdate_range('2010-01-04', periods=200), '收盘价': 10.0}),
+    }
+    # 有本地数据时再用一只真实股票检查
+    for stock_code in list(load_existing_index(INDEX_FILE))[:1]:
+        bars = load_adjusted_bars(stock_code)
+        if bars is not None and len(bars) > 100:
+            samples[f"股票 {stock_code}"] = bars
+    print("-" * 50)
+    all_passed = True
+    for label, bars in samples.items():
+        for split in (1, len(bars) // 2, len(bars) - 1):
+            diffs = indicators.check_parity(bars, split)
+            worst = max(diffs, key=diffs.get)
+            passed = diffs[worst] < 1e-8
+            all_passed = all_passed and passed
+            print(f"{label:<16} 前{split:>5}根重建+递推 最大误差 {diffs[worst]:.2e}（{worst}） {'✅' if passed else '❌'}")
+    print("-" * 50)
+    print("测试完成" if all_passed else "存在不一致的指标")
+    return all_passed
+
+def test_provider_pool():
+    """测试多数据源：本地模拟数据源上的合计吞吐、出错切换和新浪格式的列统一"""
+    print("\n===== 测试多数据源 =====")
+    dates = pd.bdate_range('2024-01-02', periods=30)
+
+    def fake_call(latency, fail=False):
+        """模拟接口: 固定耗时，返回新浪格式的日线（或总是抛出错误）"""
+        def call(api_name, symbol, start_date, end_date, adjust, **kwargs):
+            time.sleep(latency)
+            if fail:
+                raise ConnectionError("Connection aborted.")
+            close = np.linspace(10, 12.9, len(dates))
+            return pd.DataFrame({'date': dates, 'open': close - 0.1, 'high': close + 0.2, 'low': close - 0.2,
+                                 'close': close, 'volume': 123400.0, 'amount': 1.2e6, 'turnover': 0.0123})
+        return call
+
+    def run(pool, count, workers=6):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(lambda i: pool.fetch(f"{600000 + i:06d}", "20240110", "20240212"), range(count)))
+        return frames, count / (time.perf_counter() - start)
+
+    rate, count = 20.0, 60
+    single = data_providers.ProviderPool([data_providers.SinaProvider(fake_call(0.01), rate=rate, burst=1)])
+    _, single_rate = run(single, count)
+    spread = data_providers.ProviderPool([data_providers.SinaProvider(fake_call(0.01), rate=rate, burst=1)
+                                          for _ in range(3)])
+    _, spread_rate = run(spread, count)
+    failing = data_providers.SinaProvider(fake_call(0.01, fail=True), weight=3, rate=rate, burst=1)
+    failover = data_providers.ProviderPool([failing, data_providers.SinaProvider(fake_call(0.01), rate=rate, burst=1)])
+    frames, _ = run(failover, 20)
+
+    frame = frames[0]
+    checks = [
+        (f"单数据源 {single_rate:.1f} 次/秒，3个数据源 {spread_rate:.1f} 次/秒（单个限速 {rate:g}）", spread_rate > rate * 1.5),
+        (f"出错切换: 20次请求全部成功，切换 {failover.failovers} 次，出错的数据源已暂停",
+         all(len(f) for f in frames) and failover.failovers > 0 and failing.paused_until > time.monotonic()),
+        ("列格式与东方财富一致", list(frame.columns) == data_providers.HIST_COLUMNS),
+        ("截到请求的起始日，首行涨跌幅由前收盘价推算",
+         frame['日期'].iloc[0] == '2024-01-10' and not np.isnan(frame['涨跌幅'].iloc[0])),
+        ("成交量换算为手、换手率换算为百分数", frame['成交量'].iloc[0] == 1234.0 and frame['换手率'].iloc[0] == 1.23),
+    ]
+    print("-" * 50)
+    for label, passed in checks:
+        print(f"{label} {'✅' if passed else '❌'}")
+    print("-" * 50)
+    all_passed = all(passed for _, passed in checks)
+    print("测试完成" if all_passed else "存在未通过的检查")
+    return all_passed
+
+def test_hedging():
+    """测试对冲请求：模拟5%的请求卡住2秒，比较不对冲与对冲时的P99耗时"""
+    print("\n===== 测试对冲请求 =====")
+
+    def run(hedger, count=300, workers=3):
+        rng = random.Random(0)
+        lock = threading.Lock()
+
+        def request():
+            with lock:
+                latency = 2.0 if rng.random() < 0.05 else rng.uniform(0.01, 0.03)
+            time.sleep(latency)
+            return latency
+
+        latencies = []
+        def task(_):
+            start = time.perf_counter()
+            if hedger is None:
+                request()
+            else:
+                hedger.run(request, request)
+            latencies.append(time.perf_counter() - start)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(task, range(count)))
+        return float(np.percentile(latencies, 99))
+
+    baseline = run(None)
+    hedger = data_providers.Hedger(min_delay=0.05, max_ratio=0.1)
+    hedged = run(hedger)
+    stats = hedger.get_stats()
+    print("-" * 50)
+    print(f"不对冲 P99 {baseline:.2f} 秒，对冲 P99 {hedged:.2f} 秒")
+    print(hedger.summary_text())
+    passed = hedged < baseline / 2 and stats['hedge_rate'] <= 0.1
+    print("-" * 50)
+    print("测试完成" if passed else "对冲未改善尾延迟")
+    return passed
+
+def test_request_coalescing(stock_count=3):
+    """
+    测试相同请求合并：模拟接口上为新股票先确定上市日期、再获取完整历史，
+    每只股票应只发出一次日线请求和一次复权因子请求.
+    """
+    global DATA_SOURCE, AKSHARE_AVAILABLE, RAW_DIR, FACTOR_DIR
+    print("\n===== 测试相同请求合并 =====")
+    dates = pd.bdate_range('2020-01-02', periods=40)
+
+    class CountingSource:
+        """模拟接口：按接口名计数，日线为东方财富格式，复权因子为新浪格式"""
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.counts = {}
+
+        def call(self, api_name, func, **params):
+            with self.lock:
+                self.counts[api_name] = self.counts.get(api_name, 0) + 1
+            if api_name == 'stock_zh_a_daily':
+                return pd.DataFrame({'date': [dates[0], dates[20]], 'hfq_factor': [1.0, 1.1]})
+            close = np.linspace(10, 13.9, len(dates))
+            return pd.DataFrame({'日期': dates.strftime('%Y-%m-%d'), '股票代码': params['symbol'],
+                                 '开盘': close - 0.1, '收盘': close, '最高': close + 0.2, '最低': close - 0.2,
+                                 '成交量': 1000.0, '成交额': close * 1000 * 100, '振幅': 4.0,
+                                 '涨跌幅': 1.0, '涨跌额': 0.1, '换手率': 0.3})
+
+    source = CountingSource()
+    saved = DATA_SOURCE, AKSHARE_AVAILABLE, RAW_DIR, FACTOR_DIR
+    REQUEST_COALESCER.clear()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            DATA_SOURCE, AKSHARE_AVAILABLE = source, True
+            RAW_DIR, FACTOR_DIR = os.path.join(tmp_dir, 'raw'), os.path.join(tmp_dir, 'factor')
+            codes = [f"{600000 + i:06d}" for i in range(stock_count)]
+            listing_dates = [probe_listing_date_from_history(code) for code in codes]
+            frames = [get_stock_history_data(code) for code in codes]
+            raw_saved = all(load_raw_bars(code) is not None for code in codes)
+    finally:
+        DATA_SOURCE, AKSHARE_AVAILABLE, RAW_DIR, FACTOR_DIR = saved
+    stats = REQUEST_COALESCER.get_stats()
+    REQUEST_COALESCER.clear()
+
+    hist_calls = source.counts.get('stock_zh_a_hist', 0)
+    factor_calls = source.counts.get('stock_zh_a_daily', 0)
+    checks = [
+        (f"{stock_count} 只股票，日线请求 {hist_calls} 次，复权因子请求 {factor_calls} 次",
+         hist_calls == stock_count and factor_calls == stock_count),
+        (f"探测的结果被随后的历史数据请求取走: 命中缓存 {stats['memo_hits']} 次，剩余 {stats['memo_entries']} 条",
+         stats['memo_hits'] == 2 * stock_count and stats['memo_entries'] == 0),
+        ("上市日期为第一个交易日", all(d == '2020-01-02' for d in listing_dates)),
+        ("历史数据完整，不复权数据已入库",
+         all(f is not None and len(f) == len(dates) for f in frames) and raw_saved),
+    ]
+    print("-" * 50)
+    for label, passed in checks:
+        print(f"{label} {'✅' if passed else '❌'}")
+    print("-" * 50)
+    all_passed = all(passed for _, passed in checks)
+    print("测试完成" if all_passed else "存在未通过的检查")
+    return all_passed
+
 def auto_mode():
     """自动模式 - 自动检测是否需要初始化或更新"""
     log_message("INFO", "=== 自动模式 ===")
@@ -1815,15 +4052,31 @@ def auto_mode():
             log_message("ERROR", "3线程初始化模式失败")
             return False
 
-def sync_index_with_files():
-    """同步索引文件与实际文件，确保一致性"""
+def sync_index_with_files(max_workers=None):
+    """
+    同步索引文件与实际文件，确保一致性（完全离线）.
+    上市日期依次取自现有索引、本地上市日期登记表，仍没有时多进程读取文件的第一行数据；
+    结果一次写入索引.
+    """
     log_message("INFO", "=== 同步索引与文件 ===")
     log_message("INFO", "正在扫描文件夹中的所有股票文件...")
+    start_time = time.time()
     
     # 扫描所有文件夹中的Excel文件
     found_files = {}
     total_files = 0
     
+    # 代码存储目录中的文件（名称和年限在下面由现有索引、视图文件名或文件内容补充）
+    for stock_code, file_path in layout.scan_store(STORE_DIR).items():
+        total_files += 1
+        found_files[stock_code] = {
+            '股票代码': stock_code,
+            '股票名称': STOCK_NAME_CACHE.get(stock_code, stock_code),
+            '上市日期': '',
+            '上市年限': '',
+            '文件路径': file_path
+        }
+
     # 遍历所有可能的年限文件夹（0-35年）
     for years in range(36):
         years_dir = os.path.join(DATA_DIR, f"{years}年")
@@ -1833,6 +4086,11 @@ def sync_index_with_files():
         # 获取该文件夹中的所有Excel文件
         excel_files = [f for f in os.listdir(years_dir) if f.endswith('.xlsx') and not f.startswith('~$')]
         for file in excel_files:
+            # 代码存储中已有的股票，年限文件夹中的是视图链接（文件名中的名称可用于补充索引）
+            if file[:6] in found_files and layout.is_store_path(found_files[file[:6]]['文件路径'], STORE_DIR):
+                if found_files[file[:6]]['股票名称'] == file[:6] and file[6:7] == '_':
+                    found_files[file[:6]]['股票名称'] = file[7:].replace('.xlsx', '')
+                continue
             total_files += 1
             # 从文件名中提取股票代码和名称
             parts = file.split('_', 1)
@@ -1856,21 +4114,37 @@ def sync_index_with_files():
     existing_count = len(existing_index) if existing_index else 0
     log_message("INFO", f"现有索引中有 {existing_count} 条记录")
     
-    # 合并信息
+    # 合并信息：上市日期先查现有索引，再查本地登记表（不联网刷新）
+    to_read = {}
     for stock_code, file_info in found_files.items():
-        if stock_code in existing_index:
-            # 保留上市日期信息
-            file_info['上市日期'] = existing_index[stock_code]['上市日期']
-        else:
-            # 对于新文件，尝试获取上市日期
-            try:
-                file_info['上市日期'] = get_stock_listing_date(stock_code)
-            except:
-                file_info['上市日期'] = ''
+        existing = existing_index.get(stock_code, {})
+        if existing and layout.is_store_path(file_info['文件路径'], STORE_DIR):
+            # 代码存储的文件名不含名称，沿用索引中的名称
+            file_info['股票名称'] = existing['股票名称'] or file_info['股票名称']
+        file_info['上市日期'] = existing.get('上市日期') or listing_registry.get(stock_code, refresh=False) or ''
+        if not file_info['上市日期'] or file_info['股票名称'] == stock_code:
+            to_read[stock_code] = file_info['文件路径']
+
+    # 仍缺少上市日期（或名称）的文件，多进程只读取第一行数据
+    if to_read:
+        log_message("INFO", f"{len(to_read)} 个文件缺少上市日期或名称，读取文件第一行...")
+        for stock_code, (first_date, name) in panel.read_first_bars(to_read, max_workers).items():
+            file_info = found_files[stock_code]
+            if not file_info['上市日期'] and first_date is not None:
+                file_info['上市日期'] = first_date.strftime('%Y-%m-%d')
+            if file_info['股票名称'] == stock_code and name:
+                file_info['股票名称'] = str(name)
     
-    # 保存更新后的索引
+    for file_info in found_files.values():
+        if file_info['上市年限'] == '':
+            file_info['上市年限'] = get_listing_years(file_info)
+
+    # 保存更新后的索引（一次写入）
     save_index_file(list(found_files.values()), INDEX_FILE)
-    log_message("INFO", f"索引已更新，现包含 {len(found_files)} 条记录")
+    elapsed = time.time() - start_time
+    log_message("INFO", f"索引已更新，现包含 {len(found_files)} 条记录，读取文件 {len(to_read)} 个，"
+                        f"耗时 {elapsed:.2f} 秒（{total_files / max(elapsed, 1e-6):.0f} 文件/秒）")
+    refresh_year_views()
     
     return True
 
@@ -1913,6 +4187,35 @@ def auto_mode(sync_files=False):
 
 # 修改命令行参数处理
 if __name__ == "__main__":
+    # 打包为exe后进程池需要
+    multiprocessing.freeze_support()
+    # --shard i/N 可与 --init/--update/--auto 等组合使用，多台机器各处理一个分片
+    try:
+        shard_option = parse_shard_option(sys.argv)
+    except ValueError as e:
+        log_message("ERROR", str(e))
+        sys.exit(1)
+    if shard_option is not None:
+        configure_shard(*shard_option)
+    # --multi-provider 启用多数据源（PROVIDER_CONFIG）
+    if '--multi-provider' in sys.argv:
+        sys.argv.remove('--multi-provider')
+        PROVIDER_CONFIG['enabled'] = True
+    # --off-peak 启用时段调度（SCHEDULE_CONFIG）：初始化推迟到深夜，白天更新按较低速率
+    if '--off-peak' in sys.argv:
+        sys.argv.remove('--off-peak')
+        THROUGHPUT_SCHEDULER.enabled = True
+    # --hedge 启用对冲请求（HEDGE_CONFIG）
+    if '--hedge' in sys.argv:
+        sys.argv.remove('--hedge')
+        HEDGE_CONFIG['enabled'] = True
+    # --record / --replay 可与 --init/--update 等组合使用，录制或离线回放数据接口调用
+    try:
+        if parse_replay_options(sys.argv):
+            configure_replay()
+    except ValueError as e:
+        log_message("ERROR", str(e))
+        sys.exit(1)
     # 检查命令行参数
     if len(sys.argv) > 1:
         if sys.argv[1] == "--test":
@@ -1923,6 +4226,39 @@ if __name__ == "__main__":
             sync_index_with_files()
         elif sys.argv[1] == "--fix":
             classification_fix_mode()
+        elif sys.argv[1] == "--resample":
+            resample_mode()
+        elif sys.argv[1] == "--rebuild-xsection":
+            xsection_rebuild_mode()
+        elif sys.argv[1] == "--rebuild-indicators":
+            indicator_rebuild_mode()
+        elif sys.argv[1] == "--test-indicators":
+            test_indicator_parity()
+        elif sys.argv[1] == "--test-providers":
+            test_provider_pool()
+        elif sys.argv[1] == "--test-hedging":
+            test_hedging()
+        elif sys.argv[1] == "--test-coalescing":
+            test_request_coalescing()
+        elif sys.argv[1] == "--estimate":
+            estimate_mode(sys.argv[2] if len(sys.argv) > 2 else 'update')
+        elif sys.argv[1] == "--recompute-trade-count":
+            recompute_trade_count_mode(int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else None)
+        elif sys.argv[1] == "--migrate-layout":
+            migrate_layout_mode()
+        elif sys.argv[1] == "--refresh-views":
+            refresh_year_views()
+        elif sys.argv[1] == "--refresh-listing-dates":
+            listing_registry.refresh(force=True)
+        elif sys.argv[1] == "--merge-shards":
+            merge_shards_mode(sys.argv[2:])
+        elif sys.argv[1] == "--worker":
+            switch_to_optimized_mode()
+            worker_mode(sys.argv[2] if len(sys.argv) > 2 else 'update')
+        elif sys.argv[1] == "--queue-status":
+            queue_status_mode()
+        elif sys.argv[1] == "--daemon":
+            daemon_mode()
         elif sys.argv[1] == "--update":
             switch_to_optimized_mode()
             update_mode()
@@ -1935,4 +4271,12 @@ if __name__ == "__main__":
         else:
             main()
     else:
-        main() 
\ No newline at end of file
+        main() 
+    if REQUEST_COALESCER.get_stats()['calls']:
+        log_message("INFO", REQUEST_COALESCER.summary_text())
+    if PROVIDER_POOL is not None:
+        log_message("INFO", PROVIDER_POOL.summary_text())
+    if HEDGER is not None:
+        log_message("INFO", HEDGER.summary_text())
+    if DATA_SOURCE is not None:
+        log_message("INFO", DATA_SOURCE.summary_text())
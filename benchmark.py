@@ -0,0 +1,234 @@
+"""
+性能基准工具 - 在本地生成的模拟归档上测量各环节耗时，不需要联网
+用法: python benchmark.py [panel] [validation] [memory] [--stocks N] [--years N] [--workers N] [--keep]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+import panel
+import validation
+import index_store
+
+EXCEL_HEADERS = [
+    "时间", "开盘价", "最高价", "最低价", "收盘价", "涨幅",
+    "振幅", "总手数", "金额", "换手率", "成交次数", "名称"
+]
+
+BENCH_DIR = os.path.join(tempfile.gettempdir(), "pystock_benchmark")
+
+def print_header(message):
+    """打印带格式的标题"""
+    print("=" * 60)
+    print(message)
+    print("=" * 60)
+
+def make_synthetic_bars(stock_code, years, seed=None):
+    """生成一只股票的模拟日线（12列归档格式，涨幅/振幅为百分数）"""
+    rng = np.random.default_rng(seed if seed is not None else int(stock_code))
+    dates = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=years * 250)
+    n = len(dates)
+    change = rng.normal(0, 2, n).clip(-10, 10)
+    close = np.round(10 * np.cumprod(1 + change / 100), 2)
+    open_price = np.round(close * (1 + rng.normal(0, 0.005, n)), 2)
+    high = np.round(np.maximum(open_price, close) * (1 + rng.random(n) * 0.02), 2)
+    low = np.round(np.minimum(open_price, close) * (1 - rng.random(n) * 0.02), 2)
+    volume = rng.integers(1000, 200000, n)
+    return pd.DataFrame({
+        '时间': dates.date,
+        '开盘价': open_price,
+        '最高价': high,
+        '最低价': low,
+        '收盘价': close,
+        '涨幅': np.round(change, 2),
+        '振幅': np.round((high - low) / close * 100, 2),
+        '总手数': volume,
+        '金额': np.round(volume * 100 * close, 2),
+        '换手率': np.round(rng.random(n) * 5, 2),
+        '成交次数': (volume // 20).clip(min=1),
+        '名称': f"模拟{stock_code}",
+    })
+
+def write_synthetic_file(item):
+    """按归档格式写一个模拟Excel文件（涨幅/振幅以百分比格式存储）"""
+    stock_code, years, file_path = item
+    df = make_synthetic_bars(stock_code, years)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    ws.append(EXCEL_HEADERS)
+    df['涨幅'] = df['涨幅'] / 100
+    df['振幅'] = df['振幅'] / 100
+    for row in df.itertuples(index=False):
+        ws.append(list(row))
+    wb.save(file_path)
+    return stock_code
+
+def build_synthetic_archive(root_dir, n_stocks, years, workers=None):
+    """生成模拟归档和索引文件，已存在且规模一致时直接复用. 返回索引文件路径"""
+    data_dir = os.path.join(root_dir, "A_Stock_Data", f"{years}年")
+    index_file = os.path.join(root_dir, "stock_index.csv")
+    codes = [f"{600000 + i:06d}" for i in range(n_stocks)]
+    paths = {code: os.path.join(data_dir, f"{code}_模拟{code}.xlsx") for code in codes}
+    missing = [(code, years, path) for code, path in paths.items() if not os.path.exists(path)]
+    if missing:
+        os.makedirs(data_dir, exist_ok=True)
+        print(f"生成模拟归档: {len(missing)} 个文件 ({years}年 × {years * 250}行)...")
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_synthetic_file, missing, chunksize=4))
+        print(f"生成完成，耗时 {time.perf_counter() - start:.1f} 秒")
+    listing_date = (pd.Timestamp.today() - pd.DateOffset(years=years)).strftime("%Y-%m-%d")
+    index_store.write_index([{'股票代码': code, '股票名称': f"模拟{code}", '上市日期': listing_date,
+                              '上市年限': years, '文件路径': paths[code]} for code in codes], index_file)
+    return index_file
+
+def bench_load_panel(n_stocks=500, years=10, workers=None):
+    """面板读取基准：n_stocks只股票 × years年，读取收盘价和成交量"""
+    print_header(f"面板读取基准: {n_stocks}只股票 × {years}年")
+    index_file = build_synthetic_archive(BENCH_DIR, n_stocks, years, workers)
+    file_map = panel.read_index_paths(index_file)
+    codes = list(file_map.keys())
+    end = pd.Timestamp.today().normalize()
+    start = end - pd.DateOffset(years=years)
+
+    # 基线：逐个调用 pd.read_excel 读取全部列再过滤
+    sample = codes[:min(20, len(codes))]
+    t0 = time.perf_counter()
+    for code in sample:
+        df = pd.read_excel(file_map[code])
+        df[(df['时间'] >= start) & (df['时间'] <= end)]
+    baseline = (time.perf_counter() - t0) / len(sample) * len(codes)
+    print(f"基线 pd.read_excel 串行（按{len(sample)}个文件外推）: {baseline:.1f} 秒")
+
+    t0 = time.perf_counter()
+    wide = panel.load_panel(codes, start, end, fields=('收盘价', '总手数'),
+                            index_file=index_file, max_workers=workers)
+    elapsed = time.perf_counter() - t0
+    print(f"load_panel 宽表: {elapsed:.1f} 秒，形状 {wide.shape}，"
+          f"{len(codes) / elapsed:.1f} 文件/秒，加速 {baseline / elapsed:.1f}x")
+
+    t0 = time.perf_counter()
+    recent = panel.load_panel(codes, end - pd.DateOffset(months=3), end, fields=('收盘价',),
+                              layout='long', index_file=index_file, max_workers=workers)
+    print(f"load_panel 近3个月长表: {time.perf_counter() - t0:.1f} 秒，{len(recent)} 行")
+
+    # 二进制缓存：首次读取建立缓存，之后只做切片
+    cache_dir = os.path.join(BENCH_DIR, "panel_cache")
+    for label in ("建立缓存", "命中缓存"):
+        t0 = time.perf_counter()
+        wide = panel.load_panel(codes, start, end, fields=('收盘价', '总手数'),
+                                index_file=index_file, max_workers=workers, cache_dir=cache_dir)
+        cached_elapsed = time.perf_counter() - t0
+        print(f"load_panel 宽表（{label}）: {cached_elapsed:.2f} 秒，加速 {baseline / cached_elapsed:.1f}x")
+    return elapsed
+
+def bench_validation(rows=7000, repeat=200):
+    """入库校验基准：单只股票rows行数据整体校验的平均耗时（目标低于1毫秒）"""
+    print_header(f"入库校验基准: {rows} 行")
+    bars = make_synthetic_bars('600000', rows // 250 + 1).iloc[-rows:].reset_index(drop=True)
+    bars['时间'] = pd.to_datetime(bars['时间'])
+    validation.validate_bars(bars)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        validation.validate_bars(bars)
+    elapsed_ms = (time.perf_counter() - t0) / repeat * 1000
+    status = "达标" if elapsed_ms < 1 else "超出目标"
+    print(f"{len(validation.VALIDATION_RULES)} 条规则，平均 {elapsed_ms:.3f} 毫秒/次（{status}）")
+    return elapsed_ms
+
+# 历史数据接口返回的原始列名（与 astock_main.HIST_COLUMN_MAPPING 对应）
+API_COLUMN_NAMES = {
+    '时间': '日期', '开盘价': '开盘', '最高价': '最高', '最低价': '最低', '收盘价': '收盘',
+    '涨幅': '涨跌幅', '振幅': '振幅', '总手数': '成交量', '金额': '成交额', '换手率': '换手率'
+}
+
+def make_api_frame(stock_code, years):
+    """模拟历史数据接口返回的DataFrame（原始列名，日期为字符串）"""
+    bars = make_synthetic_bars(stock_code, years)
+    api = bars[list(API_COLUMN_NAMES)].rename(columns=API_COLUMN_NAMES)
+    api['日期'] = [d.isoformat() for d in api['日期']]
+    api.insert(1, '股票代码', stock_code)
+    api['涨跌额'] = np.round(bars['收盘价'] * bars['涨幅'] / 100, 2)
+    return api
+
+def bench_memory(years=30, threads=3):
+    """
+    入库内存基准：用tracemalloc测量单只股票从接口数据到导出数据的峰值内存，
+    以及threads个线程同时处理时的峰值；同时比较不复权数据压缩存储前后的大小.
+    """
+    import astock_main
+
+    print_header(f"入库内存基准: {years}年日线，{threads}线程")
+    factors = pd.DataFrame({'时间': pd.to_datetime(['1990-01-01']), '复权因子': [1.0]})
+
+    def ingest(stock_code):
+        hist_data = astock_main.normalize_hist_columns(make_api_frame(stock_code, years))
+        hist_data['时间'] = pd.to_datetime(hist_data['时间'])
+        validation.validate_bars(hist_data)
+        hist_data = astock_main.apply_adjustment(hist_data, factors, "qfq")
+        return astock_main.finalize_export_frame(stock_code, hist_data)
+
+    sample = make_api_frame('600000', years)
+    input_mb = sample.memory_usage(deep=True).sum() / 1024 / 1024
+
+    tracemalloc.start()
+    ingest('600000')
+    _, single_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracemalloc.start()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # 只保留行数，模拟写入后释放导出数据
+        list(executor.map(lambda code: len(ingest(code)), [f"{600000 + i:06d}" for i in range(threads * 4)]))
+    _, threaded_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"接口数据 {len(sample)} 行，占用 {input_mb:.2f}MB")
+    print(f"单只股票峰值: {single_peak / 1024 / 1024:.2f}MB（接口数据的 {single_peak / 1024 / 1024 / input_mb:.1f} 倍）")
+    print(f"{threads}线程并发峰值: {threaded_peak / 1024 / 1024:.2f}MB")
+
+    # 不复权数据存储：压缩类型后的大小，以及还原后是否与原数据完全一致
+    raw = astock_main.normalize_hist_columns(make_api_frame('600000', years))
+    raw['时间'] = pd.to_datetime(raw['时间'])
+    raw = raw[astock_main.RAW_COLUMNS]
+    packed = astock_main.downcast_frame(raw)
+    restored = astock_main.restore_frame(packed.copy())
+    restored.attrs = {}
+    lossless = restored.equals(raw)
+    print(f"不复权数据存储: {raw.memory_usage(deep=True).sum() / 1024:.0f}KB -> "
+          f"{packed.memory_usage(deep=True).sum() / 1024:.0f}KB，还原后{'完全一致' if lossless else '不一致'}")
+    return single_peak, threaded_peak
+
+def parse_option(args, name, default):
+    """读取 --name value 形式的参数"""
+    if name in args:
+        pos = args.index(name)
+        if pos + 1 < len(args):
+            return int(args[pos + 1])
+    return default
+
+def main():
+    args = sys.argv[1:]
+    n_stocks = parse_option(args, '--stocks', 500)
+    years = parse_option(args, '--years', 10)
+    workers = parse_option(args, '--workers', None)
+    selected = [a for a in args if not a.startswith('--') and not a.isdigit()] or ['panel', 'validation', 'memory']
+
+    if 'panel' in selected:
+        bench_load_panel(n_stocks, years, workers)
+    if 'validation' in selected:
+        bench_validation()
+    if 'memory' in selected:
+        bench_memory()
+
+    if '--keep' not in args:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
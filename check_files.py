@@ -1,16 +1,34 @@
 """
-检查工具 - 验证日志中的下载记录与实际文件是否匹配
+检查工具 - 验证索引记录与实际文件是否一致
+增量检查：保存上次扫描的快照（路径、大小、修改时间、股票代码、内容哈希），
+再次运行时只重新扫描修改时间变化的目录，只对变化的文件计算内容哈希，结果输出为JSON差异报告
+用法: python check_files.py [--full] [--json]
 """
 import os
 import re
 import sys
-import pandas as pd
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import index_store
+
 # 配置
 ROOT_DIR = "D:/股票归档"
 DATA_DIR = os.path.join(ROOT_DIR, "A_Stock_Data")
+STORE_DIR = os.path.join(ROOT_DIR, "A_Stock_Store")
 INDEX_FILE = os.path.join(ROOT_DIR, "stock_index.csv")
+SNAPSHOT_FILE = os.path.join(ROOT_DIR, "check_snapshot.json")  # 上次扫描的快照
+REPORT_FILE = os.path.join(ROOT_DIR, "check_report.json")  # 本次检查的差异报告
+
+SNAPSHOT_VERSION = 1
+# 扫描目录和计算哈希的线程数（都是IO操作，哈希计算时释放GIL）
+CHECK_WORKERS = 8
+
+STORE_FILE_PATTERN = re.compile(r'(\d{6})\.xlsx$')
+YEAR_FILE_PATTERN = re.compile(r'(\d{6})_(.+)\.xlsx$')
 
 def print_header(message):
     """打印带格式的标题"""
@@ -18,191 +36,255 @@ def print_header(message):
     print(message)
     print("=" * 60)
 
-def get_actual_files():
-    """获取实际存在的文件列表"""
-    files_dict = {}
-    total_files = 0
-    
-    # 检查目录是否存在
-    if not os.path.exists(DATA_DIR):
-        print(f"错误: 目录 {DATA_DIR} 不存在")
-        return files_dict, 0
-    
-    # 遍历所有年份目录
-    for year_dir in os.listdir(DATA_DIR):
-        year_path = os.path.join(DATA_DIR, year_dir)
-        if not os.path.isdir(year_path):
+def normalize_path(path):
+    """统一路径写法再比较（分隔符、大小写、相对路径）"""
+    return os.path.normcase(os.path.abspath(os.path.normpath(str(path)))) if path else ''
+
+def file_hash(file_path):
+    """文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_snapshot():
+    """读取上次的快照，不存在或版本不符时返回空快照"""
+    empty = {'version': SNAPSHOT_VERSION, 'dirs': {}}
+    if not os.path.exists(SNAPSHOT_FILE):
+        return empty
+    try:
+        with open(SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    return snapshot if snapshot.get('version') == SNAPSHOT_VERSION else empty
+
+def save_json(data, file_path):
+    """写入JSON（先写临时文件再替换）"""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, file_path)
+
+def list_data_dirs():
+    """需要扫描的目录: (目录路径, 类型)，类型为 store（按代码存储）或 year（上市年限文件夹）"""
+    dirs = []
+    for base_dir, kind in ((STORE_DIR, 'store'), (DATA_DIR, 'year')):
+        if not os.path.isdir(base_dir):
+            continue
+        for name in sorted(os.listdir(base_dir)):
+            path = os.path.join(base_dir, name)
+            if os.path.isdir(path):
+                dirs.append((path, kind))
+    return dirs
+
+def scan_dir(item):
+    """
+    扫描一个目录中的股票文件，返回 {文件名: {'code', 'name', 'size', 'mtime', 'link'}}.
+    年限文件夹中的符号链接（年限视图）只记录名称，不作为数据文件.
+    """
+    dir_path, kind = item
+    entries = {}
+    pattern = STORE_FILE_PATTERN if kind == 'store' else YEAR_FILE_PATTERN
+    for entry in os.scandir(dir_path):
+        if entry.name.startswith('~$'):
+            continue
+        match = pattern.match(entry.name)
+        if not match:
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries[entry.name] = {
+            'code': match.group(1),
+            'name': match.group(2) if kind == 'year' else '',
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'link': entry.is_symlink(),
+        }
+    return entries
+
+def scan_files(snapshot, full=False):
+    """
+    增量扫描: 目录修改时间与快照相同时直接沿用快照中的文件列表，否则重新列出目录.
+    full=True 时所有目录都重新扫描（发现不改变目录修改时间的原地修改）.
+    返回 (目录快照, 重新扫描的目录数)
+    """
+    old_dirs = snapshot.get('dirs', {})
+    dirs = {}
+    to_scan = []
+    for dir_path, kind in list_data_dirs():
+        mtime = os.stat(dir_path).st_mtime_ns
+        old = old_dirs.get(dir_path)
+        if not full and old is not None and old['mtime'] == mtime and old['kind'] == kind:
+            dirs[dir_path] = old
+        else:
+            dirs[dir_path] = {'kind': kind, 'mtime': mtime, 'files': {}}
+            to_scan.append((dir_path, kind))
+    if to_scan:
+        with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as executor:
+            for (dir_path, _), files in zip(to_scan, executor.map(scan_dir, to_scan)):
+                # 大小和修改时间未变的文件沿用上次的哈希
+                old_files = old_dirs.get(dir_path, {}).get('files', {})
+                for name, info in files.items():
+                    old = old_files.get(name)
+                    if old and old['size'] == info['size'] and old['mtime'] == info['mtime']:
+                        info['hash'] = old.get('hash')
+                dirs[dir_path]['files'] = files
+    return dirs, len(to_scan)
+
+def hash_changed_files(dirs):
+    """对新增或大小/修改时间变化的数据文件计算内容哈希（多线程），返回计算的文件数"""
+    pending = [(dir_path, name, info) for dir_path, d in dirs.items() for name, info in d['files'].items()
+               if not info['link'] and not info.get('hash')]
+    if not pending:
+        return 0
+    with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as executor:
+        hashes = executor.map(lambda item: _safe_hash(os.path.join(item[0], item[1])), pending)
+        for (_, _, info), digest in zip(pending, hashes):
+            info['hash'] = digest
+    return len(pending)
+
+def _safe_hash(file_path):
+    try:
+        return file_hash(file_path)
+    except OSError:
+        return None
+
+def collect_actual_files(dirs):
+    """
+    由目录快照得到每只股票的数据文件: {代码: {'path', 'name', 'dir', 'hash'}}.
+    按代码存储中已有的股票，年限文件夹中的同代码文件是视图（链接），只用于补充名称.
+    """
+    files = {}
+    view_names = {}
+    for dir_path, d in dirs.items():
+        if d['kind'] != 'store':
             continue
-            
-        # 获取该年份目录下的所有文件
-        files = [f for f in os.listdir(year_path) if f.endswith('.xlsx') and not f.startswith('~$')]
-        
-        # 解析文件名获取股票代码
-        for file in files:
-            match = re.match(r'(\d{6})_(.+)\.xlsx', file)
-            if match:
-                stock_code = match.group(1)
-                stock_name = match.group(2)
-                files_dict[stock_code] = {
-                    '股票代码': stock_code,
-                    '股票名称': stock_name,
-                    '文件路径': os.path.join(year_path, file),
-                    '年份目录': year_dir
-                }
-                total_files += 1
-    
-    return files_dict, total_files
-
-def get_index_records():
-    """获取索引文件中的记录"""
+        for name, info in d['files'].items():
+            files[info['code']] = {'path': os.path.join(dir_path, name), 'name': '', 'dir': '代码存储', 'hash': info.get('hash')}
+    store_codes = set(files)
+    for dir_path, d in dirs.items():
+        if d['kind'] != 'year':
+            continue
+        for name, info in d['files'].items():
+            if info['code'] in store_codes:
+                view_names[info['code']] = info['name']
+            elif not info['link']:
+                files[info['code']] = {'path': os.path.join(dir_path, name), 'name': info['name'],
+                                       'dir': os.path.basename(dir_path), 'hash': info.get('hash')}
+    for code, name in view_names.items():
+        files[code]['name'] = name
+    return files
+
+def load_index_records():
+    """读取索引 {代码: 名称、文件路径、上市年限}（索引未变化时 index_store 直接读取二进制快照）"""
     if not os.path.exists(INDEX_FILE):
         print(f"错误: 索引文件 {INDEX_FILE} 不存在")
-        return {}, 0
-    
-    try:
-        df = pd.read_csv(INDEX_FILE, encoding='utf-8')
-        
-        # 打印索引文件的前几行，查看格式
-        print("\n索引文件前5行:")
-        print(df.head().to_string())
-        print(f"索引文件列名: {list(df.columns)}")
-        
-        records = {}
-        for _, row in df.iterrows():
-            # 检查股票代码格式
-            stock_code = str(row['股票代码'])
-            
-            # 如果股票代码不是6位数，尝试补齐
-            if len(stock_code) < 6:
-                stock_code = stock_code.zfill(6)
-                print(f"警告: 股票代码 {row['股票代码']} 不是6位数，已补齐为 {stock_code}")
-            
-            records[stock_code] = {
-                '股票代码': stock_code,
-                '股票名称': row['股票名称'],
-                '上市日期': row['上市日期'] if '上市日期' in df.columns else '',
-                '上市年限': row['上市年限'] if '上市年限' in df.columns else 0,
-                '文件路径': row['文件路径'] if '文件路径' in df.columns else ''
-            }
-        return records, len(records)
-    except Exception as e:
-        print(f"读取索引文件时出错: {str(e)}")
-        return {}, 0
+        return {}
+    return {code: {'name': row['股票名称'], 'path': row['文件路径'], 'years': row['上市年限']}
+            for code, row in index_store.read_index(INDEX_FILE).items()}
 
-def main():
-    print_header("文件系统与索引一致性检查工具")
-    
-    # 获取实际文件
-    print("正在扫描文件系统...")
-    actual_files, actual_count = get_actual_files()
-    print(f"文件系统中找到 {actual_count} 个股票数据文件")
-    
-    # 显示部分实际文件信息
-    print("\n文件系统中的部分文件:")
-    for i, (code, info) in enumerate(list(actual_files.items())[:5]):
-        print(f"{i+1}. 股票代码: {code}, 股票名称: {info['股票名称']}, 路径: {info['文件路径']}")
-    
-    # 获取索引记录
-    print("\n正在读取索引文件...")
-    index_records, index_count = get_index_records()
-    print(f"索引文件中有 {index_count} 条记录")
-    
-    # 比较差异
-    print("\n开始比较差异...")
-    
-    # 1. 在文件系统中存在但索引中不存在的文件
-    missing_in_index = []
-    for code in actual_files:
-        if code not in index_records:
-            # 检查是否因为前导零的问题
-            no_leading_zeros = code.lstrip('0')
-            if no_leading_zeros in index_records:
-                print(f"发现代码格式不匹配: 文件系统中为 {code}，索引中为 {no_leading_zeros}")
-                continue
-                
-            missing_in_index.append({
-                '股票代码': code,
-                '股票名称': actual_files[code]['股票名称'],
-                '文件路径': actual_files[code]['文件路径'],
-                '年份目录': actual_files[code]['年份目录']
-            })
-    
-    # 2. 在索引中存在但文件系统中不存在的记录
-    missing_in_fs = []
-    for code in index_records:
-        if code not in actual_files:
-            # 检查是否因为前导零的问题
-            code_with_zeros = code.zfill(6)
-            if code_with_zeros in actual_files:
-                print(f"发现代码格式不匹配: 索引中为 {code}，文件系统中为 {code_with_zeros}")
-                continue
-                
-            missing_in_fs.append({
-                '股票代码': code,
-                '股票名称': index_records[code]['股票名称'],
-                '文件路径': index_records[code]['文件路径'],
-                '上市年限': index_records[code]['上市年限']
-            })
-    
-    # 3. 路径不一致的记录
-    path_mismatch = []
-    for code in actual_files:
-        if code in index_records:
-            actual_path = actual_files[code]['文件路径']
-            index_path = index_records[code]['文件路径']
-            if actual_path != index_path:
-                path_mismatch.append({
-                    '股票代码': code,
-                    '股票名称': actual_files[code]['股票名称'],
-                    '实际路径': actual_path,
-                    '索引路径': index_path
-                })
-    
-    # 打印结果
+def diff_changes(old_dirs, dirs):
+    """与上次快照比较的文件变化: 新增、删除、内容变化（哈希不同）"""
+    def data_files(snapshot_dirs):
+        result = {}
+        for dir_path, d in snapshot_dirs.items():
+            for name, info in d['files'].items():
+                if not info['link']:
+                    result[os.path.join(dir_path, name)] = info.get('hash')
+        return result
+    before, after = data_files(old_dirs), data_files(dirs)
+    return {
+        'added': sorted(set(after) - set(before)),
+        'removed': sorted(set(before) - set(after)),
+        'modified': sorted(path for path in set(after) & set(before) if after[path] != before[path]),
+    }
+
+def compare_with_index(actual_files, index_records):
+    """索引与文件系统的差异（路径统一写法后比较）"""
+    missing_in_index = [{'股票代码': code, '股票名称': info['name'], '文件路径': info['path'], '目录': info['dir']}
+                        for code, info in sorted(actual_files.items()) if code not in index_records]
+    missing_in_fs = [{'股票代码': code, '股票名称': record['name'], '文件路径': record['path'], '上市年限': record['years']}
+                     for code, record in sorted(index_records.items()) if code not in actual_files]
+    path_mismatch = [{'股票代码': code, '股票名称': index_records[code]['name'] or info['name'],
+                      '实际路径': info['path'], '索引路径': index_records[code]['path']}
+                     for code, info in sorted(actual_files.items())
+                     if code in index_records and normalize_path(info['path']) != normalize_path(index_records[code]['path'])]
+    return missing_in_index, missing_in_fs, path_mismatch
+
+def run_check(full=False):
+    """执行一次检查，保存新快照和差异报告，返回报告字典"""
+    start_time = time.time()
+    snapshot = load_snapshot()
+    dirs, scanned_dirs = scan_files(snapshot, full)
+    hashed = hash_changed_files(dirs)
+    actual_files = collect_actual_files(dirs)
+    index_records = load_index_records()
+    missing_in_index, missing_in_fs, path_mismatch = compare_with_index(actual_files, index_records)
+
+    report = {
+        'checked_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'first_run': not snapshot.get('dirs'),
+        'dirs': len(dirs),
+        'scanned_dirs': scanned_dirs,
+        'hashed_files': hashed,
+        'files': len(actual_files),
+        'index_records': len(index_records),
+        'changes': diff_changes(snapshot.get('dirs', {}), dirs),
+        'missing_in_index': missing_in_index,
+        'missing_in_fs': missing_in_fs,
+        'path_mismatch': path_mismatch,
+    }
+    report['elapsed'] = round(time.time() - start_time, 3)
+    save_json({'version': SNAPSHOT_VERSION, 'dirs': dirs}, SNAPSHOT_FILE)
+    save_json(report, REPORT_FILE)
+    return report
+
+def print_report(report):
+    """打印检查结果和修复建议"""
     print_header("检查结果")
-    
-    print(f"文件系统中有 {actual_count} 个文件，索引中有 {index_count} 条记录")
-    print(f"差异: {abs(actual_count - index_count)} 个")
-    
-    if missing_in_index:
-        print(f"\n在文件系统中存在但索引中不存在的文件: {len(missing_in_index)} 个")
-        for i, item in enumerate(missing_in_index[:10], 1):
-            print(f"{i}. {item['股票代码']} - {item['股票名称']} ({item['年份目录']})")
-        if len(missing_in_index) > 10:
-            print(f"... 以及其他 {len(missing_in_index) - 10} 个文件")
-    else:
-        print("\n所有文件都已在索引中记录")
-    
-    if missing_in_fs:
-        print(f"\n在索引中存在但文件系统中不存在的记录: {len(missing_in_fs)} 个")
-        for i, item in enumerate(missing_in_fs[:10], 1):
-            print(f"{i}. {item['股票代码']} - {item['股票名称']} (上市年限: {item['上市年限']})")
-        if len(missing_in_fs) > 10:
-            print(f"... 以及其他 {len(missing_in_fs) - 10} 个记录")
-    else:
-        print("\n索引中的所有记录都有对应的文件")
-    
-    if path_mismatch:
-        print(f"\n路径不一致的记录: {len(path_mismatch)} 个")
-        for i, item in enumerate(path_mismatch[:5], 1):
-            print(f"{i}. {item['股票代码']} - {item['股票名称']}")
-            print(f"   实际: {item['实际路径']}")
-            print(f"   索引: {item['索引路径']}")
-        if len(path_mismatch) > 5:
-            print(f"... 以及其他 {len(path_mismatch) - 5} 个记录")
-    
+    print(f"目录 {report['dirs']} 个（重新扫描 {report['scanned_dirs']} 个），计算哈希 {report['hashed_files']} 个文件，"
+          f"耗时 {report['elapsed']:.3f} 秒")
+    print(f"文件系统中有 {report['files']} 个文件，索引中有 {report['index_records']} 条记录")
+
+    changes = report['changes']
+    if not report['first_run']:
+        print(f"与上次检查相比: 新增 {len(changes['added'])}, 删除 {len(changes['removed'])}, 内容变化 {len(changes['modified'])}")
+
+    sections = [
+        ('missing_in_index', "在文件系统中存在但索引中不存在的文件", lambda item: f"{item['股票代码']} - {item['股票名称']} ({item['目录']})"),
+        ('missing_in_fs', "在索引中存在但文件系统中不存在的记录", lambda item: f"{item['股票代码']} - {item['股票名称']} (上市年限: {item['上市年限']})"),
+        ('path_mismatch', "路径不一致的记录", lambda item: f"{item['股票代码']} - {item['股票名称']}\n   实际: {item['实际路径']}\n   索引: {item['索引路径']}"),
+    ]
+    for key, title, describe in sections:
+        items = report[key]
+        if not items:
+            continue
+        print(f"\n{title}: {len(items)} 个")
+        for i, item in enumerate(items[:10], 1):
+            print(f"{i}. {describe(item)}")
+        if len(items) > 10:
+            print(f"... 以及其他 {len(items) - 10} 个")
+    if not (report['missing_in_index'] or report['missing_in_fs'] or report['path_mismatch']):
+        print("\n索引与文件完全一致")
+
     # 提供修复建议
-    print_header("修复建议")
-    
-    if missing_in_index:
-        print("1. 更新索引文件，添加缺失的记录")
-        print("   可以使用 astock_main.py 中的分类修复模式")
-    
-    if missing_in_fs or path_mismatch:
-        print("2. 重新生成索引文件，确保与文件系统一致")
-        print("   可以备份当前索引文件，然后运行初始化模式")
-    
-    print("\n检查完成！")
+    if report['missing_in_index'] or report['missing_in_fs'] or report['path_mismatch']:
+        print_header("修复建议")
+        print("运行 python astock_main.py --sync 由文件重建索引（离线）")
+    print(f"\n差异报告: {REPORT_FILE}")
+
+def main():
+    args = sys.argv[1:]
+    report = run_check(full='--full' in args)
+    if '--json' in args:
+        print(json.dumps(report, ensure_ascii=False, indent=1))
+    else:
+        print_header("文件系统与索引一致性检查工具")
+        print_report(report)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
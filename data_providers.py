@@ -0,0 +1,493 @@
+"""
+多数据源日线接口 - 东方财富、新浪、腾讯三个akshare日线接口统一为东方财富 stock_zh_a_hist 的列格式，
+主程序的列名映射和12列归档整理对所有数据源通用.
+每个数据源有独立的令牌桶限速；ProviderPool 按权重把请求分摊到当前有余量的数据源，
+某个数据源出错时自动换下一个，连续出错的数据源暂停一段时间. 合计速率是各数据源限速之和.
+Hedger 在请求明显慢于近期耗时时发出对冲请求，取先返回的结果；RequestCoalescer 合并相同的请求.
+数据源只通过传入的 call(接口名, **参数) 调用接口，可替换为本地模拟数据源测试.
+"""
+import sys
+import time
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+# 统一的日线列（东方财富 stock_zh_a_hist 的返回格式）
+HIST_COLUMNS = ['日期', '开盘', '收盘', '最高', '最低', '成交量', '成交额', '振幅', '涨跌幅', '涨跌额', '换手率']
+
+# 新浪/腾讯接口没有涨跌幅等列，需要前一交易日收盘价推算；向前多取的自然日数（覆盖长假）
+PREV_CLOSE_LOOKBACK_DAYS = 20
+
+def exchange_symbol(stock_code):
+    """转换为带交易所前缀的代码（新浪、腾讯接口使用）"""
+    code = str(stock_code).zfill(6)
+    if code.startswith('92') or code.startswith(('4', '8')):
+        return f"bj{code}"
+    if code.startswith(('6', '9')):
+        return f"sh{code}"
+    return f"sz{code}"
+
+def _parse_date(value):
+    return pd.Timestamp(str(value).replace('-', ''))
+
+def _format_date(value):
+    return pd.Timestamp(value).strftime("%Y%m%d")
+
+def empty_history():
+    return pd.DataFrame(columns=HIST_COLUMNS)
+
+def finish_history(frame, start_date):
+    """
+    由 日期/开高低收/成交量/成交额/换手率 推算 振幅、涨跌幅、涨跌额（以前一交易日收盘价为基准，保留两位小数），
+    截掉为取前收盘价多取的日期，返回 HIST_COLUMNS 格式（日期为 YYYY-MM-DD 字符串）
+    """
+    if frame is None or frame.empty:
+        return empty_history()
+    frame = frame.sort_values('日期').reset_index(drop=True)
+    prev_close = frame['收盘'].shift(1)
+    frame['涨跌额'] = (frame['收盘'] - prev_close).round(2)
+    frame['涨跌幅'] = ((frame['收盘'] / prev_close - 1) * 100).round(2)
+    frame['振幅'] = ((frame['最高'] - frame['最低']) / prev_close * 100).round(2)
+    frame = frame[frame['日期'] >= _parse_date(start_date)]
+    frame = frame.assign(日期=frame['日期'].dt.strftime("%Y-%m-%d"))
+    return frame[HIST_COLUMNS].reset_index(drop=True)
+
+class TokenBucket:
+    """令牌桶：平均 rate 次/秒，允许 burst 次突发"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """还需等待多少秒才有令牌"""
+        with self.lock:
+            self._refill(time.monotonic())
+            return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """取一个令牌，不足时等待. 返回等待的秒数"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class HistoryProvider:
+    """
+    日线数据源. 子类实现 fetch_raw，返回 HIST_COLUMNS 格式的表.
+    weight 分摊权重（0 表示只在其他数据源都失败时使用），rate/burst 本数据源的限速.
+    """
+    name = ''
+
+    def __init__(self, call, weight=1.0, rate=1.0, burst=2):
+        self.call = call
+        self.weight = float(weight)
+        self.limiter = TokenBucket(rate, burst)
+        self.issued = 0
+        self.requests = 0
+        self.failures = 0
+        self.rows = 0
+        self.latency = 0.0
+        self.waited = 0.0
+        self.consecutive_failures = 0
+        self.paused_until = 0.0
+        self.stats_lock = threading.Lock()
+
+    def supports(self, stock_code):
+        return True
+
+    def fetch_raw(self, stock_code, start_date, end_date, adjust):
+        raise NotImplementedError
+
+    def fetch(self, stock_code, start_date, end_date, adjust=''):
+        """限速后获取日线，记录耗时和成败"""
+        waited = self.limiter.acquire()
+        start = time.perf_counter()
+        frame, ok = None, False
+        try:
+            frame = self.fetch_raw(stock_code, start_date, end_date, adjust)
+            if frame is None:
+                frame = empty_history()
+            ok = True
+            return frame
+        finally:
+            with self.stats_lock:
+                self.requests += 1
+                self.waited += waited
+                self.latency += time.perf_counter() - start
+                if ok:
+                    self.rows += len(frame)
+                else:
+                    self.failures += 1
+
+class EastmoneyProvider(HistoryProvider):
+    """东方财富 stock_zh_a_hist（原有接口，列格式即统一格式）"""
+    name = 'eastmoney'
+
+    def fetch_raw(self, stock_code, start_date, end_date, adjust):
+        frame = self.call('stock_zh_a_hist', symbol=stock_code, period="daily",
+                          start_date=start_date, end_date=end_date, adjust=adjust)
+        if frame is None or frame.empty:
+            return empty_history()
+        for col in HIST_COLUMNS:
+            if col not in frame.columns:
+                frame[col] = np.nan
+        return frame[HIST_COLUMNS]
+
+class SinaProvider(HistoryProvider):
+    """新浪 stock_zh_a_daily：成交量为股（换算为手），换手率为小数（换算为百分数），涨跌幅等由前收盘价推算"""
+    name = 'sina'
+
+    def fetch_raw(self, stock_code, start_date, end_date, adjust):
+        lookback = _parse_date(start_date) - timedelta(days=PREV_CLOSE_LOOKBACK_DAYS)
+        raw = self.call('stock_zh_a_daily', symbol=exchange_symbol(stock_code),
+                        start_date=_format_date(lookback), end_date=_format_date(_parse_date(end_date)), adjust=adjust)
+        if raw is None or raw.empty:
+            return empty_history()
+        frame = pd.DataFrame({
+            '日期': pd.to_datetime(raw['date']),
+            '开盘': pd.to_numeric(raw['open'], errors='coerce'),
+            '收盘': pd.to_numeric(raw['close'], errors='coerce'),
+            '最高': pd.to_numeric(raw['high'], errors='coerce'),
+            '最低': pd.to_numeric(raw['low'], errors='coerce'),
+            '成交量': pd.to_numeric(raw['volume'], errors='coerce') / 100,
+            '成交额': pd.to_numeric(raw['amount'], errors='coerce'),
+            '换手率': (pd.to_numeric(raw['turnover'], errors='coerce') * 100).round(2)
+                      if 'turnover' in raw.columns else np.nan,
+        })
+        return finish_history(frame, start_date)
+
+class TencentProvider(HistoryProvider):
+    """
+    腾讯 stock_zh_a_hist_tx：只有开高低收和成交量（amount列，单位为手），没有成交额和换手率（这两列为空），
+    默认只作为备用数据源. 成交额为空的数据入库校验不通过（金额缺失），只用于不入库的比对请求. 不支持北交所股票.
+    """
+    name = 'tencent'
+
+    def supports(self, stock_code):
+        return not exchange_symbol(stock_code).startswith('bj')
+
+    def fetch_raw(self, stock_code, start_date, end_date, adjust):
+        lookback = _parse_date(start_date) - timedelta(days=PREV_CLOSE_LOOKBACK_DAYS)
+        raw = self.call('stock_zh_a_hist_tx', symbol=exchange_symbol(stock_code),
+                        start_date=_format_date(lookback), end_date=_format_date(_parse_date(end_date)), adjust=adjust)
+        if raw is None or raw.empty:
+            return empty_history()
+        frame = pd.DataFrame({
+            '日期': pd.to_datetime(raw['date']),
+            '开盘': pd.to_numeric(raw['open'], errors='coerce'),
+            '收盘': pd.to_numeric(raw['close'], errors='coerce'),
+            '最高': pd.to_numeric(raw['high'], errors='coerce'),
+            '最低': pd.to_numeric(raw['low'], errors='coerce'),
+            '成交量': pd.to_numeric(raw['amount'], errors='coerce'),
+            '成交额': np.nan,
+            '换手率': np.nan,
+        })
+        return finish_history(frame, start_date)
+
+PROVIDER_CLASSES = {cls.name: cls for cls in (EastmoneyProvider, SinaProvider, TencentProvider)}
+
+class NoProviderAvailable(RuntimeError):
+    """没有可用的数据源（都不支持该股票，或都已失败/暂停）"""
+
+class ProviderPool:
+    """
+    按权重分摊请求并自动切换的数据源组.
+    选择顺序：未暂停、支持该股票、本次请求中还没失败过的数据源中，令牌等待时间最短者优先，
+    等待时间相同时取 已分配请求数/权重 最小者；权重为0的数据源只在其他数据源都不可用时使用.
+    连续失败 failure_threshold 次的数据源暂停 pause_seconds 秒（再次失败时加倍，最长 max_pause_seconds）.
+    """
+
+    def __init__(self, providers, failure_threshold=3, pause_seconds=60, max_pause_seconds=900):
+        self.providers = list(providers)
+        self.failure_threshold = failure_threshold
+        self.pause_seconds = pause_seconds
+        self.max_pause_seconds = max_pause_seconds
+        self.lock = threading.Lock()
+        self.failovers = 0
+
+    def _pick(self, stock_code, tried, avoid=()):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [p for p in self.providers
+                          if p not in tried and p.supports(stock_code) and p.paused_until <= now]
+            # 对冲请求尽量换一个数据源，没有其他数据源时才用同一个
+            candidates = [p for p in candidates if p not in avoid] or candidates
+            primary = [p for p in candidates if p.weight > 0] or candidates
+            if not primary:
+                return None
+            provider = min(primary, key=lambda p: (p.limiter.wait_time(), p.issued / (p.weight or 1.0)))
+            provider.issued += 1
+            return provider
+
+    def _record(self, provider, ok):
+        with self.lock:
+            if ok:
+                provider.consecutive_failures = 0
+                return
+            provider.consecutive_failures += 1
+            excess = provider.consecutive_failures - self.failure_threshold
+            if excess >= 0:
+                pause = min(self.pause_seconds * (2 ** min(excess, 10)), self.max_pause_seconds)
+                provider.paused_until = time.monotonic() + pause
+
+    def fetch(self, stock_code, start_date, end_date, adjust='', used=None, avoid=()):
+        """
+        获取日线（HIST_COLUMNS格式）. 当前数据源出错时换下一个，全部失败时抛出最后一个错误.
+        used: 传入列表时记录本次用到的数据源；avoid: 尽量不用的数据源（对冲请求避开原请求的数据源）
+        """
+        tried = []
+        last_error = None
+        while True:
+            provider = self._pick(stock_code, tried, avoid)
+            if provider is None:
+                if last_error is not None:
+                    raise last_error
+                raise NoProviderAvailable(f"没有可用的数据源: {stock_code}")
+            if tried:
+                with self.lock:
+                    self.failovers += 1
+            tried.append(provider)
+            if used is not None:
+                used.append(provider)
+            try:
+                frame = provider.fetch(stock_code, start_date, end_date, adjust)
+            except Exception as e:
+                self._record(provider, False)
+                last_error = e
+                continue
+            self._record(provider, True)
+            return frame
+
+    def acquire(self, name):
+        """
+        在数据源组之外调用同一网站的接口（如新浪的复权因子）前取该数据源的令牌，使其计入该数据源的限速.
+        返回等待的秒数，没有该数据源时返回0.
+        """
+        for p in self.providers:
+            if p.name == name:
+                waited = p.limiter.acquire()
+                with p.stats_lock:
+                    p.waited += waited
+                return waited
+        return 0.0
+
+    def get_stats(self):
+        """各数据源的请求数、失败数、平均耗时和限速等待时间"""
+        stats = {}
+        for p in self.providers:
+            stats[p.name] = {
+                'requests': p.requests, 'failures': p.failures, 'rows': p.rows,
+                'avg_latency': p.latency / p.requests if p.requests else 0.0,
+                'waited': p.waited, 'paused': p.paused_until > time.monotonic(),
+            }
+        return stats
+
+    def summary_text(self):
+        parts = [f"{name} 请求{s['requests']}/失败{s['failures']}/平均{s['avg_latency']:.2f}秒"
+                 for name, s in self.get_stats().items()]
+        return f"数据源: {'，'.join(parts)}，切换 {self.failovers} 次"
+
+class Hedger:
+    """
+    对冲请求：请求耗时超过近期耗时的 percentile 分位数（至少 min_delay 秒）仍未返回时，
+    再发出一个相同的请求，取先成功返回的结果（慢的请求在后台结束，结果丢弃）.
+    对冲请求数不超过全部请求的 max_ratio；发出前调用 before_hedge()（如取共享速率令牌），与普通请求共用速率预算.
+    统计对冲比例，以及原请求与实际返回耗时的 P99（即对冲带来的尾延迟改善）.
+    """
+
+    def __init__(self, percentile=95, min_samples=20, min_delay=0.5, max_ratio=0.1, window=200, max_workers=32):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=window)
+        self.primary_latencies = deque(maxlen=10000)
+        self.effective_latencies = deque(maxlen=10000)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self):
+        """发出对冲请求前等待的秒数，样本不足时返回None（不对冲）"""
+        with self.lock:
+            if len(self.recent) < self.min_samples:
+                return None
+            return max(float(np.percentile(self.recent, self.percentile)), self.min_delay)
+
+    def _record_primary(self, future, start):
+        if future.exception() is None:
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.recent.append(latency)
+                self.primary_latencies.append(latency)
+
+    def _allow_hedge(self):
+        with self.lock:
+            if self.hedged + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def run(self, primary, hedge, before_hedge=None):
+        """执行 primary()，超过对冲等待时间时再执行 hedge()，返回先成功的结果；都失败时抛出原请求的错误"""
+        start = time.perf_counter()
+        with self.lock:
+            self.requests += 1
+        delay = self.hedge_delay()
+        futures = [self.executor.submit(primary)]
+        futures[0].add_done_callback(lambda f: self._record_primary(f, start))
+        if delay is not None:
+            done, _ = wait(futures, timeout=delay)
+            if not done and self._allow_hedge():
+                if before_hedge is not None:
+                    before_hedge()
+                if futures[0].done():
+                    # 等待速率预算期间原请求已返回，不再对冲，名额退回
+                    with self.lock:
+                        self.hedged -= 1
+                else:
+                    futures.append(self.executor.submit(hedge))
+
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    with self.lock:
+                        self.effective_latencies.append(time.perf_counter() - start)
+                        if future is not futures[0]:
+                            self.hedge_wins += 1
+                    return future.result()
+        raise futures[0].exception()
+
+    def get_stats(self):
+        with self.lock:
+            primary = list(self.primary_latencies)
+            effective = list(self.effective_latencies)
+            stats = {'requests': self.requests, 'hedged': self.hedged, 'hedge_wins': self.hedge_wins}
+        stats['hedge_rate'] = stats['hedged'] / stats['requests'] if stats['requests'] else 0.0
+        stats['p99_primary'] = float(np.percentile(primary, 99)) if primary else 0.0
+        stats['p99_effective'] = float(np.percentile(effective, 99)) if effective else 0.0
+        return stats
+
+    def summary_text(self):
+        s = self.get_stats()
+        return (f"对冲请求: {s['hedged']}/{s['requests']}（{s['hedge_rate']:.1%}），对冲先返回 {s['hedge_wins']} 次，"
+                f"P99耗时 {s['p99_primary']:.2f} 秒 -> {s['p99_effective']:.2f} 秒")
+
+class RequestCoalescer:
+    """
+    相同请求合并：同一个键的请求正在进行时，其他线程等待并共用它的结果（或错误），只发出一次网络请求；
+    成功的结果缓存到下一次相同请求取走为止（典型的是先探测再获取的两次相同请求，取走后不再占用内存），
+    按估算的内存占用不超过 max_bytes（最久未用的先淘汰）.
+    返回给调用方的总是副本（调用方会原地修改返回的表）.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.memo = OrderedDict()
+        self.memo_bytes = 0
+        self.calls = 0
+        self.fetched = 0
+        self.coalesced = 0
+        self.memo_hits = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _size(value):
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True, deep=True).sum())
+        return sys.getsizeof(value)
+
+    @staticmethod
+    def _copy(value):
+        return value.copy() if isinstance(value, pd.DataFrame) else value
+
+    def _remember(self, key, value):
+        """缓存结果（调用时持有锁），超出内存上限时淘汰最久未用的结果"""
+        size = self._size(value)
+        if value is None or size > self.max_bytes:
+            return
+        self.memo[key] = (value, size)
+        self.memo_bytes += size
+        while self.memo_bytes > self.max_bytes:
+            _, (_, old_size) = self.memo.popitem(last=False)
+            self.memo_bytes -= old_size
+            self.evicted += 1
+
+    def get(self, key, fetch):
+        """取键对应的结果：有缓存时直接返回，相同请求进行中时等待它，否则调用 fetch()"""
+        with self.lock:
+            self.calls += 1
+            if key in self.memo:
+                value, size = self.memo.pop(key)
+                self.memo_bytes -= size
+                self.memo_hits += 1
+                return self._copy(value)
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Future()
+                self.fetched += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return self._copy(flight.result())
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            flight.set_exception(e)
+            raise
+        with self.lock:
+            self._remember(key, value)
+            del self.inflight[key]
+        flight.set_result(value)
+        return self._copy(value)
+
+    def clear(self):
+        """清空缓存和统计（常驻模式每次更新前调用）"""
+        with self.lock:
+            self.memo.clear()
+            self.memo_bytes = 0
+            self.calls = self.fetched = self.coalesced = self.memo_hits = self.evicted = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'fetched': self.fetched, 'coalesced': self.coalesced,
+                    'memo_hits': self.memo_hits, 'deduplicated': self.coalesced + self.memo_hits,
+                    'evicted': self.evicted, 'memo_entries': len(self.memo), 'memo_bytes': self.memo_bytes}
+
+    def summary_text(self):
+        s = self.get_stats()
+        return (f"相同请求去重: 请求 {s['calls']} 次，实际获取 {s['fetched']} 次，省去 {s['deduplicated']} 次"
+                f"（合并进行中的请求 {s['coalesced']}，命中缓存 {s['memo_hits']}），"
+                f"缓存 {s['memo_entries']} 条 {s['memo_bytes'] / 1024 / 1024:.1f}MB，淘汰 {s['evicted']} 条")
+
+def build_pool(call, config):
+    """按配置建立数据源组. config: {数据源名称: {'weight', 'rate', 'burst'}}，按配置顺序排列"""
+    providers = [PROVIDER_CLASSES[name](call, **options) for name, options in config.items()]
+    return ProviderPool(providers)
@@ -2,7 +2,9 @@
 修复工具 - 确保索引文件中的股票代码都是6位数格式
 """
 import os
-import pandas as pd
+import shutil
+
+import index_store
 
 # 配置
 ROOT_DIR = "D:/股票归档"
@@ -15,6 +17,11 @@ def print_header(message):
     print(message)
     print("=" * 60)
 
+def print_rows(records, limit=5):
+    """打印前几条索引记录"""
+    for row in list(records.values())[:limit]:
+        print("  " + ", ".join(f"{h}={row.get(h, '')}" for h in index_store.INDEX_HEADERS))
+
 def fix_stock_codes():
     """修复索引文件中的股票代码格式"""
     if not os.path.exists(INDEX_FILE):
@@ -25,39 +32,26 @@ def fix_stock_codes():
     
     try:
         # 备份原始文件
-        import shutil
         shutil.copy2(INDEX_FILE, BACKUP_FILE)
         print(f"已备份原始索引文件至: {BACKUP_FILE}")
         
-        # 读取索引文件
-        df = pd.read_csv(INDEX_FILE, encoding='utf-8')
-        
-        # 显示原始数据的前几行
-        print("\n原始索引文件前5行:")
-        print(df.head().to_string())
+        # 直接解析CSV（不使用快照），代码按字符串读取并校验
+        records, report = index_store.parse_index_csv(INDEX_FILE)
+        fixed_codes = report['fixed']
         
-        # 统计需要修复的股票代码数量
-        non_six_digit_codes = 0
-        for _, row in df.iterrows():
-            stock_code = str(row['股票代码'])
-            if len(stock_code) != 6:
-                non_six_digit_codes += 1
+        print("\n索引文件前5行:")
+        print_rows(records)
         
-        print(f"\n检测到 {non_six_digit_codes} 个非6位数股票代码需要修复")
+        print(f"\n检测到 {len(fixed_codes)} 个非6位数股票代码需要修复")
+        if report['invalid']:
+            print(f"检测到 {report['invalid']} 行无效股票代码，将被移除")
+        if report['duplicates']:
+            print(f"检测到 {report['duplicates']} 行重复股票代码，保留最后一行")
         
-        if non_six_digit_codes == 0:
+        if not fixed_codes and not report['invalid'] and not report['duplicates']:
             print("所有股票代码已经是6位数格式，无需修复")
             return True
         
-        # 修复股票代码格式
-        fixed_codes = []
-        for _, row in df.iterrows():
-            stock_code = str(row['股票代码'])
-            if len(stock_code) != 6:
-                fixed_code = stock_code.zfill(6)
-                fixed_codes.append((stock_code, fixed_code))
-                row['股票代码'] = fixed_code
-        
         # 显示部分修复结果
         print("\n部分修复示例:")
         for i, (old_code, new_code) in enumerate(fixed_codes[:10]):
@@ -66,14 +60,10 @@ def fix_stock_codes():
         if len(fixed_codes) > 10:
             print(f"... 以及其他 {len(fixed_codes) - 10} 个代码")
         
-        # 保存修复后的索引文件
-        df.to_csv(INDEX_FILE, index=False, encoding='utf-8')
+        # 保存修复后的索引文件（同时更新二进制快照）
+        index_store.write_index(records, INDEX_FILE)
         print(f"\n已保存修复后的索引文件: {INDEX_FILE}")
         
-        # 显示修复后的数据
-        print("\n修复后的索引文件前5行:")
-        print(df.head().to_string())
-        
         print(f"\n成功修复了 {len(fixed_codes)} 个股票代码")
         return True
         
@@ -0,0 +1,165 @@
+"""
+索引读写 - stock_index.csv 的统一读写接口，主程序、check_files.py、fix_stock_codes.py 共用
+股票代码始终按6位字符串处理（不经过数值类型，不会丢失前导零）. 读取CSV时校验一次，
+并在CSV旁保存二进制快照（<索引>.pkl），CSV未变化时直接读取快照；同一进程内重复读取使用内存中的结果.
+"""
+import os
+import csv
+import pickle
+import threading
+
+INDEX_HEADERS = ['股票代码', '股票名称', '上市日期', '上市年限', '文件路径']
+
+# Windows下用Excel另存的CSV可能是GBK编码
+INDEX_ENCODINGS = ('utf-8-sig', 'gbk')
+SNAPSHOT_VERSION = 1
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+def normalize_code(value):
+    """股票代码统一为6位字符串，无效代码返回空字符串"""
+    code = str(value if value is not None else '').strip()
+    if code.endswith('.0'):
+        # 被当作数值保存过的代码（如 600000.0）
+        code = code[:-2]
+    if not code.isdigit() or len(code) > 6:
+        return ''
+    code = code.zfill(6)
+    return '' if code == '000000' else code
+
+def get_snapshot_path(index_file):
+    return f"{index_file}.pkl"
+
+def _file_stamp(index_file):
+    stat = os.stat(index_file)
+    return stat.st_size, stat.st_mtime_ns
+
+def _read_rows(index_file, encoding):
+    """读取CSV的全部行：有标准表头时按列名，否则按列位置（前5列）"""
+    with open(index_file, 'r', newline='', encoding=encoding) as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return []
+    header = [h.strip() for h in rows[0]]
+    if '股票代码' in header:
+        positions = [header.index(h) if h in header else None for h in INDEX_HEADERS]
+    else:
+        positions = list(range(len(INDEX_HEADERS)))
+    return [{h: (row[pos].strip() if pos is not None and pos < len(row) else '') for h, pos in zip(INDEX_HEADERS, positions)}
+            for row in rows[1:] if row]
+
+def parse_index_csv(index_file):
+    """
+    解析并校验索引CSV. 返回 (记录字典 {代码: 记录}, 校验报告).
+    校验报告: fixed 补齐前导零的代码 [(原代码, 6位代码)]；invalid 无效代码的行数；duplicates 重复代码的行数（保留最后一行）
+    """
+    last_error = None
+    for encoding in INDEX_ENCODINGS:
+        try:
+            rows = _read_rows(index_file, encoding)
+            break
+        except UnicodeDecodeError as e:
+            last_error = e
+    else:
+        raise last_error
+
+    records = {}
+    report = {'fixed': [], 'invalid': 0, 'duplicates': 0}
+    for row in rows:
+        raw_code = row['股票代码']
+        code = normalize_code(raw_code)
+        if not code:
+            report['invalid'] += 1
+            continue
+        if code != raw_code:
+            report['fixed'].append((raw_code, code))
+        if code in records:
+            report['duplicates'] += 1
+        row['股票代码'] = code
+        records[code] = row
+    return records, report
+
+def _load_snapshot(index_file, stamp):
+    try:
+        with open(get_snapshot_path(index_file), 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or tuple(snapshot.get('stamp', ())) != stamp:
+        return None
+    return snapshot['records']
+
+def _save_snapshot(index_file, stamp, records):
+    """保存二进制快照（失败时忽略，下次重新解析CSV）"""
+    snapshot_path = get_snapshot_path(index_file)
+    tmp_path = f"{snapshot_path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'stamp': stamp, 'records': records}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+    except OSError:
+        pass
+
+def _load_records(index_file):
+    """读取索引记录（内存 -> 二进制快照 -> CSV），返回共享的字典，调用方不得修改"""
+    key = os.path.abspath(index_file)
+    stamp = _file_stamp(index_file)
+    with _memo_lock:
+        cached = _memo.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    records = _load_snapshot(index_file, stamp)
+    if records is None:
+        records, _ = parse_index_csv(index_file)
+        _save_snapshot(index_file, stamp, records)
+    with _memo_lock:
+        _memo[key] = (stamp, records)
+    return records
+
+def read_index(index_file):
+    """读取索引，返回 {代码: 记录字典}（每次返回新的副本，可自由修改）. 文件不存在时返回空字典"""
+    if not index_file or not os.path.exists(index_file):
+        return {}
+    return {code: dict(row) for code, row in _load_records(index_file).items()}
+
+def read_index_paths(index_file):
+    """读取 {代码: 文件路径}"""
+    if not index_file or not os.path.exists(index_file):
+        return {}
+    return {code: row['文件路径'] for code, row in _load_records(index_file).items()}
+
+def read_index_names(index_file):
+    """读取 {代码: 股票名称}（只包含有名称的记录）"""
+    if not index_file or not os.path.exists(index_file):
+        return {}
+    return {code: row['股票名称'] for code, row in _load_records(index_file).items() if row['股票名称']}
+
+def write_index(records, index_file):
+    """
+    写入索引（按代码排序，先写临时文件再替换），同时更新二进制快照.
+    records: {代码: 记录} 或记录列表，缺少的列写为空.
+    """
+    if isinstance(records, dict):
+        records = records.values()
+    normalized = {}
+    for record in records:
+        code = normalize_code(record.get('股票代码'))
+        if code:
+            row = {h: '' if record.get(h) is None else str(record.get(h)) for h in INDEX_HEADERS}
+            row['股票代码'] = code
+            normalized[code] = row
+    ordered = {code: normalized[code] for code in sorted(normalized)}
+
+    tmp_path = f"{index_file}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_HEADERS)
+        writer.writeheader()
+        writer.writerows(ordered.values())
+    os.replace(tmp_path, index_file)
+
+    stamp = _file_stamp(index_file)
+    _save_snapshot(index_file, stamp, ordered)
+    with _memo_lock:
+        _memo[os.path.abspath(index_file)] = (stamp, ordered)
+    return len(ordered)
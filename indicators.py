@@ -0,0 +1,234 @@
+"""
+技术指标存储 - 每只股票保存 MA/EMA/MACD/RSI/BOLL 指标序列及其递推状态
+新日线到达时只用保存的状态（EMA种子、滚动窗口等）逐根递推，每根K线的计算量与历史长度无关；
+除权后前复权价整体变化时用向量化方式整段重建. check_parity 比对两种方式的结果.
+"""
+import os
+import math
+
+import numpy as np
+import pandas as pd
+
+# 均线周期
+MA_WINDOWS = (5, 10, 20, 60)
+# MACD参数（快线、慢线、信号线）
+MACD_FAST, MACD_SLOW, MACD_SIGNAL = 12, 26, 9
+# RSI周期（Wilder平滑，alpha = 1/N）
+RSI_PERIOD = 14
+# 布林带周期和标准差倍数（标准差为样本标准差）
+BOLL_PERIOD, BOLL_WIDTH = 20, 2
+
+INDICATOR_COLUMNS = (
+    [f"MA{n}" for n in MA_WINDOWS]
+    + [f"EMA{MACD_FAST}", f"EMA{MACD_SLOW}", "DIF", "DEA", "MACD", f"RSI{RSI_PERIOD}",
+       "BOLL中轨", "BOLL上轨", "BOLL下轨"]
+)
+
+# 递推所需保留的最近收盘价数量
+WINDOW_SIZE = max(max(MA_WINDOWS), BOLL_PERIOD)
+
+def _alpha(span):
+    return 2.0 / (span + 1)
+
+def _rsi(avg_gain, avg_loss):
+    """RSI = 100 × 平均涨幅 / (平均涨幅 + 平均跌幅)，两者都为0时无定义"""
+    total = avg_gain + avg_loss
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, 100.0 * avg_gain / np.where(total > 0, total, 1.0), np.nan)
+
+def compute_indicators(bars):
+    """向量化计算全部历史的指标（bars需含 时间、收盘价，按日期升序），返回 时间 + 各指标列"""
+    close = pd.Series(pd.to_numeric(bars['收盘价'], errors='coerce').to_numpy(dtype=float))
+    out = {'时间': pd.to_datetime(bars['时间']).to_numpy()}
+    for n in MA_WINDOWS:
+        out[f"MA{n}"] = close.rolling(n, min_periods=n).mean().to_numpy()
+
+    ema_fast = close.ewm(span=MACD_FAST, adjust=False).mean()
+    ema_slow = close.ewm(span=MACD_SLOW, adjust=False).mean()
+    dif = ema_fast - ema_slow
+    dea = dif.ewm(span=MACD_SIGNAL, adjust=False).mean()
+    out[f"EMA{MACD_FAST}"] = ema_fast.to_numpy()
+    out[f"EMA{MACD_SLOW}"] = ema_slow.to_numpy()
+    out['DIF'] = dif.to_numpy()
+    out['DEA'] = dea.to_numpy()
+    out['MACD'] = 2 * (dif - dea).to_numpy()
+
+    delta = close.diff()
+    avg_gain = delta.clip(lower=0).ewm(alpha=1.0 / RSI_PERIOD, adjust=False).mean()
+    avg_loss = (-delta).clip(lower=0).ewm(alpha=1.0 / RSI_PERIOD, adjust=False).mean()
+    out[f"RSI{RSI_PERIOD}"] = _rsi(avg_gain.to_numpy(), avg_loss.to_numpy())
+
+    mid = close.rolling(BOLL_PERIOD, min_periods=BOLL_PERIOD).mean()
+    std = close.rolling(BOLL_PERIOD, min_periods=BOLL_PERIOD).std()
+    out['BOLL中轨'] = mid.to_numpy()
+    out['BOLL上轨'] = (mid + BOLL_WIDTH * std).to_numpy()
+    out['BOLL下轨'] = (mid - BOLL_WIDTH * std).to_numpy()
+
+    values = pd.DataFrame(out, columns=['时间'] + INDICATOR_COLUMNS)
+    values.attrs['avg_gain'] = float(avg_gain.iloc[-1]) if len(avg_gain) > 1 else None
+    values.attrs['avg_loss'] = float(avg_loss.iloc[-1]) if len(avg_loss) > 1 else None
+    return values
+
+def _state_from_batch(bars, values):
+    """由整段计算的结果得到继续递推所需的状态"""
+    if values.empty:
+        return None
+    close = pd.to_numeric(bars['收盘价'], errors='coerce').to_numpy(dtype=float)
+    last = values.iloc[-1]
+    return {
+        'last_time': pd.Timestamp(last['时间']),
+        'window': close[-WINDOW_SIZE:].tolist(),
+        'ema_fast': float(last[f"EMA{MACD_FAST}"]),
+        'ema_slow': float(last[f"EMA{MACD_SLOW}"]),
+        'dea': float(last['DEA']),
+        'avg_gain': values.attrs.get('avg_gain'),
+        'avg_loss': values.attrs.get('avg_loss'),
+    }
+
+def rebuild(bars):
+    """整段重建，返回 {'values': 指标表, 'state': 递推状态}"""
+    values = compute_indicators(bars)
+    state = _state_from_batch(bars, values)
+    values.attrs = {}
+    return {'values': values, 'state': state}
+
+def append_bar(state, trade_time, close):
+    """
+    用递推状态追加一根K线（修改state），返回该日的指标字典.
+    只用到最近 WINDOW_SIZE 个收盘价和几个EMA/平滑值，计算量与历史长度无关.
+    """
+    close = float(close)
+    window = state['window']
+    prev_close = window[-1] if window else None
+    window.append(close)
+    if len(window) > WINDOW_SIZE:
+        del window[0]
+
+    row = {'时间': pd.Timestamp(trade_time)}
+    for n in MA_WINDOWS:
+        row[f"MA{n}"] = math.fsum(window[-n:]) / n if len(window) >= n else np.nan
+
+    if prev_close is None:
+        state['ema_fast'] = state['ema_slow'] = close
+        state['dea'] = 0.0
+    else:
+        state['ema_fast'] += _alpha(MACD_FAST) * (close - state['ema_fast'])
+        state['ema_slow'] += _alpha(MACD_SLOW) * (close - state['ema_slow'])
+    dif = state['ema_fast'] - state['ema_slow']
+    if prev_close is not None:
+        state['dea'] += _alpha(MACD_SIGNAL) * (dif - state['dea'])
+    row[f"EMA{MACD_FAST}"] = state['ema_fast']
+    row[f"EMA{MACD_SLOW}"] = state['ema_slow']
+    row['DIF'] = dif
+    row['DEA'] = state['dea']
+    row['MACD'] = 2 * (dif - state['dea'])
+
+    if prev_close is not None:
+        gain = max(close - prev_close, 0.0)
+        loss = max(prev_close - close, 0.0)
+        if state['avg_gain'] is None:
+            state['avg_gain'], state['avg_loss'] = gain, loss
+        else:
+            state['avg_gain'] += (gain - state['avg_gain']) / RSI_PERIOD
+            state['avg_loss'] += (loss - state['avg_loss']) / RSI_PERIOD
+    if state['avg_gain'] is None:
+        row[f"RSI{RSI_PERIOD}"] = np.nan
+    else:
+        row[f"RSI{RSI_PERIOD}"] = float(_rsi(np.float64(state['avg_gain']), np.float64(state['avg_loss'])))
+
+    if len(window) >= BOLL_PERIOD:
+        recent = np.array(window[-BOLL_PERIOD:])
+        mid = math.fsum(recent) / BOLL_PERIOD
+        std = float(np.std(recent, ddof=1))
+        row['BOLL中轨'] = mid
+        row['BOLL上轨'] = mid + BOLL_WIDTH * std
+        row['BOLL下轨'] = mid - BOLL_WIDTH * std
+    else:
+        row['BOLL中轨'] = row['BOLL上轨'] = row['BOLL下轨'] = np.nan
+
+    state['last_time'] = row['时间']
+    return row
+
+def append_bars(store, new_bars):
+    """把新日线逐根递推追加到指标存储，已存在的日期跳过. 返回追加的行数"""
+    if store['state'] is None:
+        store['state'] = {'last_time': None, 'window': [], 'ema_fast': None, 'ema_slow': None,
+                          'dea': None, 'avg_gain': None, 'avg_loss': None}
+    state = store['state']
+    times = pd.to_datetime(new_bars['时间'])
+    closes = pd.to_numeric(new_bars['收盘价'], errors='coerce').to_numpy(dtype=float)
+    rows = [append_bar(state, trade_time, close)
+            for trade_time, close in zip(times, closes)
+            if state['last_time'] is None or trade_time > state['last_time']]
+    if rows:
+        store['values'] = pd.concat([store['values'], pd.DataFrame(rows, columns=['时间'] + INDICATOR_COLUMNS)],
+                                    ignore_index=True)
+    return len(rows)
+
+def get_indicator_path(out_dir, stock_code):
+    return os.path.join(out_dir, f"{str(stock_code).zfill(6)}.pkl")
+
+def load_indicators(out_dir, stock_code):
+    """读取一只股票的指标存储，不存在时返回None"""
+    file_path = get_indicator_path(out_dir, stock_code)
+    if not os.path.exists(file_path):
+        return None
+    try:
+        return pd.read_pickle(file_path)
+    except Exception:
+        return None
+
+def save_indicators(out_dir, stock_code, store):
+    """保存指标存储（先写临时文件再替换）"""
+    os.makedirs(out_dir, exist_ok=True)
+    file_path = get_indicator_path(out_dir, stock_code)
+    tmp_path = f"{file_path}.tmp"
+    pd.to_pickle(store, tmp_path)
+    os.replace(tmp_path, file_path)
+
+def update_indicators(out_dir, stock_code, new_bars, full_refresh=False, load_full_bars=None):
+    """
+    更新一只股票的指标存储.
+    full_refresh=True 时 new_bars 是完整历史（如除权后前复权价整体变化），整段重建；
+    否则用递推状态追加. 本地没有指标存储时调用 load_full_bars() 取完整历史重建.
+    返回 'rebuilt' / 'appended' / 'skipped'.
+    """
+    if full_refresh:
+        save_indicators(out_dir, stock_code, rebuild(new_bars))
+        return 'rebuilt'
+    store = load_indicators(out_dir, stock_code)
+    if store is None:
+        full_bars = load_full_bars() if load_full_bars is not None else None
+        if full_bars is None or full_bars.empty:
+            return 'skipped'
+        store = rebuild(full_bars)
+        append_bars(store, new_bars)
+        save_indicators(out_dir, stock_code, store)
+        return 'rebuilt'
+    if append_bars(store, new_bars):
+        save_indicators(out_dir, stock_code, store)
+        return 'appended'
+    return 'skipped'
+
+def check_parity(bars, split=None):
+    """
+    一致性检查：前split根整段重建，其余逐根递推追加，与整段计算结果比较.
+    返回 {指标: 最大绝对误差}（两边都为空值视为一致，只有一边为空值时误差为inf）.
+    """
+    if split is None:
+        split = len(bars) // 2
+    store = rebuild(bars.iloc[:split])
+    append_bars(store, bars.iloc[split:])
+    incremental = store['values'].reset_index(drop=True)
+    batch = compute_indicators(bars)
+    diffs = {}
+    for col in INDICATOR_COLUMNS:
+        a = incremental[col].to_numpy(dtype=float)
+        b = batch[col].to_numpy(dtype=float)
+        nan_mismatch = np.isnan(a) != np.isnan(b)
+        if nan_mismatch.any():
+            diffs[col] = float('inf')
+            continue
+        both = ~np.isnan(a)
+        diffs[col] = float(np.max(np.abs(a[both] - b[both]))) if both.any() else 0.0
+    return diffs
@@ -0,0 +1,105 @@
+"""
+存储布局 - 归档文件按股票代码固定存放：<store_dir>/<代码前3位>/<代码>.xlsx，位置不随上市年限变化
+按上市年限分组的目录只是视图：<view_dir>/<N>年/<代码>_<名称>.xlsx 是指向存储文件的链接，
+由索引重新生成. 跨年后年限变化时只重建链接，不读取、不移动数据文件.
+"""
+import os
+
+def get_store_path(store_dir, stock_code):
+    """股票归档文件的固定存储路径"""
+    stock_code = str(stock_code).zfill(6)
+    return os.path.join(store_dir, stock_code[:3], f"{stock_code}.xlsx")
+
+def is_store_path(path, store_dir):
+    """路径是否位于代码存储目录中"""
+    if not path:
+        return False
+    store_dir = os.path.abspath(store_dir)
+    return os.path.abspath(path).startswith(store_dir + os.sep)
+
+def get_view_path(view_dir, years, stock_code, stock_name):
+    """年限视图中的链接路径（文件名与按年限存放时的归档文件名相同）"""
+    safe_name = str(stock_name).replace('*', '').replace('ST', '')
+    return os.path.join(view_dir, f"{years}年", f"{str(stock_code).zfill(6)}_{safe_name}.xlsx")
+
+def scan_store(store_dir):
+    """扫描代码存储目录，返回 {股票代码: 文件路径}"""
+    found = {}
+    if not os.path.isdir(store_dir):
+        return found
+    for prefix in os.listdir(store_dir):
+        prefix_dir = os.path.join(store_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for name in os.listdir(prefix_dir):
+            if name.endswith('.xlsx') and not name.startswith('~$') and name[:6].isdigit():
+                found[name[:6]] = os.path.join(prefix_dir, name)
+    return found
+
+def _link_matches(view_path, target):
+    """已有的视图链接是否指向目标文件（硬链接在目标被替换写入后会失效，需要重建）"""
+    if os.path.islink(view_path):
+        return os.path.realpath(view_path) == os.path.realpath(target)
+    try:
+        return os.path.samefile(view_path, target)
+    except OSError:
+        return False
+
+def _make_link(target, view_path, mode):
+    """
+    创建视图链接. mode: symlink / hardlink / auto（先尝试符号链接，
+    Windows无权限创建符号链接时改用硬链接）. 返回实际使用的方式.
+    """
+    if mode in ('symlink', 'auto'):
+        try:
+            os.symlink(os.path.relpath(target, os.path.dirname(view_path)), view_path)
+            return 'symlink'
+        except (OSError, NotImplementedError):
+            if mode == 'symlink':
+                raise
+    os.link(target, view_path)
+    return 'hardlink'
+
+def rebuild_views(entries, view_dir, mode='auto'):
+    """
+    按 entries 重建年限视图: entries 为 [(股票代码, 股票名称, 上市年限, 存储路径)].
+    已正确的链接保持不变，过期的链接（年限或名称变化、硬链接失效）删除后重建.
+    存储文件是唯一的数据来源：视图目录中属于 entries 股票的其他文件都视为过期视图删除；
+    不属于 entries 的股票文件（尚未迁移的旧文件）不做处理.
+    返回统计信息字典.
+    """
+    stats = {'linked': 0, 'kept': 0, 'removed': 0, 'failed': 0, 'mode': mode}
+    desired = {}
+    for stock_code, stock_name, years, store_path in entries:
+        if os.path.exists(store_path):
+            desired[get_view_path(view_dir, years, stock_code, stock_name)] = store_path
+    managed_codes = {os.path.basename(path)[:6] for path in desired}
+
+    existing = set()
+    if os.path.isdir(view_dir):
+        for folder in os.listdir(view_dir):
+            folder_path = os.path.join(view_dir, folder)
+            if not folder.endswith('年') or not os.path.isdir(folder_path):
+                continue
+            for name in os.listdir(folder_path):
+                view_path = os.path.join(folder_path, name)
+                if not name.endswith('.xlsx') or name[:6] not in managed_codes:
+                    continue
+                if view_path in desired and _link_matches(view_path, desired[view_path]):
+                    existing.add(view_path)
+                    stats['kept'] += 1
+                    continue
+                os.remove(view_path)
+                stats['removed'] += 1
+
+    for view_path, store_path in desired.items():
+        if view_path in existing:
+            continue
+        os.makedirs(os.path.dirname(view_path), exist_ok=True)
+        try:
+            # auto 模式第一次退回硬链接后，其余文件直接使用硬链接
+            mode = stats['mode'] = _make_link(store_path, view_path, mode)
+            stats['linked'] += 1
+        except OSError:
+            stats['failed'] += 1
+    return stats
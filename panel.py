@@ -0,0 +1,214 @@
+"""
+面板读取接口 - 一次调用读取多只股票在某段时间内的数据
+通过索引文件定位归档Excel，只读取需要的列和行，多进程并行解析，返回对齐的宽表或长表
+可选的二进制缓存按源文件修改时间自动失效，重复读取时无需再解析Excel
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from openpyxl import load_workbook
+
+import index_store
+
+# 归档Excel中以百分比格式存储的列（读取后还原为百分数，与数据接口口径一致）
+PERCENT_COLUMNS = ['涨幅', '振幅']
+
+# 数量较少时串行读取，省去进程启动开销
+PARALLEL_MIN_FILES = 8
+
+def read_index_paths(index_file):
+    """读取索引文件中的 股票代码 -> 文件路径（代码保持6位字符串）"""
+    return index_store.read_index_paths(index_file)
+
+def _to_datetime(value):
+    """起止日期统一转换为datetime，None保持不变"""
+    if value is None:
+        return None
+    return pd.Timestamp(value).to_pydatetime()
+
+def read_stock_file(file_path, fields=None, start=None, end=None):
+    """
+    流式读取一个归档Excel文件.
+    fields为None时读取全部列；日期升序存储，超过end后立即停止解析后续行.
+    """
+    start = _to_datetime(start)
+    end = _to_datetime(end)
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        ws = wb['Sheet1'] if 'Sheet1' in wb.sheetnames else wb.active
+        rows = ws.iter_rows(values_only=True)
+        header = [str(h) if h is not None else '' for h in next(rows, ())]
+        if '时间' not in header:
+            return pd.DataFrame()
+        columns = ['时间'] + [f for f in (fields if fields is not None else header) if f != '时间' and f in header]
+        positions = [header.index(col) for col in columns]
+        time_pos = positions[0]
+
+        data = []
+        for row in rows:
+            trade_time = row[time_pos] if time_pos < len(row) else None
+            if trade_time is None:
+                continue
+            if isinstance(trade_time, str):
+                try:
+                    trade_time = datetime.fromisoformat(trade_time[:10])
+                except ValueError:
+                    continue
+            if start is not None and trade_time < start:
+                continue
+            if end is not None and trade_time > end:
+                break
+            data.append([trade_time] + [row[pos] if pos < len(row) else None for pos in positions[1:]])
+    finally:
+        wb.close()
+
+    df = pd.DataFrame(data, columns=columns)
+    df['时间'] = pd.to_datetime(df['时间'])
+    for col in columns[1:]:
+        if col == '名称':
+            continue
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+        if col in PERCENT_COLUMNS:
+            df[col] = df[col] * 100
+    return df
+
+def read_first_bar(file_path):
+    """
+    只读取归档Excel的第一行数据（流式解析，读到第一行即停止），用于离线确定上市日期.
+    返回 (第一个交易日, 名称)，文件无法读取或没有数据时返回 (None, None)
+    """
+    try:
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+    except Exception:
+        return None, None
+    try:
+        ws = wb['Sheet1'] if 'Sheet1' in wb.sheetnames else wb.active
+        rows = ws.iter_rows(values_only=True)
+        header = [str(h) if h is not None else '' for h in next(rows, ())]
+        if '时间' not in header:
+            return None, None
+        time_pos = header.index('时间')
+        name_pos = header.index('名称') if '名称' in header else None
+        for row in rows:
+            trade_time = row[time_pos] if time_pos < len(row) else None
+            if trade_time is None:
+                continue
+            if isinstance(trade_time, str):
+                try:
+                    trade_time = datetime.fromisoformat(trade_time[:10])
+                except ValueError:
+                    continue
+            name = row[name_pos] if name_pos is not None and name_pos < len(row) else None
+            return pd.Timestamp(trade_time), name
+    except Exception:
+        return None, None
+    finally:
+        wb.close()
+    return None, None
+
+def read_first_bars(file_map, max_workers=None):
+    """并行读取多个文件的第一行数据. file_map: {股票代码: 文件路径}，返回 {股票代码: (第一个交易日, 名称)}"""
+    codes = list(file_map)
+    paths = [file_map[code] for code in codes]
+    if max_workers == 1 or len(paths) < PARALLEL_MIN_FILES:
+        results = list(map(read_first_bar, paths))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(read_first_bar, paths, chunksize=16))
+    return dict(zip(codes, results))
+
+def read_stock_cached(file_path, cache_dir, fields=None, start=None, end=None):
+    """
+    带二进制缓存的读取：首次解析整个Excel并保存为pickle，之后按源文件大小和修改时间判断是否有效，
+    命中时只需切片，不再解析Excel.
+    """
+    stat = os.stat(file_path)
+    cache_file = os.path.join(cache_dir, os.path.basename(file_path) + ".pkl")
+    df = None
+    if os.path.exists(cache_file):
+        try:
+            cached = pd.read_pickle(cache_file)
+            if cached.attrs.get('source_size') == stat.st_size and cached.attrs.get('source_mtime') == stat.st_mtime_ns:
+                df = cached
+        except Exception:
+            df = None
+    if df is None:
+        df = read_stock_file(file_path)
+        df.attrs['source_size'] = stat.st_size
+        df.attrs['source_mtime'] = stat.st_mtime_ns
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.tmp"
+        df.to_pickle(tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    times = df['时间'].to_numpy()
+    lo = 0 if start is None else times.searchsorted(pd.Timestamp(start).to_datetime64(), side='left')
+    hi = len(df) if end is None else times.searchsorted(pd.Timestamp(end).to_datetime64(), side='right')
+    columns = ['时间'] + [f for f in (fields if fields is not None else df.columns) if f != '时间' and f in df.columns]
+    return df.iloc[lo:hi][columns].reset_index(drop=True)
+
+def _read_panel_item(item):
+    """进程池任务：读取一只股票，失败返回None"""
+    stock_code, file_path, fields, start, end, cache_dir = item
+    try:
+        if cache_dir:
+            df = read_stock_cached(file_path, cache_dir, fields, start, end)
+        else:
+            df = read_stock_file(file_path, fields, start, end)
+    except Exception:
+        return None
+    df.insert(0, '股票代码', stock_code)
+    return df
+
+def read_many(file_map, fields=None, start=None, end=None, max_workers=None, cache_dir=None):
+    """并行读取多只股票，合并为长表. file_map: {股票代码: 文件路径}；cache_dir给出时使用二进制缓存"""
+    items = [(code, path, fields, start, end, cache_dir)
+             for code, path in file_map.items() if path and os.path.exists(path)]
+    if not items:
+        return pd.DataFrame()
+    if max_workers == 1 or len(items) < PARALLEL_MIN_FILES:
+        results = map(_read_panel_item, items)
+        frames = [df for df in results if df is not None]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            frames = [df for df in executor.map(_read_panel_item, items, chunksize=8) if df is not None]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+def load_panel(codes, start=None, end=None, fields=('收盘价',), layout='wide',
+               index_file=None, file_map=None, max_workers=None, cache_dir=None):
+    """
+    读取多只股票在[start, end]内的数据.
+    codes: 股票代码列表（None表示索引中的全部股票）
+    fields: 需要的字段，如 ('开盘价', '收盘价', '总手数')
+    layout: 'long' 返回列为 股票代码、时间、各字段 的长表；
+            'wide' 返回以时间为索引、股票代码为列的宽表（多字段时列为 (字段, 股票代码) 两级）
+    index_file/file_map: 通过索引文件或直接给出 {股票代码: 文件路径} 定位文件
+    cache_dir: 二进制缓存目录，重复读取时跳过Excel解析
+    """
+    if file_map is None:
+        file_map = read_index_paths(index_file)
+    if codes is not None:
+        codes = [str(code).zfill(6) for code in codes]
+        file_map = {code: file_map.get(code, '') for code in codes}
+    fields = [f for f in fields if f != '时间']
+
+    long_df = read_many(file_map, fields, start, end, max_workers, cache_dir)
+    if long_df.empty:
+        long_df = pd.DataFrame(columns=['股票代码', '时间'] + fields)
+    if layout == 'long':
+        return long_df.sort_values(['股票代码', '时间'], kind='mergesort').reset_index(drop=True)
+
+    wide = long_df.pivot(index='时间', columns='股票代码', values=fields if len(fields) > 1 else fields[0])
+    wide = wide.sort_index()
+    if codes is not None:
+        # 保持请求的股票顺序，缺失的股票也保留空列
+        if len(fields) > 1:
+            wide = wide.reindex(columns=pd.MultiIndex.from_product([fields, codes]))
+        else:
+            wide = wide.reindex(columns=codes)
+    return wide
@@ -0,0 +1,199 @@
+"""
+录制/回放数据源 - 在数据接口调用外包一层，录制时保存每次调用的返回结果、耗时和错误，
+回放时按录制的耗时（可按倍速缩放）返回相同结果，不需要联网，性能实验可以重复.
+回放时可按设定的概率注入故障（断开连接、超时、限流、服务器错误、空数据），同一种子下注入位置固定.
+存储: <store_dir>/<接口名>/<宽松键>_<精确键>.rec，每个文件是zlib压缩的pickle.
+"""
+import os
+import time
+import zlib
+import glob
+import json
+import pickle
+import random
+import hashlib
+import threading
+
+# 匹配宽松键时忽略的参数：结束日期通常是录制当天，回放时换了日期也能找到录制
+LOOSE_IGNORED_PARAMS = ('end_date',)
+
+# 注入的故障类型 -> 错误信息（与 safe_request_with_retry 按错误信息区分处理的方式一致）
+FAULT_MESSAGES = {
+    'disconnect': "('Connection aborted.', RemoteDisconnected('Remote end closed connection without response'))",
+    'timeout': "HTTPSConnectionPool: Read timed out. (read timeout=30)",
+    'throttle': "429 Client Error: Too Many Requests",
+    'server': "502 Server Error: Bad Gateway",
+}
+FAULT_KINDS = tuple(FAULT_MESSAGES) + ('empty',)
+
+class ReplayMiss(LookupError):
+    """回放时没有对应的录制"""
+
+class RecordedError(Exception):
+    """回放录制时发生的错误，或注入的故障"""
+
+def parse_faults(text):
+    """解析故障设置 'disconnect:0.02,timeout:0.01' -> {'disconnect': 0.02, 'timeout': 0.01}"""
+    faults = {}
+    for item in filter(None, (part.strip() for part in str(text or '').split(','))):
+        kind, _, rate = item.partition(':')
+        kind = kind.strip()
+        if kind not in FAULT_KINDS:
+            raise ValueError(f"未知的故障类型: {kind}（可选: {', '.join(FAULT_KINDS)}）")
+        faults[kind] = float(rate)
+    return faults
+
+def _digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+def request_keys(api_name, params):
+    """(宽松键, 精确键)：精确键包含全部参数，宽松键忽略 LOOSE_IGNORED_PARAMS"""
+    exact = json.dumps(sorted(params.items()), ensure_ascii=False, default=str)
+    loose = json.dumps(sorted((k, v) for k, v in params.items() if k not in LOOSE_IGNORED_PARAMS),
+                       ensure_ascii=False, default=str)
+    return _digest(f"{api_name}|{loose}"), _digest(f"{api_name}|{exact}")
+
+class RecordReplaySource:
+    """
+    数据接口的录制/回放层. mode:
+      off    直接调用接口
+      record 调用接口并录制结果、耗时和错误（同一请求再次成功时覆盖）
+      replay 只读录制，按 录制耗时 / speed 等待后返回（speed=0 时不等待），可注入故障
+    """
+
+    def __init__(self, store_dir, mode='off', speed=1.0, faults=None, seed=0):
+        if mode not in ('off', 'record', 'replay'):
+            raise ValueError(f"未知的模式: {mode}")
+        self.store_dir = store_dir
+        self.mode = mode
+        self.speed = float(speed)
+        self.faults = dict(faults or {})
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.call_counts = {}
+        self.stats = {'calls': 0, 'recorded': 0, 'replayed': 0, 'loose_hits': 0, 'misses': 0,
+                      'errors': 0, 'faults': 0, 'simulated_seconds': 0.0}
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _entry_path(self, api_name, loose_key, exact_key):
+        return os.path.join(self.store_dir, api_name, f"{loose_key}_{exact_key}.rec")
+
+    def _load_entry(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _save_entry(self, path, entry):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
+
+    def call(self, api_name, func, **params):
+        """调用接口（func(**params)），按当前模式录制或回放"""
+        self._count('calls')
+        if self.mode == 'replay':
+            return self._replay(api_name, params)
+        if self.mode == 'off':
+            return func(**params)
+        return self._record(api_name, func, params)
+
+    def _record(self, api_name, func, params):
+        path = self._entry_path(api_name, *request_keys(api_name, params))
+        start = time.perf_counter()
+        try:
+            result = func(**params)
+        except Exception as e:
+            # 只在还没有成功录制时保存错误，回放时重现同样的失败
+            if not os.path.exists(path):
+                self._save_entry(path, {'api': api_name, 'params': params, 'result': None,
+                                        'error': str(e), 'elapsed': time.perf_counter() - start,
+                                        'recorded_at': time.time()})
+                self._count('recorded')
+            raise
+        self._save_entry(path, {'api': api_name, 'params': params, 'result': result, 'error': None,
+                                'elapsed': time.perf_counter() - start, 'recorded_at': time.time()})
+        self._count('recorded')
+        return result
+
+    def _find_entry(self, api_name, params):
+        """先按精确键查找，找不到时用宽松键匹配最近的一次录制"""
+        loose_key, exact_key = request_keys(api_name, params)
+        entry = self._load_entry(self._entry_path(api_name, loose_key, exact_key))
+        if entry is not None:
+            return entry, exact_key
+        candidates = glob.glob(os.path.join(self.store_dir, api_name, f"{loose_key}_*.rec"))
+        if candidates:
+            entry = self._load_entry(max(candidates, key=os.path.getmtime))
+            if entry is not None:
+                self._count('loose_hits')
+                return entry, exact_key
+        return None, exact_key
+
+    def _sleep(self, seconds):
+        """按录制的耗时等待（simulated_seconds 累计录制时的耗时，与倍速无关）"""
+        self._count('simulated_seconds', seconds)
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def _pick_fault(self, exact_key):
+        """按请求键和该请求的调用次数决定是否注入故障（与线程调度顺序无关，结果可重复）"""
+        if not self.faults:
+            return None
+        with self.lock:
+            n = self.call_counts[exact_key] = self.call_counts.get(exact_key, 0) + 1
+        roll = random.Random(f"{self.seed}|{exact_key}|{n}").random()
+        for kind in FAULT_KINDS:
+            rate = self.faults.get(kind, 0.0)
+            if roll < rate:
+                return kind
+            roll -= rate
+        return None
+
+    def _replay(self, api_name, params):
+        entry, exact_key = self._find_entry(api_name, params)
+        if entry is None:
+            self._count('misses')
+            raise ReplayMiss(f"没有录制: {api_name} {params}")
+
+        fault = self._pick_fault(exact_key)
+        if fault is not None:
+            self._count('faults')
+            if fault == 'empty':
+                self._sleep(entry['elapsed'])
+                result = entry['result']
+                return result.iloc[0:0] if hasattr(result, 'iloc') else None
+            # 超时故障按30秒计，其余故障立即返回
+            self._sleep(30.0 if fault == 'timeout' else 0.0)
+            raise RecordedError(FAULT_MESSAGES[fault])
+
+        self._sleep(entry['elapsed'])
+        if entry['error'] is not None:
+            self._count('errors')
+            raise RecordedError(entry['error'])
+        self._count('replayed')
+        result = entry['result']
+        # 宽松键匹配到的录制可能超出请求的结束日期，截掉多余的行
+        end_date = params.get('end_date')
+        if end_date and hasattr(result, 'columns') and '日期' in result.columns:
+            dates = result['日期'].astype(str).str.replace('-', '', regex=False).str[:8]
+            result = result[dates <= str(end_date).replace('-', '')]
+        return result.copy() if hasattr(result, 'copy') else result
+
+    def get_summary(self):
+        with self.lock:
+            return dict(self.stats, mode=self.mode, speed=self.speed)
+
+    def summary_text(self):
+        s = self.get_summary()
+        if s['mode'] == 'record':
+            return f"录制: 调用 {s['calls']} 次，保存 {s['recorded']} 条"
+        return (f"回放({s['speed']:g}倍速): 调用 {s['calls']} 次，命中 {s['replayed']}（宽松匹配 {s['loose_hits']}），"
+                f"未录制 {s['misses']}，录制的错误 {s['errors']}，注入故障 {s['faults']}，"
+                f"模拟耗时 {s['simulated_seconds']:.1f} 秒")
@@ -0,0 +1,185 @@
+"""
+周线/月线重采样 - 由本地归档的日线数据生成周K线、月K线
+所有股票合并为一张长表后一次分组聚合（向量化），不逐只股票循环
+结果按周期起始年份分区保存在日线数据旁边，新日线到达时增量合并
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from panel import read_many
+
+# 频率 -> (pandas周期规则, 目录名)
+RESAMPLE_FREQS = {
+    'W': ('W-FRI', '周线'),
+    'M': ('M', '月线'),
+}
+
+# 重采样结果的列（前收盘用于增量合并时重新计算振幅）
+RESAMPLED_COLUMNS = [
+    "股票代码", "周期", "时间", "开盘价", "最高价", "最低价", "收盘价", "涨幅",
+    "振幅", "总手数", "金额", "换手率", "成交次数", "名称", "前收盘"
+]
+
+# 分组聚合规则：所有规则都满足结合律，因此已聚合的周期行可以与新日线再次聚合
+_AGG_RULES = {
+    '时间': 'last',
+    '开盘价': 'first',
+    '最高价': 'max',
+    '最低价': 'min',
+    '收盘价': 'last',
+    '总手数': 'sum',
+    '金额': 'sum',
+    '换手率': 'sum',
+    '成交次数': 'sum',
+    '名称': 'last',
+    '前收盘': 'first',
+    '_增长': 'prod',
+}
+
+def load_archive_frame(file_map, max_workers=None, cache_dir=None):
+    """并行读取多只股票的归档文件，合并为一张长表. file_map: {股票代码: 文件路径}"""
+    return read_many(file_map, max_workers=max_workers, cache_dir=cache_dir)
+
+def _prepare_daily(daily):
+    """日线转为可聚合的行：增长因子 = 1 + 涨幅，前收盘由收盘价和涨幅反推"""
+    df = daily.copy()
+    df['时间'] = pd.to_datetime(df['时间'])
+    growth = 1 + pd.to_numeric(df['涨幅'], errors='coerce').fillna(0).to_numpy(dtype=float) / 100
+    df['_增长'] = growth
+    df['前收盘'] = df['收盘价'].to_numpy(dtype=float) / np.where(growth > 0, growth, 1.0)
+    return df
+
+def _prepare_resampled(resampled):
+    """已聚合的周期行转为可再次聚合的行"""
+    df = resampled.copy()
+    df['_增长'] = 1 + df['涨幅'].to_numpy(dtype=float) / 100
+    return df
+
+def _aggregate(rows, freq):
+    """按(股票代码, 周期)一次分组聚合"""
+    rule = RESAMPLE_FREQS[freq][0]
+    if '周期' not in rows.columns:
+        rows = rows.assign(周期=rows['时间'].dt.to_period(rule))
+    rows = rows.sort_values(['股票代码', '时间'], kind='mergesort')
+    agg_rules = {col: how for col, how in _AGG_RULES.items() if col in rows.columns}
+    out = rows.groupby(['股票代码', '周期'], sort=True, observed=True).agg(agg_rules).reset_index()
+
+    out['涨幅'] = (out.pop('_增长') - 1) * 100
+    prev_close = out['前收盘'].to_numpy(dtype=float)
+    out['振幅'] = np.where(prev_close > 0,
+                         (out['最高价'].to_numpy(dtype=float) - out['最低价'].to_numpy(dtype=float)) / np.where(prev_close > 0, prev_close, 1.0) * 100,
+                         0.0)
+    return out[[col for col in RESAMPLED_COLUMNS if col in out.columns]]
+
+def resample_bars(daily, freq='W'):
+    """将多只股票的日线长表（需含 股票代码、时间）重采样为周线或月线"""
+    if daily is None or daily.empty:
+        return pd.DataFrame(columns=RESAMPLED_COLUMNS)
+    return _aggregate(_prepare_daily(daily), freq)
+
+def get_resample_dir(out_dir, freq):
+    """某个频率的结果目录"""
+    return os.path.join(out_dir, RESAMPLE_FREQS[freq][1])
+
+def _partition_years(resampled):
+    """分区键：周期起始年份（周期跨年时也保持稳定）"""
+    return resampled['周期'].dt.start_time.dt.year
+
+def save_resampled(resampled, out_dir, freq, years=None):
+    """按年份分区写入，years指定时只写这些年份（含清空后为空的年份）"""
+    target_dir = get_resample_dir(out_dir, freq)
+    os.makedirs(target_dir, exist_ok=True)
+    partition = _partition_years(resampled) if not resampled.empty else pd.Series(dtype=int)
+    if years is None:
+        years = sorted(set(partition.tolist()))
+    for year in years:
+        part = resampled[partition == year].reset_index(drop=True)
+        file_path = os.path.join(target_dir, f"{year}.pkl")
+        tmp_path = f"{file_path}.tmp"
+        part.to_pickle(tmp_path)
+        os.replace(tmp_path, file_path)
+
+def load_resampled(out_dir, freq='W', codes=None, start_year=None, end_year=None):
+    """读取重采样结果，可按股票代码和年份过滤"""
+    target_dir = get_resample_dir(out_dir, freq)
+    if not os.path.isdir(target_dir):
+        return pd.DataFrame(columns=RESAMPLED_COLUMNS)
+    frames = []
+    for name in sorted(os.listdir(target_dir)):
+        if not name.endswith('.pkl'):
+            continue
+        year = int(name[:-4])
+        if (start_year is not None and year < start_year) or (end_year is not None and year > end_year):
+            continue
+        part = pd.read_pickle(os.path.join(target_dir, name))
+        if codes is not None:
+            part = part[part['股票代码'].isin(codes)]
+        frames.append(part)
+    if not frames:
+        return pd.DataFrame(columns=RESAMPLED_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def rebuild_resampled(daily, out_dir, freqs=('W', 'M')):
+    """由全部日线重建重采样结果，返回各频率的行数"""
+    counts = {}
+    for freq in freqs:
+        resampled = resample_bars(daily, freq)
+        target_dir = get_resample_dir(out_dir, freq)
+        if os.path.isdir(target_dir):
+            for name in os.listdir(target_dir):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(target_dir, name))
+        save_resampled(resampled, out_dir, freq)
+        counts[freq] = len(resampled)
+    return counts
+
+def update_resampled(new_daily, out_dir, freqs=('W', 'M'), full_codes=()):
+    """
+    将新到达的日线增量合并到重采样结果.
+    new_daily: 新日线长表；full_codes中的股票视为给出了完整历史（如除权后前复权价整体变化），
+    其已有结果全部替换. 其余股票只合并晚于已有最后日期的日线，重复运行不会重复累加.
+    返回各频率受影响的行数.
+    """
+    counts = {}
+    if new_daily is None or new_daily.empty:
+        return counts
+    full_codes = set(full_codes)
+    for freq in freqs:
+        rows = _prepare_daily(new_daily)
+        rows['周期'] = rows['时间'].dt.to_period(RESAMPLE_FREQS[freq][0])
+
+        # 全量替换的股票需要读取所有年份，其余只读取新数据涉及的年份
+        touched_years = set(rows['周期'].dt.start_time.dt.year.tolist())
+        stored = load_resampled(out_dir, freq,
+                                start_year=None if full_codes else min(touched_years))
+        if not stored.empty:
+            replaced = stored['股票代码'].isin(full_codes)
+            touched_years |= set(_partition_years(stored[replaced]).tolist())
+            stored = stored[~replaced]
+
+            # 去掉已经聚合过的日线
+            last_time = stored.groupby('股票代码')['时间'].max()
+            known_last = rows['股票代码'].map(last_time)
+            rows = rows[known_last.isna() | (rows['时间'] > known_last)]
+
+        if rows.empty and not full_codes:
+            counts[freq] = 0
+            continue
+
+        affected_keys = rows[['股票代码', '周期']].drop_duplicates()
+        if not stored.empty:
+            key_index = pd.MultiIndex.from_frame(affected_keys)
+            stored_keys = pd.MultiIndex.from_frame(stored[['股票代码', '周期']])
+            is_affected = stored_keys.isin(key_index)
+            merged = _aggregate(pd.concat([_prepare_resampled(stored[is_affected]), rows], ignore_index=True), freq)
+            result = pd.concat([stored[~is_affected], merged], ignore_index=True)
+        else:
+            merged = _aggregate(rows, freq)
+            result = merged
+
+        result = result.sort_values(['股票代码', '时间'], kind='mergesort').reset_index(drop=True)
+        save_resampled(result, out_dir, freq, years=sorted(touched_years))
+        counts[freq] = len(merged)
+    return counts
@@ -0,0 +1,104 @@
+"""
+入库数据校验 - 声明式规则，向量化检查每一批日线数据
+规则只依赖NumPy数组运算，7000行的数据整体校验在1毫秒以内
+"""
+import numpy as np
+import pandas as pd
+
+# 金额与 总手数×100×价格 的允许偏差（成交均价应落在 [最低价, 最高价] 附近）
+AMOUNT_TOLERANCE = 0.05
+
+# 校验规则：
+#   name     规则名称（用于统计和隔离记录）
+#   severity error=拒绝写入并隔离；warning=照常写入，但隔离等待下次重新获取
+#   raw_only 只对不复权数据有意义的规则（前复权价格可能为负，成交均价也与复权价不可比）
+#   check    输入各列的NumPy数组字典，返回违规行的布尔数组
+VALIDATION_RULES = [
+    {
+        'name': '数值缺失',
+        'severity': 'error',
+        'raw_only': False,
+        'check': lambda v: np.isnan(v['开盘价']) | np.isnan(v['最高价']) | np.isnan(v['最低价'])
+                           | np.isnan(v['收盘价']) | np.isnan(v['总手数']),
+    },
+    {
+        # 只有量价、没有成交额的数据源（如腾讯）的数据不入库，隔离后重新获取
+        'name': '金额缺失',
+        'severity': 'error',
+        'raw_only': False,
+        'check': lambda v: np.isnan(v['金额']),
+    },
+    {
+        'name': '最高价低于最低价',
+        'severity': 'error',
+        'raw_only': False,
+        'check': lambda v: v['最高价'] < v['最低价'],
+    },
+    {
+        'name': '价格为零或负数',
+        'severity': 'error',
+        'raw_only': True,
+        'check': lambda v: (v['开盘价'] <= 0) | (v['最高价'] <= 0) | (v['最低价'] <= 0) | (v['收盘价'] <= 0),
+    },
+    {
+        'name': '开收盘超出高低价范围',
+        'severity': 'warning',
+        'raw_only': False,
+        'check': lambda v: (np.maximum(v['开盘价'], v['收盘价']) > v['最高价'] + 0.005)
+                           | (np.minimum(v['开盘价'], v['收盘价']) < v['最低价'] - 0.005),
+    },
+    {
+        'name': '日期重复',
+        'severity': 'error',
+        'raw_only': False,
+        'check': lambda v: np.concatenate(([False], v['时间'][1:] == v['时间'][:-1])),
+    },
+    {
+        'name': '日期非递增',
+        'severity': 'error',
+        'raw_only': False,
+        'check': lambda v: np.concatenate(([False], v['时间'][1:] < v['时间'][:-1])),
+    },
+    {
+        'name': '金额与总手数×价格不符',
+        'severity': 'warning',
+        'raw_only': True,
+        'check': lambda v: (v['总手数'] > 0) & (
+            (v['金额'] < v['总手数'] * 100 * v['最低价'] * (1 - AMOUNT_TOLERANCE))
+            | (v['金额'] > v['总手数'] * 100 * v['最高价'] * (1 + AMOUNT_TOLERANCE))),
+    },
+]
+
+VALUE_COLUMNS = ['开盘价', '最高价', '最低价', '收盘价', '总手数', '金额']
+
+def prepare_arrays(bars):
+    """取出规则需要的列（数值列转为float数组，日期转为int64便于比较）"""
+    values = {col: bars[col].to_numpy(dtype=float, na_value=np.nan) for col in VALUE_COLUMNS}
+    times = bars['时间']
+    if not pd.api.types.is_datetime64_any_dtype(times):
+        times = pd.to_datetime(times)
+    values['时间'] = times.to_numpy(dtype='datetime64[ns]').view('int64')
+    return values
+
+def validate_bars(bars, raw=True, rules=None):
+    """
+    校验一批日线（单只股票，按日期排列）.
+    raw: 是否为不复权数据，为False时跳过只适用于不复权数据的规则
+    返回 {规则名称: 违规行数}，只包含有违规的规则
+    """
+    if bars is None or len(bars) == 0:
+        return {}
+    values = prepare_arrays(bars)
+    violations = {}
+    for rule in (rules if rules is not None else VALIDATION_RULES):
+        if rule['raw_only'] and not raw:
+            continue
+        count = int(np.count_nonzero(rule['check'](values)))
+        if count:
+            violations[rule['name']] = count
+    return violations
+
+def has_errors(violations, rules=None):
+    """是否包含error级别的违规"""
+    severity = {rule['name']: rule['severity'] for rule in (rules if rules is not None else VALIDATION_RULES)}
+    return any(severity.get(name) == 'error' for name in violations)
@@ -0,0 +1,172 @@
+"""
+时段调度 - 按时段（深夜/高峰/其他）控制请求吞吐
+每个时段有请求速率上限；大批量补数（backfill，如初始化）只在允许的时段（默认深夜）进行，其余时段等待；
+日常更新（urgent）任何时段都可以进行，但白天高峰按较低的速率.
+按时段统计实际完成的请求数和忙碌时间（保存在统计文件中，跨运行累积），据此估算一个任务的完成时间.
+时段划分由调用方传入的 classify(datetime) 决定，本模块不依赖主程序.
+"""
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+# 两次完成之间超过这个秒数视为空闲（如等待下一个时段），不计入忙碌时间
+IDLE_GAP_SECONDS = 60
+# 某时段实测样本少于这个请求数时，按配置的速率上限估算
+MIN_MEASURED_REQUESTS = 50
+# 累积的请求数超过这个数时统计减半，让估算偏向近期的吞吐
+DECAY_THRESHOLD = 20000
+# 估算完成时间最多向后推算的天数
+MAX_PROJECTION_DAYS = 60
+
+class WindowScheduler:
+    """
+    budgets: {时段名称: {'rate': 每秒请求数上限, 'backfill': 是否允许补数任务}}
+    enabled=False 时不限速、不推迟，只统计吞吐和估算完成时间.
+    """
+
+    def __init__(self, classify, budgets, stats_file=None, enabled=True):
+        self.classify = classify
+        self.budgets = budgets
+        self.stats_file = stats_file
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.last_done = None
+        self.kind = 'urgent'
+        self.deferred_seconds = 0.0
+        self.stats = self._load_stats()
+
+    # ---------- 统计 ----------
+
+    def _load_stats(self):
+        stats = {name: {'requests': 0.0, 'seconds': 0.0} for name in self.budgets}
+        if self.stats_file and os.path.exists(self.stats_file):
+            try:
+                with open(self.stats_file, 'r', encoding='utf-8') as f:
+                    for name, values in json.load(f).items():
+                        if name in stats:
+                            stats[name] = {'requests': float(values['requests']), 'seconds': float(values['seconds'])}
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        return stats
+
+    def save_stats(self):
+        if not self.stats_file:
+            return
+        with self.lock:
+            data = json.dumps(self.stats, ensure_ascii=False, indent=2)
+        tmp_path = f"{self.stats_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.stats_file)
+
+    def record_done(self, now=None):
+        """记录完成一个请求：计入当前时段，两次完成之间的时间计为忙碌时间（空闲间隔除外）"""
+        now = now or datetime.now()
+        window = self.classify(now)
+        with self.lock:
+            entry = self.stats.setdefault(window, {'requests': 0.0, 'seconds': 0.0})
+            entry['requests'] += 1
+            if self.last_done is not None:
+                gap = (now - self.last_done).total_seconds()
+                if 0 < gap <= IDLE_GAP_SECONDS:
+                    entry['seconds'] += gap
+            self.last_done = now
+            if entry['requests'] > DECAY_THRESHOLD:
+                entry['requests'] /= 2
+                entry['seconds'] /= 2
+
+    def measured_rate(self, window):
+        """某时段实测的每秒请求数，样本不足时返回None"""
+        with self.lock:
+            entry = self.stats.get(window)
+            if not entry or entry['requests'] < MIN_MEASURED_REQUESTS or entry['seconds'] <= 0:
+                return None
+            return entry['requests'] / entry['seconds']
+
+    def effective_rate(self, window):
+        """估算用的速率：实测速率，不超过该时段的速率上限（启用限速时）"""
+        limit = self.budgets[window]['rate']
+        measured = self.measured_rate(window)
+        if measured is None:
+            return limit
+        return min(measured, limit) if self.enabled else measured
+
+    # ---------- 调度 ----------
+
+    def allowed(self, window, kind):
+        return kind != 'backfill' or self.budgets[window].get('backfill', False)
+
+    def next_allowed_time(self, now, kind):
+        """从now起下一个允许该类任务的时刻（按分钟推进）"""
+        moment = now
+        limit = now + timedelta(days=2)
+        while moment < limit:
+            if self.allowed(self.classify(moment), kind):
+                return moment
+            moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        return moment
+
+    def acquire(self, kind=None):
+        """
+        请求前调用：补数任务在不允许的时段等待到允许的时段；再按当前时段的速率上限排队.
+        未启用时立即返回. 返回等待的秒数.
+        """
+        if not self.enabled:
+            return 0.0
+        kind = kind or self.kind
+        waited = 0.0
+        while True:
+            now = datetime.now()
+            window = self.classify(now)
+            if not self.allowed(window, kind):
+                # 分段等待，期间配置或时钟变化时重新判断
+                wait = min(max((self.next_allowed_time(now, kind) - now).total_seconds(), 1.0), 300.0)
+                time.sleep(wait)
+                waited += wait
+                with self.lock:
+                    self.deferred_seconds += wait
+                continue
+            interval = 1.0 / self.budgets[window]['rate']
+            with self.lock:
+                current = time.monotonic()
+                slot = max(self.next_slot, current)
+                self.next_slot = slot + interval
+            if slot > current:
+                time.sleep(slot - current)
+                waited += slot - current
+            return waited
+
+    def project_completion(self, requests, kind=None, start=None):
+        """
+        估算完成 requests 个请求的时刻：从start起按时段推进，每个时段按实测速率（受速率上限约束）完成请求，
+        补数任务跳过不允许的时段. 超过 MAX_PROJECTION_DAYS 天仍未完成时返回None.
+        """
+        kind = kind or self.kind
+        moment = start or datetime.now()
+        remaining = float(requests)
+        limit = moment + timedelta(days=MAX_PROJECTION_DAYS)
+        while remaining > 0:
+            if moment >= limit:
+                return None
+            step_end = moment.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            window = self.classify(moment)
+            if self.allowed(window, kind):
+                capacity = self.effective_rate(window) * (step_end - moment).total_seconds()
+                if capacity >= remaining:
+                    return moment + timedelta(seconds=remaining / self.effective_rate(window))
+                remaining -= capacity
+            moment = step_end
+        return moment
+
+    def summary_lines(self):
+        """各时段的速率上限和实测吞吐"""
+        lines = []
+        for window, budget in self.budgets.items():
+            measured = self.measured_rate(window)
+            lines.append(f"{window}: 上限 {budget['rate'] * 3600:.0f} 次/小时，"
+                         f"实测 {'样本不足' if measured is None else f'{measured * 3600:.0f} 次/小时'}，"
+                         f"{'允许' if budget.get('backfill') else '不允许'}补数")
+        return lines
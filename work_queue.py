@@ -0,0 +1,220 @@
+"""
+多进程协作工作队列 - 多个进程共用一个归档目录时，通过SQLite（WAL模式）协调任务
+每只股票是一个任务，进程以限时租约领取，完成结果与任务状态在同一事务中提交；
+进程崩溃后租约到期，任务自动被其他进程重新领取. 共享令牌桶限制所有进程合计的请求速率.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    run_id TEXT NOT NULL,
+    stock_code TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT NOT NULL DEFAULT '',
+    lease_expires REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    flushed INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, stock_code)
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_claim ON tasks (run_id, status, lease_expires);
+CREATE TABLE IF NOT EXISTS rate_tokens (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+class WorkQueue:
+    """
+    基于SQLite的任务队列.
+    任务状态: pending 等待领取 -> leased 已被某进程领取（租约到期前有效）-> done 完成 / failed 超过最大尝试次数
+    每个线程使用独立连接；所有写操作都在 BEGIN IMMEDIATE 事务中完成，保证领取和提交是原子的.
+    """
+
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3, busy_timeout=60):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+
+    def _conn(self):
+        """当前线程的数据库连接（自动提交模式，事务由 _transaction 显式控制）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """写事务：BEGIN IMMEDIATE 立即取得写锁，异常时回滚"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ---------- 任务 ----------
+
+    def has_run(self, run_id):
+        """该批次是否已经建立过任务"""
+        row = self._conn().execute("SELECT 1 FROM tasks WHERE run_id = ? LIMIT 1", (run_id,)).fetchone()
+        return row is not None
+
+    def enqueue(self, run_id, items):
+        """
+        加入任务. items: [(股票代码, payload字典)]. 已存在的任务保持不变，
+        因此多个进程同时为同一批次建立任务也不会重复. 返回新加入的任务数.
+        """
+        now = time.time()
+        rows = [(run_id, str(code).zfill(6), json.dumps(payload, ensure_ascii=False, default=str), now)
+                for code, payload in items]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO tasks (run_id, stock_code, payload, updated) VALUES (?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+
+    def claim(self, run_id, worker, limit=1):
+        """
+        领取任务（包括租约已过期的任务），返回 [(股票代码, payload字典)].
+        超过最大尝试次数且租约过期的任务标记为 failed，不再分配.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE tasks SET status = 'failed', updated = ? "
+                         "WHERE run_id = ? AND status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                         (now, run_id, now, self.max_attempts))
+            rows = conn.execute(
+                "SELECT stock_code, payload FROM tasks WHERE run_id = ? AND "
+                "(status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                "ORDER BY attempts, stock_code LIMIT ?", (run_id, now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+                "WHERE run_id = ? AND stock_code = ?",
+                [(worker, now + self.lease_seconds, now, run_id, code) for code, _ in rows])
+        return [(code, json.loads(payload)) for code, payload in rows]
+
+    def complete(self, run_id, worker, stock_code, result=None):
+        """
+        提交完成的任务和结果（同一事务）. 租约已被其他进程接管时返回False，结果不写入.
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, flushed = 0, updated = ? "
+                "WHERE run_id = ? AND stock_code = ? AND status = 'leased' AND worker = ?",
+                (None if result is None else json.dumps(result, ensure_ascii=False, default=str),
+                 time.time(), run_id, stock_code, worker))
+            return cursor.rowcount == 1
+
+    def fail(self, run_id, worker, stock_code):
+        """任务失败：未超过最大尝试次数时放回等待领取，否则标记为 failed"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = '', lease_expires = 0, updated = ? "
+                "WHERE run_id = ? AND stock_code = ? AND status = 'leased' AND worker = ?",
+                (self.max_attempts, time.time(), run_id, stock_code, worker))
+
+    def counts(self, run_id):
+        """各状态的任务数（租约已过期的 leased 计为 expired）"""
+        now = time.time()
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0, 'failed': 0}
+        rows = self._conn().execute(
+            "SELECT CASE WHEN status = 'leased' AND lease_expires < ? THEN 'expired' ELSE status END, COUNT(*) "
+            "FROM tasks WHERE run_id = ? GROUP BY 1", (now, run_id)).fetchall()
+        for status, count in rows:
+            counts[status] = count
+        return counts
+
+    def runs(self):
+        """已建立的全部批次（按最近更新时间倒序）"""
+        rows = self._conn().execute("SELECT run_id, MAX(updated) FROM tasks GROUP BY run_id ORDER BY 2 DESC").fetchall()
+        return [run_id for run_id, _ in rows]
+
+    def flush_results(self, run_id, writer):
+        """
+        把已完成但尚未写出的结果交给 writer(结果列表) 写出（如写索引文件）.
+        整个过程持有数据库写锁，多个进程不会同时写同一个文件；writer抛出异常时结果保持未写出状态.
+        返回写出的结果数.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT stock_code, result FROM tasks WHERE run_id = ? AND status = 'done' "
+                                "AND flushed = 0 AND result IS NOT NULL", (run_id,)).fetchall()
+            if rows:
+                writer([json.loads(result) for _, result in rows])
+                conn.executemany("UPDATE tasks SET flushed = 1 WHERE run_id = ? AND stock_code = ?",
+                                 [(run_id, code) for code, _ in rows])
+            return len(rows)
+
+    @contextmanager
+    def exclusive(self):
+        """持有数据库写锁执行一段操作（用于多个进程共用的文件，如横截面存储）"""
+        with self._transaction():
+            yield
+
+    # ---------- 共享速率限制 ----------
+
+    def acquire_token(self, name, rate, burst):
+        """
+        从共享令牌桶取一个令牌（所有进程合计不超过 rate 次/秒，允许 burst 次突发），
+        令牌不足时等待. 返回等待的秒数.
+        """
+        waited = 0.0
+        while True:
+            now = time.time()
+            with self._transaction() as conn:
+                row = conn.execute("SELECT tokens, updated FROM rate_tokens WHERE name = ?", (name,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                if tokens >= 1:
+                    conn.execute("INSERT OR REPLACE INTO rate_tokens (name, tokens, updated) VALUES (?, ?, ?)",
+                                 (name, tokens - 1, now))
+                    return waited
+                conn.execute("INSERT OR REPLACE INTO rate_tokens (name, tokens, updated) VALUES (?, ?, ?)",
+                             (name, tokens, now))
+            wait = (1 - tokens) / rate
+            time.sleep(wait)
+            waited += wait
+
+class SharedRateLimiter:
+    """进程间共享的请求速率限制（供请求函数在发出请求前调用）"""
+
+    def __init__(self, queue, name='akshare', rate=2.0, burst=4):
+        self.queue = queue
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.acquired = 0
+
+    def acquire(self):
+        waited = self.queue.acquire_token(self.name, self.rate, self.burst)
+        with self.lock:
+            self.waited += waited
+            self.acquired += 1
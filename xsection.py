@@ -0,0 +1,171 @@
+"""
+横截面存储 - 按交易日保存全市场数据，每个交易日一个文件，包含当天所有股票的12个字段
+用于"某一天全市场"的筛选查询，只需读取一个文件，不必打开每只股票的归档
+价格为当日实际成交价（不复权），因此历史日文件不会因除权除息而改变，更新时只追加
+"""
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from panel import read_stock_cached, read_stock_file
+
+XSECTION_COLUMNS = [
+    "股票代码", "时间", "开盘价", "最高价", "最低价", "收盘价", "涨幅",
+    "振幅", "总手数", "金额", "换手率", "成交次数", "名称"
+]
+
+def get_day_path(out_dir, day):
+    """某个交易日的文件路径：<out_dir>/<年>/<YYYYMMDD>.pkl"""
+    day = pd.Timestamp(day)
+    return os.path.join(out_dir, f"{day.year}", f"{day.strftime('%Y%m%d')}.pkl")
+
+def _write_day(day_rows, file_path):
+    """写入一个交易日文件（先写临时文件再替换）"""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    day_rows = day_rows.sort_values('股票代码', kind='mergesort').reset_index(drop=True)
+    tmp_path = f"{file_path}.tmp"
+    day_rows.to_pickle(tmp_path)
+    os.replace(tmp_path, file_path)
+
+def _normalize(bars):
+    """整理为横截面存储的列格式"""
+    bars = bars.copy()
+    bars['时间'] = pd.to_datetime(bars['时间']).dt.normalize()
+    bars['股票代码'] = bars['股票代码'].astype(str).str.zfill(6)
+    for col in XSECTION_COLUMNS:
+        if col not in bars.columns:
+            bars[col] = '' if col == '名称' else 0
+    return bars[XSECTION_COLUMNS]
+
+def append_bars(bars, out_dir):
+    """
+    把新日线（多只股票的长表，需含 股票代码、时间）合并到对应的交易日文件.
+    同一股票同一天已存在时以新数据为准. 返回写入的交易日数.
+    """
+    if bars is None or bars.empty:
+        return 0
+    bars = _normalize(bars)
+    days = 0
+    for day, day_rows in bars.groupby('时间', sort=True):
+        file_path = get_day_path(out_dir, day)
+        if os.path.exists(file_path):
+            day_rows = pd.concat([pd.read_pickle(file_path), day_rows], ignore_index=True)
+            day_rows = day_rows.drop_duplicates('股票代码', keep='last')
+        _write_day(day_rows, file_path)
+        days += 1
+    return days
+
+def load_cross_section(day, out_dir, fields=None, codes=None):
+    """读取某个交易日的全市场数据，无数据时返回空表"""
+    file_path = get_day_path(out_dir, day)
+    if not os.path.exists(file_path):
+        return pd.DataFrame(columns=XSECTION_COLUMNS)
+    df = pd.read_pickle(file_path)
+    if codes is not None:
+        df = df[df['股票代码'].isin([str(code).zfill(6) for code in codes])]
+    if fields is not None:
+        df = df[['股票代码', '时间'] + [f for f in fields if f not in ('股票代码', '时间')]]
+    return df.reset_index(drop=True)
+
+def list_trading_days(out_dir):
+    """已存储的全部交易日"""
+    days = []
+    if not os.path.isdir(out_dir):
+        return days
+    for year in sorted(os.listdir(out_dir)):
+        year_dir = os.path.join(out_dir, year)
+        if not os.path.isdir(year_dir):
+            continue
+        days.extend(pd.Timestamp(name[:8]) for name in sorted(os.listdir(year_dir)) if name.endswith('.pkl'))
+    return days
+
+def _split_stock(item):
+    """
+    进程池任务（重建第一步）：读取一只股票，按年份拆分写入临时目录.
+    优先使用不复权数据（成交次数、名称取自归档Excel），没有不复权数据时退回归档Excel中的数据.
+    返回 (股票代码, 行数, 是否使用了不复权数据)
+    """
+    stock_code, file_path, raw_path, stage_dir, cache_dir = item
+    if cache_dir:
+        archive = read_stock_cached(file_path, cache_dir)
+    else:
+        archive = read_stock_file(file_path)
+    if archive.empty:
+        return stock_code, 0, False
+
+    used_raw = bool(raw_path) and os.path.exists(raw_path)
+    if used_raw:
+        bars = pd.read_pickle(raw_path)
+        bars['时间'] = pd.to_datetime(bars['时间'])
+        bars = bars.merge(archive[['时间', '成交次数', '名称']], on='时间', how='left')
+        bars['成交次数'] = bars['成交次数'].fillna(0)
+        bars['名称'] = bars['名称'].fillna(archive['名称'].iloc[-1])
+    else:
+        bars = archive
+    bars = _normalize(bars.assign(股票代码=stock_code))
+
+    for year, year_rows in bars.groupby(bars['时间'].dt.year):
+        year_dir = os.path.join(stage_dir, str(year))
+        os.makedirs(year_dir, exist_ok=True)
+        year_rows.reset_index(drop=True).to_pickle(os.path.join(year_dir, f"{stock_code}.pkl"))
+    return stock_code, len(bars), used_raw
+
+def _build_year(item):
+    """进程池任务（重建第二步）：合并一年内所有股票的数据，按交易日写出. 返回写入的交易日数"""
+    year_dir, out_dir = item
+    frames = [pd.read_pickle(os.path.join(year_dir, name)) for name in os.listdir(year_dir) if name.endswith('.pkl')]
+    if not frames:
+        return 0
+    year_rows = pd.concat(frames, ignore_index=True)
+    days = 0
+    for day, day_rows in year_rows.groupby('时间', sort=True):
+        _write_day(day_rows, get_day_path(out_dir, day))
+        days += 1
+    return days
+
+def rebuild_xsection(file_map, out_dir, raw_dir=None, max_workers=None, cache_dir=None):
+    """
+    由按股票存储的归档并行重建横截面存储.
+    先把每只股票按年份拆分到临时目录，再逐年合并写出交易日文件，内存占用只与一年的数据量有关.
+    新的横截面写在 <out_dir>_new，全部成功后才替换旧目录；中途失败时旧的横截面保持不变.
+    file_map: {股票代码: 归档Excel路径}；raw_dir: 不复权数据目录（<代码>.pkl）
+    返回统计信息字典.
+    """
+    base_dir = out_dir.rstrip(os.sep)
+    stage_dir = f"{base_dir}_staging"
+    new_dir = f"{base_dir}_new"
+    old_dir = f"{base_dir}_old"
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    shutil.rmtree(new_dir, ignore_errors=True)
+    items = [(code, path, os.path.join(raw_dir, f"{code}.pkl") if raw_dir else '', stage_dir, cache_dir)
+             for code, path in file_map.items() if path and os.path.exists(path)]
+
+    stats = {'stocks': 0, 'rows': 0, 'raw_stocks': 0, 'failed': 0, 'days': 0}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_split_stock, item) for item in items]
+            for future in futures:
+                try:
+                    _, rows, used_raw = future.result()
+                except Exception:
+                    stats['failed'] += 1
+                    continue
+                stats['stocks'] += 1
+                stats['rows'] += rows
+                stats['raw_stocks'] += int(used_raw)
+
+            year_dirs = [os.path.join(stage_dir, year) for year in sorted(os.listdir(stage_dir))] if os.path.isdir(stage_dir) else []
+            stats['days'] = sum(executor.map(_build_year, [(year_dir, new_dir) for year_dir in year_dirs]))
+        os.makedirs(new_dir, exist_ok=True)
+        # 旧目录先改名再换入新目录，两次重命名之间中断时旧数据仍在 <out_dir>_old
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.isdir(out_dir):
+            os.replace(out_dir, old_dir)
+        os.replace(new_dir, out_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        shutil.rmtree(new_dir, ignore_errors=True)
+    return stats